@@ -1,67 +1,277 @@
 import sys
+import argparse
 from pathlib import Path
 import os
-from glob import glob
 import re
-from tqdm import tqdm
+import json
+from helpers.inventory import Inventory, SESSION_PATTERN
+from helpers.pgzip import default_threads, get_backend, DEFAULT_LEVEL, BACKEND_ORDER
+from helpers.placement import PLACEMENT_MODES
+from helpers.pipeline import DEFAULT_PIPELINE
 
 def parse_command_line(args):
     '''
     Takes as input command line arguments as a list of strings
     Ensures origin path is specified and valid
-    Returns origin and dest as pathlib.Path
+    Returns origin and dest as pathlib.Path (both None with --from-plan,
+    which takes them from the plan), plus a dict of options
     '''
-    
-    # If no command line arguments given, quit
-    # For now, restrict args to only source and dest
-    if len(args) not in [1,2]:
-        raise ValueError('Usage: python eeg-to-bids.py origin_dir <dest_dir>')
 
-    # Save command line arguments as separate variables
-    origin_path = Path(args[0])
-    if len(args) > 1:
-        dest_path = Path(args[-1])
+    parser = argparse.ArgumentParser(prog='tobids',
+                                     description='Convert raw neuro data to BIDS format.')
+    parser.add_argument('--config',
+                        help='JSON file of option defaults (keys are option names, eg "expect_tasks"); '
+                             'options given on the command line win')
+    parser.add_argument('origin_dir', nargs='?', default=None,
+                        help='Directory containing the raw data (not needed with --from-plan)')
+    parser.add_argument('dest_dir', nargs='?', default='BIDS_data',
+                        help='Directory to write BIDS data to (default: BIDS_data)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of (subject, session) units to convert in parallel')
+    parser.add_argument('--run-jobs', type=int, default=1,
+                        help='Runs (EEG, NIfTI, behavioral) of a session to convert at a time, '
+                             'in dependency order; mne-bids EEG writes still go one at a time '
+                             '(default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Threads used to gzip each NIfTI / convert each EDF (default: CPU count / jobs)')
+    parser.add_argument('--compress-level', type=int, default=DEFAULT_LEVEL,
+                        help='gzip level (0-9) for NIfTI output (default: %(default)s)')
+    parser.add_argument('--compress-backend', default='auto',
+                        choices=['auto'] + BACKEND_ORDER,
+                        help='Deflate implementation; auto picks the fastest installed')
+    parser.add_argument('--no-compress', action='store_true',
+                        help='Write NIfTI images as plain .nii instead of .nii.gz')
+    parser.add_argument('--read-depth', type=int, default=DEFAULT_PIPELINE['read_depth'],
+                        help='NIfTI chunks (8 MB each) read ahead of compression (default: %(default)s)')
+    parser.add_argument('--write-depth', type=int, default=DEFAULT_PIPELINE['write_depth'],
+                        help='Compressed NIfTI blocks (up to 1 MB each) waiting to be written '
+                             '(default: %(default)s)')
+    parser.add_argument('--placement', default='copy', choices=PLACEMENT_MODES,
+                        help='How unchanged source files get into the output: copy, or auto to '
+                             'try hardlink, reflink and copy_file_range before copying')
+    parser.add_argument('--dedup-sidecars', action='store_true',
+                        help='Write identical sidecars once, at the highest BIDS inheritance level')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only regenerate outputs whose source files changed since they were written')
+    parser.add_argument('--hash', action='store_true',
+                        help='With --incremental, compare file contents (sha256) when only the mtime changed')
+    overwrite = parser.add_mutually_exclusive_group()
+    overwrite.add_argument('--overwrite', dest='overwrite', action='store_true', default=None,
+                           help='Overwrite existing data in the BIDS directory (instead of asking)')
+    overwrite.add_argument('--no-overwrite', dest='overwrite', action='store_false',
+                           help='Keep existing data in the BIDS directory (instead of asking)')
+    parser.add_argument('--expect-subjects', type=int, default=None,
+                        help='Expected number of subjects; checked instead of asking')
+    parser.add_argument('--expect-tasks', type=_comma_list, default=None,
+                        help='Expected task names, comma separated (eg, GradCPT,ES); checked instead of asking')
+    parser.add_argument('--plan', action='store_true',
+                        help='Print every output that would be written, with sizes and an estimated time, '
+                             'and stop without writing anything')
+    parser.add_argument('--plan-file',
+                        help='Also save the plan as JSON to this file (implies --plan)')
+    parser.add_argument('--from-plan',
+                        help='Convert exactly what a plan file from --plan-file lists, '
+                             'without scanning the origin or asking again')
+    parser.add_argument('--shard', default=None,
+                        help='Convert only part i of N of the subject / sessions (eg, 3/8, one per '
+                             'array job); run --merge-shards N once all N have finished')
+    parser.add_argument('--merge-shards', type=int, default=None, metavar='N',
+                        help='Combine the output of shards 1/N to N/N and write the dataset-level '
+                             'files (metadata, logs, validation)')
+    parser.add_argument('--queue', action='store_true',
+                        help='Work from a queue in the destination shared by every tobids started with '
+                             '--queue (on any host); once it is empty one of them writes the dataset-level files')
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help='Save where the time went (subject, session, modality, run, stage) as a '
+                             'Chrome trace-event JSON file to open in Perfetto')
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help='Answer yes to every question that has no answer on the command line')
+    parser.add_argument('--non-interactive', action='store_true',
+                        help='Never ask; stop with an error if a question has no answer on the command line')
+
+    # Defaults from the config file, if there is one
+    config = argparse.ArgumentParser(add_help=False)
+    config.add_argument('--config')
+    config_path = config.parse_known_args(args)[0].config
+    if config_path is not None:
+        parser.set_defaults(**load_config(config_path, parser))
+
+    parsed = parser.parse_args(args)
+
+    if parsed.plan_file is not None:
+        parsed.plan = True
+    if parsed.from_plan is not None:
+        if parsed.plan:
+            raise ValueError('Choose one of --plan and --from-plan')
+        if parsed.origin_dir is not None:
+            raise ValueError('--from-plan takes the origin and destination from the plan file')
+    elif parsed.origin_dir is None:
+        parser.error('the following arguments are required: origin_dir')
 
-    # If no destination path is provided
-    else:
-        # call it BIDS_data
-        dest_path = 'BIDS_data'
+    # Save command line arguments as separate variables
+    # (None with --from-plan)
+    origin_path = None
+    dest_path = None
+    if parsed.origin_dir is not None:
+        origin_path = Path(parsed.origin_dir)
+        dest_path = Path(parsed.dest_dir)
+
+        # Ensure the origin directory exists
+        if not os.path.exists(origin_path):
+            raise ValueError('The origin path for the source data that you supplied cannot be found.')
+
+        if origin_path == dest_path:
+            raise ValueError('Cannot have same dir for origin and destination!')
+
+    if parsed.jobs < 1:
+        raise ValueError('--jobs needs to be at least 1')
+    if parsed.run_jobs < 1:
+        raise ValueError('--run-jobs needs to be at least 1')
+
+    if parsed.threads is None:
+        parsed.threads = default_threads(parsed.jobs)
+    if parsed.threads < 1:
+        raise ValueError('--threads needs to be at least 1')
+
+    if not 0 <= parsed.compress_level <= 9:
+        raise ValueError('--compress-level needs to be between 0 and 9')
+
+    if parsed.read_depth < 1 or parsed.write_depth < 1:
+        raise ValueError('--read-depth and --write-depth need to be at least 1')
+
+    if parsed.hash and not parsed.incremental:
+        raise ValueError('--hash only applies with --incremental')
+
+    if parsed.overwrite is not None and parsed.incremental:
+        raise ValueError('--overwrite / --no-overwrite don\'t apply with --incremental')
+
+    if parsed.yes and parsed.non_interactive:
+        raise ValueError('Choose one of --yes and --non-interactive')
+
+    if parsed.shard is not None:
+        parsed.shard = parse_shard(parsed.shard)
+        if parsed.merge_shards is not None:
+            raise ValueError('Choose one of --shard and --merge-shards')
+    if parsed.merge_shards is not None:
+        if parsed.merge_shards < 1:
+            raise ValueError('--merge-shards needs to be at least 1')
+        if parsed.plan or parsed.from_plan:
+            raise ValueError('--merge-shards doesn\'t apply with --plan / --from-plan')
+
+    if parsed.queue and (parsed.shard or parsed.merge_shards or parsed.plan or parsed.from_plan):
+        raise ValueError('--queue doesn\'t apply with --shard / --merge-shards / --plan / --from-plan')
+
+    if isinstance(parsed.expect_tasks, str):
+        parsed.expect_tasks = _comma_list(parsed.expect_tasks)
+
+    options = {'jobs': parsed.jobs,
+               'run_jobs': parsed.run_jobs,
+               'threads': parsed.threads,
+               'placement': parsed.placement,
+               'compression': {'enabled': not parsed.no_compress,
+                               'level': parsed.compress_level,
+                               'backend': get_backend(parsed.compress_backend)},
+               'pipeline': {'read_depth': parsed.read_depth,
+                            'write_depth': parsed.write_depth},
+               'dedup_sidecars': parsed.dedup_sidecars,
+               'incremental': parsed.incremental,
+               'use_hash': parsed.hash,
+               'overwrite': parsed.overwrite,
+               'expect_subjects': parsed.expect_subjects,
+               'expect_tasks': parsed.expect_tasks,
+               'yes': parsed.yes,
+               'interactive': not parsed.non_interactive,
+               'plan': parsed.plan,
+               'plan_file': parsed.plan_file,
+               'from_plan': parsed.from_plan,
+               'shard': parsed.shard,
+               'merge_shards': parsed.merge_shards,
+               'queue': parsed.queue,
+               'trace': parsed.trace}
+
+    return [origin_path, dest_path, options]
+
+
+def load_config(filename, parser):
+    '''
+    Takes as input the path to a JSON config file and the argument parser
+    Returns the option defaults it sets
+    Keys are option names with or without the dashes (eg, {"jobs": 4,
+    "expect_tasks": ["GradCPT"], "no-overwrite": true})
+    Raises an error for a key that isn't a tobids option
+    '''
 
-    # Ensure the origin directory exists
-    if not os.path.exists(origin_path):
-        raise ValueError('The origin path for the source data that you supplied cannot be found.')
+    with open(filename, 'r') as file:
+        config = json.load(file)
+    if not isinstance(config, dict):
+        raise ValueError('Config file {} needs to hold a JSON object'.format(filename))
+
+    actions = {}
+    for action in parser._actions:
+        for option in action.option_strings:
+            if option.startswith('--') and option not in ['--help', '--config']:
+                actions[option] = action
+
+    defaults = {}
+    for key, value in config.items():
+        action = actions.get('--' + key.lstrip('-').replace('_', '-'))
+        if action is None:
+            raise ValueError('Unknown option {} in config file {}'.format(key, filename))
+        # Flags (eg, "no-overwrite": true) set what the flag would
+        if action.nargs == 0:
+            if value:
+                defaults[action.dest] = action.const
+        else:
+            defaults[action.dest] = value
+    return defaults
+
+
+def ask_yes_no(question, options=None):
+    '''
+    Takes as input a y/n question and the options from parse_command_line
+    Returns True for yes, False for no
+    With --yes the answer is yes without asking; with --non-interactive
+    there's nobody to ask, so it's an error
+    '''
 
-    if origin_path == dest_path:
-        raise ValueError('Cannot have same dir for origin and destination!')
+    options = options or {}
+    if options.get('yes'):
+        print(question + 'y (--yes)')
+        return True
+    if not options.get('interactive', True):
+        raise ValueError('Running with --non-interactive, but this needs an answer: {}'
+                         '\nGive it on the command line or in the config file (see tobids --help).'.format(question.strip()))
 
-    return [origin_path, dest_path]
+    response = ''
+    while response not in ['y', 'n']:
+        response = input(question).lower().strip()
+    return response == 'y'
 
 
-def get_overwrite():
-    # Ask user whether to overwrite existing data
+def get_overwrite(options=None):
+    # Ask user whether to overwrite existing data (unless --overwrite /
+    # --no-overwrite already said)
 
-    overwrite = None
-    while overwrite is None:
-        user = input('\nDo you wish to overwrite existing data in the BIDS directory (if the directory already exists)? [y/n] ')
-        user = user.lower().strip()
-        if user in ['y', 'n']:
-            overwrite = True if user == 'y' else False
+    if options and options.get('overwrite') is not None:
+        return options['overwrite']
 
-    return overwrite
+    return ask_yes_no('\nDo you wish to overwrite existing data in the BIDS directory (if the directory already exists)? [y/n] ', options)
 
-def has_sessions(subject_path):
+def has_sessions(subject_path, inventory=None):
     '''
     Takes as input a subject path as Path object
+    (and optionally the origin Inventory to look it up in)
     If there are sessions, returns dict mapping session number to path
     Else, returns false
     (Just looks one dir under subject dir to check whether any sub dirs
     have 'session' in label
     '''
 
-    subdirs = os.listdir(subject_path)
+    if inventory is None:
+        inventory = Inventory(subject_path)
+    subdirs = inventory.subdirs(subject_path)
 
-    pattern = r'[Ss][Ee][Ss].*\d+|\d+.*[Ss][Ee][Ss]'
-    sessions = [x for x in subdirs if re.search(pattern, x)]
+    sessions = [x for x in subdirs if re.search(SESSION_PATTERN, x)]
     out = {}
 
     if sessions:
@@ -78,17 +288,21 @@ def has_sessions(subject_path):
 
 
 
-def parse_subjects(origin_path):
+def parse_subjects(origin_path, inventory=None):
     '''
     Takes in the origin path as a Path object
+    (and optionally the origin Inventory)
     returns a dict mapping three digit subject numbers to the dir in origin
     path
     '''
     
     err = "Couldn't find subject numbers in first level of origin path. Make sure origin directory is structured such that subject directories are in the first level."
 
+    if inventory is None:
+        inventory = Inventory(origin_path)
+
     # Import all first-level dirs
-    dirs = [d for d in os.listdir(origin_path) if os.path.isdir(origin_path/ Path(d))]
+    dirs = inventory.subdirs(origin_path)
 
     # Only keep dir if there's a number in it
     dirs = [d for d in dirs if any(char.isdigit() for char in d)]
@@ -102,7 +316,7 @@ def parse_subjects(origin_path):
     for dir_ in dirs:
         subject = {}
         subject_number = ''.join([char for char in dir_ if char.isnumeric()]).zfill(3)
-        sessions = has_sessions(origin_path / Path(dir_))
+        sessions = has_sessions(origin_path / Path(dir_), inventory)
         subject['number'] = subject_number
         subject['path'] = dir_
         subject['sessions'] = sessions
@@ -114,26 +328,29 @@ def parse_subjects(origin_path):
     return sorted(subjects, key = lambda x: x['number'])
 
 
-def parse_data_type(seek_path):
+def parse_data_type(seek_path, inventory=None):
     '''
-    Takes as input seek path
+    Takes as input seek path (and optionally the origin Inventory)
     returns a boolean tuple indicating whether there is EEG and fMRI data
     present, respectively
     '''
 
+    if inventory is None:
+        inventory = Inventory(seek_path)
+
     eeg = False
     fmri = False
     behav = False
 
-    if glob(str(seek_path) + '/**/*.eeg', recursive=True):
+    if inventory.files(seek_path, extension='.eeg'):
         eeg = True
-    if glob(str(seek_path) + '/**/*.nii', recursive=True):
+    if inventory.files(seek_path, extension='.nii'):
         fmri = True
 
     # For behav
-    ptbps = glob(str(seek_path / Path('**/ptbP.mat')), recursive=True)
-    csvs = glob(str(seek_path / Path('**/*.csv')), recursive=True)
-    gradcpts = glob(str(seek_path / Path('**/*_city_mnt_*.mat')), recursive=True)
+    ptbps = inventory.files(seek_path, pattern='ptbP.mat')
+    csvs = inventory.files(seek_path, extension='.csv')
+    gradcpts = inventory.files(seek_path, pattern='*_city_mnt_*.mat')
     if any(ptbps + csvs + gradcpts):
         behav = True
 
@@ -178,16 +395,22 @@ def make_skeleton(subjects, dest_path, eeg, fmri):
                     os.makedirs(p)
 
 
-def configure_progress_bar(origin_path):
-    
-    eegs = glob(str(origin_path) + '/**/*.eeg', recursive=True)
-    bolds = glob(str(origin_path) + '/**/*_BOLD_*/**/*.nii', recursive=True)
-    fmaps = glob(str(origin_path) + '/**/*_B0map*/**/*.nii', recursive=True)
-    T1ws = glob(str(origin_path) + '/**/*_T1w_*/**/*.nii', recursive=True)
+def parse_shard(value):
+    '''
+    Takes as input the --shard value, 'i/N' with 1 <= i <= N (eg, a SLURM
+    array task id over the shard count)
+    Returns (i, N) as ints
+    '''
 
-    files = len(eegs) + len(bolds) + len(fmaps) + len(T1ws)
+    try:
+        index, count = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise ValueError('--shard needs the form i/N, eg 3/8 (got {})'.format(value))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('--shard i/N needs 1 <= i <= N (got {})'.format(value))
+    return index, count
 
-    progress_bar = tqdm(total = files, desc='Processing')
 
-    return progress_bar
- 
+def _comma_list(value):
+    # 'GradCPT, ES' -> ['GradCPT', 'ES']
+    return [x.strip() for x in value.split(',') if x.strip()]
@@ -0,0 +1,141 @@
+'''
+Per-run cache of EEG events (the events array, event_id and sfreq)
+
+write_eeg already has every run open, so it stores the run's events here;
+the behavioral writers then look them up instead of re-reading the
+converted EEG. Entries live in memory until write_session is done with the
+subject / session (its EEG and behavioral data are written in the same
+call), so a worker going through many units doesn't pile them up. They are
+also saved to <dataset dir>/.tobids_events so a later (eg, --incremental)
+run that skips the EEG, or a --queue item holding just the behavioral
+data, can still use them.
+
+Keys are (subject, session, task, run), see run_key.
+'''
+
+import os
+import json
+import numpy as np
+from pathlib import Path
+from helpers.brainvision import read_events as read_brainvision_events
+
+
+CACHE_DIR = '.tobids_events'
+
+_events = {}
+
+
+def run_key(subject, session, task, run):
+    '''
+    Takes as input the subject, session, task and run in any of the forms
+    used around tobids ('sub-001' or '001', session '-999' or '' if there
+    are no sessions, ...)
+    Returns the cache key as a tuple of plain strings
+    '''
+
+    def strip(value, prefix):
+        value = str(value)
+        return value[len(prefix):] if value.startswith(prefix) else value
+
+    session = strip(session, 'ses-')
+    if session == '-999':
+        session = ''
+    return (strip(subject, 'sub-'), session, str(task), strip(run, 'run-'))
+
+
+def get_cache_dir(rawdata):
+    # Persisted entries sit next to rawdata (outside the BIDS tree)
+    return Path(rawdata).parent / Path(CACHE_DIR)
+
+
+def put_events(key, events, event_id, sfreq, cache_dir=None, vmrk=None):
+    '''
+    Stores a run's events
+
+    PARAMETERS
+    ----------
+    key (tuple): from run_key
+    events (np.ndarray): mne-style events (sample, 0, id)
+    event_id (dict): marker description -> id
+    sfreq (float): sampling rate
+    cache_dir (pathlib.Path): if given, also save the entry there
+    vmrk (pathlib.Path): the marker file the events were read from (the
+                         source .vmrk, which exists whether or not the
+                         output is BrainVision); a saved entry is only used
+                         again while that file is unchanged
+    '''
+
+    _events[key] = (events, event_id, sfreq)
+
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    stamp = _stamp(vmrk) if vmrk is not None else None
+    filename = _cache_file(cache_dir, key)
+    temp = filename.with_name('{}.{}.tmp.npz'.format(filename.stem, os.getpid()))
+    np.savez(temp, events=events, sfreq=sfreq,
+             meta=json.dumps({'event_id': event_id,
+                              'vmrk_path': str(vmrk) if vmrk is not None else None,
+                              'vmrk': stamp}))
+    os.replace(temp, filename)
+
+
+def get_events(key, vhdr_path, cache_dir=None):
+    '''
+    Returns (events, event_id, sfreq) for a run
+    Looks in memory, then in cache_dir (if the .vmrk the entry was read
+    from hasn't changed since it was saved), and only then reads the
+    markers of the converted EEG at vhdr_path
+    '''
+
+    if key in _events:
+        return _events[key]
+
+    vmrk = Path(vhdr_path).with_suffix('.vmrk')
+    if cache_dir is not None:
+        filename = _cache_file(cache_dir, key)
+        if os.path.exists(filename):
+            with np.load(filename) as saved:
+                meta = json.loads(str(saved['meta']))
+                # (entries saved before the marker path was kept are redone)
+                if meta['vmrk'] is not None and meta.get('vmrk_path') is not None \
+                        and meta['vmrk'] == _stamp(meta['vmrk_path']):
+                    _events[key] = (saved['events'], meta['event_id'], float(saved['sfreq']))
+                    return _events[key]
+
+    events, event_id, sfreq = read_events(vhdr_path)
+    put_events(key, events, event_id, sfreq, cache_dir, vmrk)
+    return events, event_id, sfreq
+
+
+def drop_events(subject, session):
+    '''
+    Takes as input a subject and session (as for run_key)
+    Forgets their runs' entries in memory (the saved ones stay)
+    '''
+
+    unit = run_key(subject, session, '', '')[:2]
+    for key in [x for x in _events if x[:2] == unit]:
+        del _events[key]
+
+
+def read_events(vhdr_path):
+    # Reads (events, event_id, sfreq) from a BrainVision file's header and
+    # markers (see helpers/brainvision.py)
+    return read_brainvision_events(vhdr_path)
+
+
+def _cache_file(cache_dir, key):
+    subject, session, task, run = key
+    parts = ['sub-' + subject] + (['ses-' + session] if session else [])
+    parts += ['task-' + task, 'run-' + run]
+    return Path(cache_dir) / Path('_'.join(parts) + '.npz')
+
+
+def _stamp(path):
+    # Size and mtime of path, or None if it doesn't exist
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
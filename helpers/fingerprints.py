@@ -0,0 +1,136 @@
+'''
+Source fingerprints for incremental conversion (tobids.py --incremental)
+
+Every output written in incremental mode gets an entry in a small manifest
+next to it (<output dir>/.tobids_fingerprints.json) recording the size and
+mtime (and optionally a sha256) of each source file it was made from. On
+the next run an output is only regenerated if one of its sources changed.
+Runs without --incremental write no manifests, so the BIDS tree only gets
+them when they're wanted (the first --incremental run over such output
+writes everything once).
+'''
+
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+
+MANIFEST_NAME = '.tobids_fingerprints.json'
+
+# Manifests are read-modify-written; keep threads in this process from
+# interleaving (different processes always work on different dirs)
+_manifest_lock = threading.Lock()
+
+
+def needs_write(dest, sources, overwrite, incremental=False, use_hash=False,
+                remember=True):
+    '''
+    Decide whether an output has to be (re)written
+
+    PARAMETERS
+    ----------
+    dest (pathlib.Path): the output file
+    sources (list of pathlib.Path): the files dest is made from
+    overwrite (bool): the user's overwrite answer (used when not incremental)
+    incremental (bool): if True, rewrite only when the sources changed
+    use_hash (bool): if True, a source whose mtime changed but whose
+                     contents didn't still counts as unchanged
+    remember (bool): if False, never update the manifest (eg, --plan)
+
+    Returns True if dest should be written
+    '''
+
+    if not os.path.exists(dest):
+        return True
+    if incremental:
+        return not is_current(dest, sources, use_hash, remember)
+    return overwrite
+
+
+def is_current(dest, sources, use_hash=False, remember=True):
+    # True if dest was recorded from exactly these sources and none of them
+    # changed since (remember=False leaves the manifest alone)
+
+    dest = Path(dest)
+    entry = _read_manifest(dest.parent).get(dest.name)
+    keys = [_key(x) for x in sources]
+    if entry is None or sorted(entry) != sorted(keys):
+        return False
+
+    rehashed = False
+    for source, key in zip(sources, keys):
+        old = entry[key]
+        try:
+            stat = os.stat(source)
+        except FileNotFoundError:
+            return False
+        if stat.st_size != old['size']:
+            return False
+        if stat.st_mtime_ns == old['mtime_ns']:
+            continue
+        # Touched; only the hash can still save it
+        if not use_hash or old.get('sha256') is None:
+            return False
+        if _hash(source) != old['sha256']:
+            return False
+        rehashed = True
+
+    # Remember the new mtimes so the file isn't hashed again next time
+    if rehashed and remember:
+        record(dest, sources, use_hash)
+
+    return True
+
+
+def record(dest, sources, use_hash=False):
+    # Store the fingerprints of sources as the inputs of dest
+
+    dest = Path(dest)
+    entry = {_key(x): fingerprint(x, use_hash) for x in sources}
+    with _manifest_lock:
+        manifest = _read_manifest(dest.parent)
+        manifest[dest.name] = entry
+        _write_manifest(dest.parent, manifest)
+
+
+def fingerprint(path, use_hash=False):
+    # Returns a dict with size, mtime_ns and (if use_hash) sha256 of path
+
+    stat = os.stat(path)
+    out = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if use_hash:
+        out['sha256'] = _hash(path)
+    return out
+
+
+def _key(path):
+    # Same file reached through different relative paths gets the same key
+    return os.path.realpath(path)
+
+
+def _hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _read_manifest(directory):
+    filename = Path(directory) / Path(MANIFEST_NAME)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as file:
+        return json.load(file)
+
+
+def _write_manifest(directory, manifest):
+    filename = Path(directory) / Path(MANIFEST_NAME)
+    # Own temp file per process (another process may be writing this dir,
+    # eg a --queue worker whose lease ran out)
+    temp = filename.with_name('.{}.{}.tmp'.format(filename.name, os.getpid()))
+    with open(temp, 'w') as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+    os.replace(temp, filename)
@@ -0,0 +1,315 @@
+'''
+A one-pass inventory of the origin directory
+
+The origin tree is walked once with os.scandir and every file is kept in a
+table indexed by directory, subject, session, modality and extension.
+Everything that used to glob / os.walk the origin tree queries this instead.
+
+The scan can be saved to a cache file (eg, rawdata/.tobids_cache). On the
+next run only directories whose mtime or inode changed are listed again;
+everything else comes from the cache.
+'''
+
+import os
+import re
+import time
+import pickle
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import NamedTuple
+
+
+CACHE_VERSION = 1
+
+# Directories modified this close (in seconds) to when they were scanned
+# might change again within the filesystem's mtime resolution, so they
+# always get listed again on the next run
+RACY_WINDOW = 2
+
+# Same rule as helpers.basic_parsing.has_sessions
+SESSION_PATTERN = r'[Ss][Ee][Ss].*\d+|\d+.*[Ss][Ee][Ss]'
+
+MODALITIES = {'.eeg': 'eeg',
+              '.vhdr': 'eeg',
+              '.vmrk': 'eeg',
+              '.nii': 'fmri',
+              '.mat': 'behav',
+              '.csv': 'behav'}
+
+
+class FileRecord(NamedTuple):
+    path: Path          # full path (origin root joined with the rel path)
+    subject: str        # first-level dir name, '' if file sits in the root
+    session: str        # second-level dir name if it's a session dir, else ''
+    modality: str       # 'eeg', 'fmri', 'behav' or 'other'
+    extension: str      # eg, '.eeg'
+    size: int           # bytes
+    mtime: float
+
+
+class Inventory:
+    '''
+    Takes as input the origin path
+    Scans it once; afterwards all queries are answered from memory
+
+    Hidden files and dirs (starting with '.') are left out, matching what
+    glob did before.
+
+    If `cache` (a file path) is given, the previous scan is loaded from it
+    and only changed directories are listed again; the new scan is then
+    saved back to it (unless update_cache is False, eg for tobids --plan).
+    Note a directory's mtime only changes when entries are added, removed
+    or renamed, so sizes / mtimes of files edited in place can be stale.
+    Anything that needs exact file stats has to stat the file itself.
+    '''
+
+    def __init__(self, root, cache=None, update_cache=True, _dirs=None):
+        self.root = Path(root)
+        # How many dirs actually got listed (the rest came from the cache)
+        self.rescanned = 0
+        # Maps dir parts relative to root (tuple) to
+        # {'dirs': [subdir names], 'files': [FileRecord],
+        #  'mtime_ns': int, 'ino': int}
+        if _dirs is not None:
+            self._dirs = _dirs
+        else:
+            cached = _load_cache(cache, self.root) if cache else {}
+            started = time.time()
+            self._dirs = self._scan(cached)
+            if cache and update_cache:
+                _save_cache(cache, self.root, self._dirs, started)
+        self._by_extension = {}
+        self._by_subject = {}
+        self._by_modality = {}
+        for entry in self._dirs.values():
+            for record in entry['files']:
+                self._by_extension.setdefault(record.extension, []).append(record)
+                self._by_subject.setdefault(record.subject, []).append(record)
+                self._by_modality.setdefault(record.modality, []).append(record)
+
+    def _scan(self, cached):
+        # Walk with os.scandir; one stat per entry
+        # Dirs whose mtime / inode match `cached` aren't listed again
+        dirs = {}
+        stack = [()]
+        while stack:
+            rel = stack.pop()
+            dir_stat = os.stat(self.root.joinpath(*rel))
+            old = cached.get(rel)
+            if (old is not None
+                    and old['mtime_ns'] == dir_stat.st_mtime_ns
+                    and old['ino'] == dir_stat.st_ino):
+                dirs[rel] = old
+                stack += [rel + (d,) for d in old['dirs']]
+                continue
+
+            self.rescanned += 1
+            entry = {'dirs': [], 'files': [],
+                     'mtime_ns': dir_stat.st_mtime_ns,
+                     'ino': dir_stat.st_ino}
+            with os.scandir(self.root.joinpath(*rel)) as it:
+                for item in it:
+                    if item.name.startswith('.'):
+                        continue
+                    if item.is_dir():
+                        entry['dirs'].append(item.name)
+                        stack.append(rel + (item.name,))
+                    elif item.is_file():
+                        entry['files'].append(self._make_record(rel, item.name, item.stat()))
+            entry['dirs'].sort()
+            entry['files'].sort()
+            dirs[rel] = entry
+        return dirs
+
+    def _make_record(self, rel, name, stat):
+        subject = rel[0] if rel else ''
+        session = ''
+        if len(rel) > 1 and re.search(SESSION_PATTERN, rel[1]):
+            session = rel[1]
+        extension = os.path.splitext(name)[1]
+        return FileRecord(path=self.root.joinpath(*rel, name),
+                          subject=subject,
+                          session=session,
+                          modality=MODALITIES.get(extension, 'other'),
+                          extension=extension,
+                          size=stat.st_size,
+                          mtime=stat.st_mtime)
+
+    def _rel(self, path):
+        # Path relative to root as a tuple of parts
+        if path is None:
+            return ()
+        return Path(path).relative_to(self.root).parts
+
+    def _walk(self, rel):
+        # Yield (rel parts, entry) for rel and every dir below it
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            entry = self._dirs.get(rel)
+            if entry is None:
+                continue
+            yield rel, entry
+            stack += [rel + (d,) for d in reversed(entry['dirs'])]
+
+    def files(self, under=None, extension=None, pattern=None, within=None,
+              modality=None, recursive=True):
+        '''
+        Returns FileRecords (sorted by path) for files below `under`
+        (default: the whole origin)
+
+        extension (str): keep only this extension, eg '.eeg'
+        pattern (str): fnmatch pattern the file name has to match
+        within (str): fnmatch pattern that at least one parent dir (below
+                      `under`) has to match, eg '*_BOLD_*'
+        modality (str): keep only 'eeg', 'fmri', 'behav' or 'other'
+        recursive (bool): if False, only files directly inside `under`
+        '''
+
+        rel = self._rel(under)
+
+        if recursive and not rel and within is None:
+            # Whole tree: answer straight from the indexes
+            if extension is not None:
+                records = self._by_extension.get(extension, [])
+            elif modality is not None:
+                records = self._by_modality.get(modality, [])
+            else:
+                records = [r for e in self._dirs.values() for r in e['files']]
+            candidates = [(None, r) for r in records]
+        elif recursive:
+            candidates = [(d, r) for d, e in self._walk(rel) for r in e['files']]
+        else:
+            candidates = [(rel, r) for r in self._dirs.get(rel, {'files': []})['files']]
+
+        out = []
+        for dir_rel, record in candidates:
+            if extension is not None and record.extension != extension:
+                continue
+            if modality is not None and record.modality != modality:
+                continue
+            if pattern is not None and not fnmatchcase(record.path.name, pattern):
+                continue
+            if within is not None:
+                parents = dir_rel[len(rel):]
+                if not any(fnmatchcase(p, within) for p in parents):
+                    continue
+            out.append(record)
+
+        return sorted(out, key=lambda x: x.path)
+
+    def subject_files(self, subject):
+        # All FileRecords for one first-level subject dir
+        return self._by_subject.get(subject, [])
+
+    def subdirs(self, path=None):
+        # Names of the (non-hidden) dirs directly inside path
+        entry = self._dirs.get(self._rel(path))
+        if entry is None:
+            return []
+        return list(entry['dirs'])
+
+    def walk_dirs(self, under=None):
+        '''
+        Like os.walk but only returns dirs: yields
+        (dirpath as str, subdir names) for `under` and every dir below it
+        '''
+        for rel, entry in self._walk(self._rel(under)):
+            yield str(self.root.joinpath(*rel)), list(entry['dirs'])
+
+    def size(self, under=None):
+        # Total bytes of all files below under
+        return sum(r.size for r in self.files(under))
+
+    def subset(self, path):
+        '''
+        Returns an Inventory holding only `path` and what's below it
+        (same root, so paths are unchanged). Cheap to hand to a worker
+        process.
+        '''
+        rel = self._rel(path)
+        dirs = {d: e for d, e in self._walk(rel)}
+        # Keep the parents (with only the one child) so _rel still works
+        for i in range(len(rel)):
+            dirs[rel[:i]] = {'dirs': [rel[i]], 'files': []}
+        return Inventory(self.root, _dirs=dirs)
+
+    def to_dict(self):
+        '''
+        Returns the inventory as plain JSON-able data (eg, to save in a
+        tobids --plan file); from_dict turns it back into an Inventory
+        '''
+        dirs = []
+        for rel, entry in sorted(self._dirs.items()):
+            files = [[x.path.name, x.subject, x.session, x.modality,
+                      x.extension, x.size, x.mtime] for x in entry['files']]
+            dirs.append([list(rel), list(entry['dirs']), files])
+        return {'root': str(self.root), 'dirs': dirs}
+
+    @classmethod
+    def from_dict(cls, saved):
+        # Inverse of to_dict
+        root = Path(saved['root'])
+        dirs = {}
+        for rel, subdirs, files in saved['dirs']:
+            rel = tuple(rel)
+            records = [FileRecord(root.joinpath(*rel, name), *fields)
+                       for name, *fields in files]
+            dirs[rel] = {'dirs': subdirs, 'files': records,
+                         'mtime_ns': None, 'ino': None}
+        return cls(root, _dirs=dirs)
+
+
+def _load_cache(cache, root):
+    '''
+    Takes as input the cache file path and the origin root
+    Returns the cached dir table, or an empty dict if there's no usable
+    cache (missing, unreadable, other version or other origin)
+    '''
+
+    if not os.path.exists(cache):
+        return {}
+    try:
+        with open(cache, 'rb') as file:
+            saved = pickle.load(file)
+    except Exception:
+        print('Could not read inventory cache {}; rescanning'.format(cache))
+        return {}
+
+    if saved.get('version') != CACHE_VERSION:
+        return {}
+    if saved['origin'] != os.path.realpath(root):
+        return {}
+
+    dirs = saved['dirs']
+    # Same origin reached through a different path (eg, another cwd)
+    if saved['root'] != str(root):
+        for rel, entry in dirs.items():
+            entry['files'] = [x._replace(path=root.joinpath(*rel, x.path.name))
+                              for x in entry['files']]
+    return dirs
+
+
+def _save_cache(cache, root, dirs, started):
+    # Write the dir table to the cache file (atomically, so concurrent runs
+    # never see half a file)
+
+    racy = (started - RACY_WINDOW) * 1e9
+    out = {}
+    for rel, entry in dirs.items():
+        if entry['mtime_ns'] >= racy:
+            # Too fresh to trust next time
+            entry = dict(entry, mtime_ns=None)
+        out[rel] = entry
+
+    saved = {'version': CACHE_VERSION,
+             'origin': os.path.realpath(root),
+             'root': str(root),
+             'dirs': out}
+
+    cache = Path(cache)
+    os.makedirs(cache.parent, exist_ok=True)
+    temp = cache.with_name('{}.{}.tmp'.format(cache.name, os.getpid()))
+    with open(temp, 'wb') as file:
+        pickle.dump(saved, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, cache)
@@ -3,6 +3,8 @@
 from collections import OrderedDict
 from pathlib import Path
 import pickle
+import fcntl
+from contextlib import contextmanager
 import shutil
 from glob import glob
 import json
@@ -10,20 +12,160 @@ import os
 import pandas as pd
 import json
 
-def make_write_log(ins, outs, modality):
-    first_dir = outs[0].parts[0]
-    write_log = {}
-    name = f'{first_dir}/conversion_log_{modality}'
-    if os.path.exists(name + '.pkl'):
-        with open(name + '.pkl', 'rb') as file:
-            write_log = pickle.load(file) 
-    for i, o in zip(ins, outs):
-        write_log[str(i)] = str(o)
-    with open(name + '.pkl', 'wb') as file:
-        pickle.dump(write_log, file)
-    with open(name + '.json', 'w') as file:
-        json.dump(write_log, file, indent=4)
-    file.close()
+def make_write_log(ins, outs, modality, log_dir=None):
+    '''
+    Appends one record per (input, output) pair to the conversion journal
+    <dataset dir>/conversion_log_<modality>.jsonl
+    (or <log_dir>/conversion_log_<modality>.jsonl if log_dir is given, eg a
+    shard's own dir, see helpers/shards.py)
+
+    Each call is a single locked append, so its cost doesn't grow with the
+    dataset and several processes can log at once. The readable
+    conversion_log_<modality>.json (and .pkl) are built from the journal
+    once at the end by finalize_write_logs.
+    '''
+
+    pairs = list(zip(ins, outs))
+    if not pairs:
+        return
+
+    if log_dir is None:
+        log_dir = _get_log_dir(Path(outs[0]))
+    name = Path(log_dir) / Path(f'conversion_log_{modality}.jsonl')
+    lines = ''.join(json.dumps({'in': str(i), 'out': str(o)}) + '\n' for i, o in pairs)
+    _append_locked(name, lines.encode())
+
+
+def finalize_write_logs(dataset_dir):
+    '''
+    Takes as input the dataset dir (the one holding rawdata)
+    For every conversion journal in it, writes the conversion_log_<modality>
+    .json / .pkl views (input path -> output path, latest record wins) and
+    compacts the journal down to those records
+    '''
+
+    dataset_dir = Path(dataset_dir)
+
+    for journal in sorted(glob(str(dataset_dir / Path('conversion_log_*.jsonl')))):
+        journal = Path(journal)
+        name = journal.with_suffix('')
+
+        with open(journal, 'a+b') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.seek(0)
+                write_log = {}
+                for line in file.read().decode().splitlines():
+                    # A writer killed mid-append can leave a partial last line
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    write_log[record['in']] = record['out']
+                write_log = dict(sorted(write_log.items()))
+
+                # Compact: swap in a journal holding only the live records
+                # (appenders notice the new inode and reopen, see
+                # _append_locked)
+                temp = journal.with_name(journal.name + '.tmp')
+                with open(temp, 'w') as out:
+                    for i, o in write_log.items():
+                        out.write(json.dumps({'in': i, 'out': o}) + '\n')
+                os.replace(temp, journal)
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+        with open(str(name) + '.pkl', 'wb') as file:
+            pickle.dump(write_log, file)
+        with open(str(name) + '.json', 'w') as file:
+            json.dump(write_log, file, indent=4)
+
+
+def merge_write_logs(from_dir, dataset_dir):
+    '''
+    Appends the records of every conversion journal in from_dir (eg, a
+    shard's dir) to the journal of the same modality in dataset_dir
+    '''
+
+    for journal in sorted(glob(str(Path(from_dir) / Path('conversion_log_*.jsonl')))):
+        with open(journal, 'rb') as file:
+            data = file.read()
+        if data and not data.endswith(b'\n'):
+            # Drop a partial last line (writer killed mid-append)
+            data = data[:data.rfind(b'\n') + 1]
+        if data:
+            _append_locked(Path(dataset_dir) / Path(journal).name, data)
+
+
+def _get_log_dir(out):
+    # Logs go in the dataset dir, ie the parent of rawdata
+    for parent in out.parents:
+        if parent.name == 'rawdata':
+            return parent.parent
+    return Path(out.parts[0])
+
+
+def _append_locked(name, data):
+    # Append data to the journal under an exclusive lock
+    # If the journal got swapped out (compacted) while we waited for the
+    # lock, reopen and append to the new one
+
+    if not os.path.exists(name):
+        _import_pickle_log(name)
+
+    while True:
+        with open(name, 'ab') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(file.fileno()).st_ino != os.stat(name).st_ino:
+                    continue
+                file.write(data)
+                file.flush()
+                return
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _import_pickle_log(name):
+    # Seed a new journal with the records of an old-style pickle log
+    # (from before the journal) so they aren't lost from the .json view
+
+    pkl = Path(name).with_suffix('.pkl')
+    if not os.path.exists(pkl):
+        return
+    with open(pkl, 'rb') as file:
+        write_log = pickle.load(file)
+    lines = ''.join(json.dumps({'in': i, 'out': o}) + '\n' for i, o in write_log.items())
+    # O_EXCL: if another process got here first, its import stands
+    try:
+        fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        return
+    with os.fdopen(fd, 'w') as file:
+        file.write(lines)
+
+
+@contextmanager
+def dataset_lock(root):
+    '''
+    Takes as input the BIDS root (rawdata dir) as pathlib.Path
+    Holds an exclusive lock on root/.tobids_lock for the duration of the
+    block
+    Used around anything that touches dataset-level files (participants.tsv,
+    dataset_description.json, ...) so concurrent writers don't clobber each
+    other
+    '''
+
+    root = Path(root)
+    if not os.path.exists(root):
+        os.makedirs(root, exist_ok=True)
+
+    with open(root / Path('.tobids_lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
 def make_metadata(dest_path):
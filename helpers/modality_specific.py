@@ -1,6 +1,8 @@
 import numpy as np
 import sys
 import pandas as pd
+import json
+import hashlib
 import warnings
 from collections import OrderedDict
 from mne.channels.channels import _unit2human
@@ -20,6 +22,9 @@ I'll have a different function later in the pipeline that worries about
 writing all these objects to file.
 '''
 
+# Channel tables built so far, by _get_channels_key
+_channel_tables = {}
+
 
 def get_eeg_json(task_name, raw):
     '''
@@ -70,70 +75,18 @@ def get_channels_tsv(raw):
 
     *_channels.tsv is only recommended (not required)
 
+    Every run recorded with the same cap gives the same table, so tables
+    are kept (for the life of the process) by a hash of what they're built
+    from, and later runs get a copy instead of rebuilding it
+
     ** Come back and comment each with descriptions from docs:
     https://bids-specification.readthedocs.io/en/stable/04-modality-specific-files/03-electroencephalography.html
     ** See line 107 in mne_bids.write
     '''
-    data = OrderedDict()
-    chs = raw.info['chs']
-
-    # Get channel type mapping from MNE to BIDs
-    map_chs = _get_ch_type_mapping(fro='mne', to='bids')
-
-    # Determine channel type and status
-    # * Could also add description
-
-    get_specific = ("mag", "ref_meg", "grad")
-    ch_type, status = list(), list()
-    map_chs = _get_ch_type_mapping(fro='mne', to='bids')
-    for idx, ch in enumerate(raw.info['ch_names']):
-        status.append('bad' if ch in raw.info['bads'] else 'good')
-        _channel_type = channel_type(raw.info, idx)
-        if _channel_type in get_specific:
-            _channel_type = coil_type(raw.info, idx, _channel_type)
-        ch_type.append(map_chs[_channel_type])
-
-        # Determine units
-        if raw._orig_units:
-            units = [raw._orig_units.get(ch, "n/a") for ch in raw.ch_names]
-        else:
-            units = [_unit2human.get(ch_i["unit"], "n/a") for ch_i in raw.info["chs"]]
-            units = [u if u not in ["NA"] else "n/a" for u in units]
-
-    # Sampling frequencty
-    sfreq = raw.info['sfreq']
-    nchan = raw.info['nchan']
-
-    ## The following fields are required: ##
-
-    # Label of the channel.
-    # Values in name MUST be unique.
-    # This column must appear first in the file.
-    data['name'] = raw.info['ch_names']
-
-    # Type of channel; MUST use the channel types listed below. Note that the type MUST be in upper-case.
-    # This column must appear second in the file.
-    # (We'll generally want type EEG or ECG)
-    
-    data['type'] = ch_type
-
-    # Physical unit of the value represented in this channel, for example, V for Volt, or fT/cm for femto Tesla per centimeter (see Units).
-    # This column must appear third in the file.
-
-    data['units'] = units
-
-    ## The following fields are optional: ##
-
-    data['description'] = ''
-    data['sampling_frequency'] = np.full((nchan), sfreq)
-    data['reference'] = ''
-    data['low_cutoff'] = ''
-    data['high_cutoff'] = ''
-    data['notch'] = ''
-    data['status'] = status
-    data['status_description'] = ''
-
-    return pd.DataFrame(_keep_non_empty(data))
+    key = _get_channels_key(raw)
+    if key not in _channel_tables:
+        _channel_tables[key] = _make_channels_tsv(raw)
+    return _channel_tables[key].copy()
 
 
 def get_electrodes_tsv(raw):
@@ -173,8 +126,79 @@ def get_electrodes_tsv(raw):
 
     return pd.DataFrame(_keep_non_empty(data))
 
+def _get_channels_key(raw):
+    # Hash of everything the channels table depends on: channel names,
+    # kinds, coil types and units, original units, bads and sfreq
+    info = raw.info
+    chs = [(int(ch['kind']), int(ch['coil_type']), int(ch['unit']))
+           for ch in info['chs']]
+    content = json.dumps([info['ch_names'], chs, raw._orig_units or {},
+                          sorted(info['bads']), info['sfreq']])
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def _make_channels_tsv(raw):
+    # Builds the *_channels.tsv table (see get_channels_tsv)
+    data = OrderedDict()
+    info = raw.info
+    names = np.array(info['ch_names'])
+    nchan = info['nchan']
+
+    # Determine channel type (mne -> BIDS)
+    # * Could also add description
+    map_chs = _get_ch_type_mapping(fro='mne', to='bids')
+    get_specific = ("mag", "ref_meg", "grad")
+    ch_type = list()
+    for idx in range(nchan):
+        _channel_type = channel_type(info, idx)
+        if _channel_type in get_specific:
+            _channel_type = coil_type(info, idx, _channel_type)
+        ch_type.append(map_chs[_channel_type])
+
+    # Determine units
+    if raw._orig_units:
+        units = [raw._orig_units.get(ch, "n/a") for ch in info['ch_names']]
+    else:
+        units = [_unit2human.get(ch_i["unit"], "n/a") for ch_i in info["chs"]]
+        units = [u if u not in ["NA"] else "n/a" for u in units]
+
+    # Determine status
+    status = np.where(np.isin(names, info['bads']), 'bad', 'good')
+
+    ## The following fields are required: ##
+
+    # Label of the channel.
+    # Values in name MUST be unique.
+    # This column must appear first in the file.
+    data['name'] = info['ch_names']
+
+    # Type of channel; MUST use the channel types listed below. Note that the type MUST be in upper-case.
+    # This column must appear second in the file.
+    # (We'll generally want type EEG or ECG)
+    data['type'] = ch_type
+
+    # Physical unit of the value represented in this channel, for example, V for Volt, or fT/cm for femto Tesla per centimeter (see Units).
+    # This column must appear third in the file.
+    data['units'] = units
+
+    ## The following fields are optional: ##
+
+    data['description'] = ''
+    data['sampling_frequency'] = np.full((nchan), info['sfreq'])
+    data['reference'] = ''
+    data['low_cutoff'] = ''
+    data['high_cutoff'] = ''
+    data['notch'] = ''
+    data['status'] = status
+    data['status_description'] = ''
+
+    return pd.DataFrame(_keep_non_empty(data))
+
+
 def _keep_non_empty(data):
-    # Keep only non-empty entries
+    # Keep only non-empty entries (columns given as '' are left out; arrays
+    # and lists are always kept)
     warnings.simplefilter("ignore", category=FutureWarning)
-    data = OrderedDict((key, value) for key, value in data.items() if value != '')
+    data = OrderedDict((key, value) for key, value in data.items()
+                       if not (isinstance(value, str) and value == ''))
     return data
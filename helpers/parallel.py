@@ -0,0 +1,151 @@
+'''
+Tools for converting several subject / session units at once on a process
+pool (tobids.py --jobs N)
+'''
+
+import os
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from writers.session_tools import write_session
+from helpers.work_queue import run_worker
+from helpers.trace import join_trace, flush_trace
+
+
+class QueueProgress:
+    '''
+    Stands in for the progress bar inside worker processes
+    Every update is sent back to the main process, which applies it to the
+    real bar (see helpers/progress.py)
+    '''
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def update(self, n=1, kind=None, seconds=0.0):
+        self.queue.put((n, kind, seconds))
+
+
+def run_parallel(units, settings, jobs, progress_bar):
+    '''
+    Converts each unit from get_session_units on a pool of `jobs` processes
+
+    PARAMETERS
+    ----------
+    units (list of dict): from writers.session_tools.get_session_units
+    settings (dict): passed through to write_session
+    jobs (int): number of worker processes
+    progress_bar (ByteProgress): the main progress bar; workers report into it
+
+    Largest units (by source bytes) are handed out first so a big subject
+    doesn't end up running alone at the end.
+    Returns the stats from write_session for each unit (in unit order)
+    '''
+
+    if not units:
+        return []
+
+    # Biggest first, ties broken by serial order
+    order = sorted(range(len(units)), key=lambda i: (-units[i]['size'], i))
+
+    results = [None] * len(units)
+    with _progress_queue(progress_bar) as queue:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(_write_session_worker, units[i], settings, queue): i
+                       for i in order}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception:
+                    pool.shutdown(wait=True, cancel_futures=True)
+                    raise
+
+    # (a shard's participants.tsv is in its own dir, see helpers/shards.py)
+    sort_participants(settings['shard_dir'] or units[0]['dest_path'])
+
+    return results
+
+
+def run_queue_workers(dataset_dir, items, units, settings, jobs, progress_bar):
+    '''
+    Runs `jobs` workers of the shared queue (tobids.py --queue, see
+    helpers/work_queue.py) on a process pool, each until the queue has
+    nothing left for it
+    Takes as input the dataset dir, what load_queue returned, the number
+    of workers and the main progress bar (workers report into it)
+    '''
+
+    with _progress_queue(progress_bar) as queue:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(_queue_worker, dataset_dir, items, units, settings, queue)
+                       for _ in range(jobs)]
+            for future in as_completed(futures):
+                future.result()
+
+
+def sort_participants(dest_path):
+    '''
+    Takes as input the rawdata dir
+    mne-bids appends each new subject to participants.tsv as it is written,
+    so workers finishing out of order shuffle the rows. Put them back in
+    subject order (the order of a serial run).
+    '''
+
+    filename = os.path.join(dest_path, 'participants.tsv')
+    if not os.path.exists(filename):
+        return
+
+    # Sort the raw lines so nothing else about the file changes
+    with open(filename, 'r') as file:
+        header, *rows = file.read().splitlines(keepends=True)
+    rows = sorted(rows, key=lambda x: x.split('\t')[0])
+    with open(filename, 'w') as file:
+        file.write(header + ''.join(rows))
+
+
+def _write_session_worker(unit, settings, queue):
+    # Runs in the worker process (with tobids --trace, its spans go to
+    # the trace's part for this process, see helpers/trace.py)
+    print('\nProcessing Subject {}'.format(unit['subject']))
+    join_trace(settings['trace'])
+    try:
+        return write_session(unit, settings, QueueProgress(queue))
+    finally:
+        flush_trace()
+
+
+def _queue_worker(dataset_dir, items, units, settings, queue):
+    # Runs in the worker process (its own worker name: host-pid)
+    join_trace(settings['trace'])
+    try:
+        run_worker(dataset_dir, items, units, settings, QueueProgress(queue))
+    finally:
+        flush_trace()
+
+
+@contextmanager
+def _progress_queue(progress_bar):
+    # A queue worker processes can send progress updates through, drained
+    # onto the real bar while the block runs
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    listener = threading.Thread(target=_drain_progress,
+                                args=(queue, progress_bar),
+                                daemon=True)
+    listener.start()
+    try:
+        yield queue
+    finally:
+        queue.put(None)
+        listener.join()
+        manager.shutdown()
+
+
+def _drain_progress(queue, progress_bar):
+    # Move worker progress updates onto the real bar until told to stop
+    while True:
+        message = queue.get()
+        if message is None:
+            break
+        progress_bar.update(*message)
@@ -0,0 +1,222 @@
+'''
+Overlapped read / compress / write of NIfTI images (write_fmri)
+
+The images of a session go through three stages that run at the same
+time, each on its own thread:
+    read      streams the header and voxel bytes of each image from the
+              origin, CHUNK_SIZE at a time, up to read_depth chunks ahead
+              (so the next image is prefetched while this one compresses)
+    compress  feeds the chunks to a ParallelGzipWriter (which deflates on
+              its own threads, see helpers/pgzip.py); this is the calling
+              thread
+    write     writes the compressed output to the destination, with up to
+              write_depth pieces queued (so the previous image is flushed
+              while this one compresses)
+The queues are bounded, so memory stays at about read_depth chunks plus
+write_depth compressed blocks, however large or many the images are.
+
+Each stage times how long it was busy (not waiting on the others); these
+go in the NIfTI stats for the report. With tobids --trace, each stage's
+work on each image is also a span (see helpers/trace.py).
+'''
+
+import os
+import time
+import queue
+import threading
+from helpers.pgzip import ParallelGzipWriter
+from helpers.trace import span
+
+
+# Bytes read from a source .nii at a time
+CHUNK_SIZE = 8 << 20
+
+# Chunks read ahead, and pieces of output (a compressed block, or a chunk
+# when not compressing) waiting to be written
+DEFAULT_PIPELINE = {'read_depth': 4, 'write_depth': 16}
+
+# Put on the read queue when the read stage failed
+_FAILED = object()
+
+
+def run_pipeline(images, compression, threads, finished, stats, depths=None):
+    '''
+    PARAMETERS
+    ----------
+    images (list): (source, dest, n_bytes) per image; the first n_bytes of
+                   source (header and voxels) go to dest
+    compression (dict): {'enabled', 'level', 'backend'} (see write_fmri)
+    threads (int): threads to gzip each image on
+    finished (function): called as finished(index) once the dest of
+                         images[index] is complete (on the write thread)
+    stats (dict): NIfTI stats (see helpers.pgzip.new_stats); the pipeline's
+                  wall time and each stage's busy time are added to it
+    depths (dict): {'read_depth', 'write_depth'} (default DEFAULT_PIPELINE)
+    '''
+
+    if depths is None:
+        depths = DEFAULT_PIPELINE
+
+    started = time.perf_counter()
+    reads = queue.Queue(maxsize=depths['read_depth'])
+    writes = queue.Queue(maxsize=depths['write_depth'])
+    stop = threading.Event()
+    busy = {'read': 0.0, 'compress': 0.0, 'write': 0.0}
+    errors = []
+
+    reader = threading.Thread(target=_read_stage, args=(images, reads, stop, busy, errors),
+                              name='nifti read', daemon=True)
+    writer = threading.Thread(target=_write_stage, args=(writes, finished, busy, errors),
+                              name='nifti write', daemon=True)
+    reader.start()
+    writer.start()
+
+    try:
+        for index, (source, dest, n_bytes) in enumerate(images):
+            sink = _QueueFile(writes, index, dest)
+            if compression['enabled']:
+                out = ParallelGzipWriter(sink, threads, level=compression['level'],
+                                         backend=compression['backend'])
+            else:
+                out = sink
+
+            working = time.perf_counter()
+            waited = 0.0
+            with span('compress ' + dest.name, bytes=n_bytes):
+                while True:
+                    waiting = time.perf_counter()
+                    chunk = reads.get()
+                    waited += time.perf_counter() - waiting
+                    if chunk is _FAILED:
+                        raise errors[0]
+                    if chunk is None:
+                        break
+                    out.write(chunk)
+                out.close()
+            # Time spent waiting on the read and write queues isn't work
+            busy['compress'] += time.perf_counter() - working - waited - sink.waited
+
+            # Stop early if writing failed
+            if errors:
+                raise errors[0]
+    finally:
+        stop.set()
+        writes.put(None)
+        writer.join()
+        reader.join()
+
+    if errors:
+        raise errors[0]
+
+    stats['seconds'] += time.perf_counter() - started
+    for stage in busy:
+        stats[stage + '_seconds'] += busy[stage]
+
+
+class _QueueFile:
+    '''
+    The write end of one image: what gets written goes on the write queue
+    (ParallelGzipWriter writes its output here), close() marks the image
+    complete. waited is the time spent blocked on a full queue
+    '''
+
+    def __init__(self, writes, index, dest):
+        self.writes = writes
+        self.index = index
+        self.waited = 0.0
+        self._put(('open', dest))
+
+    def write(self, data):
+        self._put(bytes(data))
+        return len(data)
+
+    def close(self):
+        self._put(('close', self.index))
+
+    def _put(self, message):
+        started = time.perf_counter()
+        self.writes.put(message)
+        self.waited += time.perf_counter() - started
+
+
+def _read_stage(images, reads, stop, busy, errors):
+    # Stream every image's bytes onto the read queue, None after each one
+    try:
+        for source, _, remaining in images:
+            with span('read ' + source.name, bytes=remaining), open(source, 'rb') as file:
+                while remaining:
+                    started = time.perf_counter()
+                    chunk = file.read(min(CHUNK_SIZE, remaining))
+                    busy['read'] += time.perf_counter() - started
+                    if not chunk:
+                        raise ValueError('{} is shorter than its header says'.format(source))
+                    remaining -= len(chunk)
+                    if not _put_unless(reads, chunk, stop):
+                        return
+            if not _put_unless(reads, None, stop):
+                return
+    except Exception as error:
+        errors.append(error)
+        _put_unless(reads, _FAILED, stop)
+
+
+def _write_stage(writes, finished, busy, errors):
+    # Write what comes off the write queue until told to stop
+    # After an error, keep taking messages (so the compressor never blocks)
+    # but do nothing with them
+    # Each image is written to a temp file next to its dest and only
+    # replaces the dest once complete, so a failed run never leaves a
+    # truncated image at the BIDS path (which a later run would keep)
+    # Each image is one span, from opening its output to closing it
+    file = None
+    dest = None
+    temp = None
+    image = None
+    while True:
+        message = writes.get()
+        if message is None:
+            break
+        if errors:
+            continue
+        started = time.perf_counter()
+        try:
+            if isinstance(message, bytes):
+                file.write(message)
+            elif message[0] == 'open':
+                image = span('write ' + message[1].name)
+                image.__enter__()
+                dest = message[1]
+                temp = dest.with_name('.{}.{}.tmp'.format(dest.name, os.getpid()))
+                file = open(temp, 'wb')
+            else:
+                image.set(bytes=file.tell())
+                file.close()
+                file = None
+                # Replaces the old output's dir entry, so an old output that
+                # is a hardlink to a source is never written through
+                os.replace(temp, dest)
+                temp = None
+                image.__exit__(None, None, None)
+                busy['write'] += time.perf_counter() - started
+                finished(message[1])
+                continue
+        except Exception as error:
+            errors.append(error)
+        busy['write'] += time.perf_counter() - started
+
+    if file is not None:
+        file.close()
+    if temp is not None and os.path.exists(temp):
+        os.remove(temp)
+
+
+def _put_unless(items, item, stop):
+    # Put item on the queue, unless stop is set while it's full
+    # Returns whether it was put
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
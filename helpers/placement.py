@@ -0,0 +1,130 @@
+'''
+Putting source files into the BIDS output without duplicating their bytes
+(tobids.py --placement auto)
+
+Files that go into the output unchanged (the BrainVision .eeg, fMRI
+sidecars, uncompressed NIfTI) are placed with the cheapest method that
+works, in this order:
+    hardlink         same inode, no new data at all (same filesystem only)
+    reflink          copy-on-write clone (eg, btrfs, XFS)
+    copy_file_range  the kernel copies without going through userspace
+    copy             plain shutil.copy
+With --placement copy (the default) every file is simply copied.
+
+A hardlinked output IS the source file: editing it in place edits the raw
+data too. tobids itself never writes into a placed file (outputs are
+always replaced, see place_file).
+'''
+
+import os
+import errno
+import fcntl
+import shutil
+from pathlib import Path
+
+
+METHODS = ['hardlink', 'reflink', 'copy_file_range', 'copy']
+
+PLACEMENT_MODES = ['copy', 'auto']
+
+# ioctl request for cloning a whole file (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def place_file(source, dest, mode='copy'):
+    '''
+    Puts a copy of source at dest
+
+    PARAMETERS
+    ----------
+    source (pathlib.Path): the file to place
+    dest (pathlib.Path): where it goes
+    mode (str): 'copy' to always copy, 'auto' to try the METHODS in order
+
+    Returns the method that was used
+    An existing dest is removed first rather than written into, in case it
+    is a hardlink to a source file
+    '''
+
+    _remove(dest)
+
+    methods = METHODS if mode == 'auto' else ['copy']
+    for method in methods[:-1]:
+        try:
+            _PLACERS[method](source, dest)
+            return method
+        except OSError:
+            # Don't leave a partial file for the next method
+            _remove(dest)
+
+    _PLACERS[methods[-1]](source, dest)
+    return methods[-1]
+
+
+def placement_report(placements):
+    '''
+    Takes as input a list of (source, dest, method) tuples
+    Returns a one-line count of the files placed by each method
+    '''
+
+    if not placements:
+        return 'Placed files: none'
+
+    counts = {}
+    for _, _, method in placements:
+        counts[method] = counts.get(method, 0) + 1
+    parts = ['{} {}'.format(x, counts[x]) for x in METHODS if x in counts]
+    return 'Placed files: {} ({})'.format(len(placements), ', '.join(parts))
+
+
+def write_placement_log(placements, dataset_dir):
+    '''
+    Takes as input a list of (source, dest, method) tuples and the dataset
+    dir (the one holding rawdata)
+    Writes placement_log.tsv there with the method used for each file
+    placed in this run (sorted by dest)
+    '''
+
+    filename = Path(dataset_dir) / Path('placement_log.tsv')
+    with open(filename, 'w') as file:
+        file.write('dest\tsource\tmethod\n')
+        for source, dest, method in sorted(placements, key=lambda x: str(x[1])):
+            file.write('{}\t{}\t{}\n'.format(dest, source, method))
+
+
+def _remove(path):
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+def _hardlink(source, dest):
+    os.link(source, dest)
+
+
+def _reflink(source, dest):
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copymode(source, dest)
+
+
+def _copy_file_range(source, dest):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+            if copied == 0:
+                raise OSError(errno.EIO, 'copy_file_range stopped early')
+            remaining -= copied
+    shutil.copymode(source, dest)
+
+
+def _copy(source, dest):
+    shutil.copy(source, dest)
+
+
+_PLACERS = {'hardlink': _hardlink,
+            'reflink': _reflink,
+            'copy_file_range': _copy_file_range,
+            'copy': _copy}
@@ -0,0 +1,303 @@
+'''
+Dry-run planning (tobids.py --plan / --plan-file / --from-plan)
+
+make_plan lists, for every subject / session unit, each output the writers
+would produce: the EEG runs (write_eeg), the NIfTI images with their
+sidecars (write_fmri) and the behavioral events (write_behav), each with
+its source files, BIDS destinations, source bytes and whether it would be
+written or skipped (same overwrite / --incremental rules as a real run).
+Nothing is written, copied or compressed.
+
+Times are estimated from the source bytes and the throughput measured on
+earlier runs into the same dataset (see helpers/throughput.py); the wall
+time hands units to --jobs workers largest first, like run_parallel.
+
+A plan saved as JSON holds the units (with their part of the inventory) and
+the settings, so --from-plan can execute it later without scanning the
+origin tree or asking anything again.
+'''
+
+import os
+import json
+import heapq
+from pathlib import Path
+from helpers.basic_parsing import parse_data_type
+from helpers.fingerprints import needs_write
+from helpers.inventory import Inventory
+from helpers.throughput import load_throughput
+from writers.eeg_tools import get_eeg_runs
+from writers.fmri_tools import get_fmri_scans, get_fmri_root
+from writers.behav_tools import get_behav_runs
+
+
+PLAN_VERSION = 2
+
+# Unit fields that hold paths
+PATH_FIELDS = ['seek_path', 'write_path', 'dest_path', 'subject_arg', 'session_arg']
+
+
+def make_plan(units, settings, origin_path, dest_path, jobs=1, shard=None, split=None):
+    '''
+    PARAMETERS
+    ----------
+    units (list of dict): from writers.session_tools.get_session_units
+    settings (dict): the settings write_session would be run with
+    origin_path (pathlib.Path): root of the raw data
+    dest_path (pathlib.Path): the rawdata dir in the BIDS dest
+    jobs (int): number of worker processes the estimate is for
+    shard (tuple): (i, N) if units are shard i of N (tobids --shard)
+    split (list of str): with shard, the keys of every unit in the split
+                         (see helpers/shards.py)
+
+    Returns the plan as a dict (JSON-able) with keys
+        origin, dest, settings, jobs, shard, split
+        throughput: bytes per second per kind of data, and 'measured', the
+                    number of earlier runs each rate comes from (0: default)
+        units: per unit the unit's fields, its 'items' (kind, action
+               'write' / 'skip', sources as [path, bytes], dests, bytes),
+               'bytes' and 'estimated_seconds' of the work to do
+        totals: items, write, skip, bytes (to write), estimated_seconds
+                (one worker) and estimated_wall_seconds (with jobs workers)
+    '''
+
+    rates, measured = load_throughput(dest_path.parent)
+
+    plan_units = []
+    for unit in units:
+        items = _plan_unit(unit, settings)
+        work = [x for x in items if x['action'] == 'write']
+        planned = unit_to_dict(unit)
+        planned['items'] = items
+        planned['bytes'] = sum(x['bytes'] for x in work)
+        planned['estimated_seconds'] = sum(x['bytes'] / rates[x['kind']] for x in work)
+        plan_units.append(planned)
+
+    items = [x for unit in plan_units for x in unit['items']]
+    totals = {'items': len(items),
+              'write': len([x for x in items if x['action'] == 'write']),
+              'skip': len([x for x in items if x['action'] == 'skip']),
+              'bytes': sum(x['bytes'] for x in plan_units),
+              'estimated_seconds': sum(x['estimated_seconds'] for x in plan_units),
+              'estimated_wall_seconds': _wall_time(plan_units, jobs)}
+
+    return {'version': PLAN_VERSION,
+            'origin': str(origin_path),
+            'dest': str(dest_path),
+            'settings': settings,
+            'jobs': jobs,
+            'shard': shard,
+            'split': split,
+            'throughput': dict(rates, measured=measured),
+            'units': plan_units,
+            'totals': totals}
+
+
+def plan_report(plan, origin_path=None):
+    '''
+    Takes as input a plan from make_plan
+    Returns it as text: one line per planned output
+    (action, kind, source -> destination), then a summary per unit and
+    the estimated time
+    '''
+
+    origin = Path(origin_path or plan['origin'])
+    dataset = Path(plan['dest']).parent
+    lines = []
+    for unit in plan['units']:
+        name = 'sub-{}'.format(unit['subject'])
+        if unit['session'] != '-999':
+            name += ' ses-{}'.format(unit['session'])
+        lines.append('{}: {} to write, ~{}'.format(name, _format_bytes(unit['bytes']),
+                                                   _format_seconds(unit['estimated_seconds'])))
+        for item in unit['items']:
+            source = _relative(item['sources'][0][0], origin)
+            dest = _relative(item['dests'][0], dataset)
+            extra = len(item['dests']) - 1
+            lines.append('  {:<5} {:<5} {} -> {}{}'.format(
+                item['action'], item['kind'], source, dest,
+                ' (+{} more)'.format(extra) if extra else ''))
+
+    totals = plan['totals']
+    throughput = plan['throughput']
+    rates = []
+    for kind in ['eeg', 'fmri', 'behav']:
+        runs = throughput['measured'][kind]
+        rates.append('{} {:.1f} MB/s ({})'.format(
+            kind, throughput[kind] / 1e6,
+            'last {} runs'.format(runs) if runs else 'default'))
+    lines += ['',
+              'Plan: {} units, {} outputs to write ({}), {} up to date'.format(
+                  len(plan['units']), totals['write'], _format_bytes(totals['bytes']),
+                  totals['skip']),
+              'Throughput per worker: ' + ', '.join(rates),
+              'Estimated time: ~{} with --jobs {} (~{} on one worker)'.format(
+                  _format_seconds(totals['estimated_wall_seconds']), plan['jobs'],
+                  _format_seconds(totals['estimated_seconds']))]
+    return '\n'.join(lines)
+
+
+def save_plan(plan, filename):
+    # Write the plan as JSON (atomically)
+    filename = Path(filename)
+    temp = filename.with_name('.{}.{}.tmp'.format(filename.name, os.getpid()))
+    with open(temp, 'w') as file:
+        json.dump(plan, file, indent=1)
+    os.replace(temp, filename)
+
+
+def load_plan(filename):
+    '''
+    Takes as input a plan file from save_plan
+    Returns (plan, units) with the units ready for write_session
+    Raises an error if a source file under the origin changed since the
+    plan was made (the plan has to be made again then)
+    '''
+
+    with open(filename, 'r') as file:
+        plan = json.load(file)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('{} is not a plan from this version of tobids; make the plan again'.format(filename))
+
+    origin = os.path.realpath(plan['origin'])
+    for unit in plan['units']:
+        for item in unit['items']:
+            for source, size in item['sources']:
+                # EEG-synced events also read converted EEG in the dest,
+                # which the run itself rewrites
+                if not os.path.realpath(source).startswith(origin + os.sep):
+                    continue
+                if not os.path.exists(source) or os.path.getsize(source) != size:
+                    raise ValueError('{} changed since the plan {} was made; '
+                                     'make the plan again'.format(source, filename))
+
+    units = [unit_from_dict(x) for x in plan['units']]
+    return plan, units
+
+
+def _plan_unit(unit, settings):
+    # The planned outputs of one unit, in the order write_session writes
+    # them (mirrors write_session / write_eeg / write_fmri / write_behav)
+
+    seek_path = unit['seek_path']
+    write_path = unit['write_path']
+    inventory = unit['inventory']
+    overwrite = settings['overwrite']
+    incremental = settings['incremental']
+    use_hash = settings['use_hash']
+    items = []
+
+    eeg, fmri, behav = parse_data_type(seek_path, inventory)
+
+    if behav and not fmri:
+        raise ValueError('tobids is only configured to process behavioral data when fMRI data are present.')
+
+    if eeg:
+        eeg_files = [x.path for x in inventory.files(seek_path, extension='.eeg')]
+        eeg_runs = get_eeg_runs(eeg_files, write_path / Path('eeg'), settings['make_edf'],
+                                settings['use_mne_bids'], settings['edf_type'])
+        for eeg_run in sorted(eeg_runs, key=lambda x: x['main_out']):
+            main_out = eeg_run['main_out']
+            write = needs_write(main_out, eeg_run['sources'], overwrite, incremental,
+                                use_hash, remember=False)
+            items.append(_make_item('eeg', write, eeg_run['sources'], _eeg_dests(main_out)))
+
+    if fmri:
+        fmri_root = get_fmri_root(seek_path, inventory)
+        meta_info = {'subject': str(unit['subject_arg']),
+                     'session': str(unit['session_arg'])}
+        suffix = '.nii.gz' if settings['compression']['enabled'] else '.nii'
+        for fmri_scan in get_fmri_scans(fmri_root, write_path, meta_info, inventory):
+            for nii, sidecar, dest in zip(fmri_scan['niis'], fmri_scan['sidecars'],
+                                          fmri_scan['dests']):
+                write = needs_write(dest.with_suffix(suffix), [nii], overwrite,
+                                    incremental, use_hash, remember=False)
+                items.append(_make_item('fmri', write, [nii, sidecar],
+                                        [dest.with_suffix(suffix), dest.with_suffix('.json')]))
+
+    if behav:
+        for behav_run in get_behav_runs(unit['subject'], unit['session'], seek_path,
+                                        unit['dest_path'], eeg, inventory):
+            dests = []
+            write = False
+            for datatype in behav_run['datatypes']:
+                dest = behav_run['out_bids'].copy().update(datatype=datatype, extension='.tsv').fpath
+                dests += [dest, dest.with_suffix('.json')]
+                # Outside --incremental the EEG-synced events are cleared
+                # and written again on every run
+                write = write or (datatype == 'eeg' and not incremental)
+                write = write or needs_write(dest, behav_run['sources'], overwrite,
+                                             incremental, use_hash, remember=False)
+            items.append(_make_item('behav', write, behav_run['sources'], dests))
+
+    return items
+
+
+def _make_item(kind, write, sources, dests):
+    sources = [[str(x), os.path.getsize(x)] for x in sources]
+    return {'kind': kind,
+            'action': 'write' if write else 'skip',
+            'sources': sources,
+            'dests': [str(x) for x in dests],
+            'bytes': sum(x[1] for x in sources)}
+
+
+def _eeg_dests(main_out):
+    # The data file write_eeg keeps fingerprints against, the rest of the
+    # recording (BrainVision) and its sidecars
+    stem = str(main_out)[:-len('_eeg' + main_out.suffix)]
+    dests = [main_out]
+    if main_out.suffix == '.vhdr':
+        dests += [main_out.with_suffix('.vmrk'), main_out.with_suffix('.eeg')]
+    return dests + [Path(stem + '_eeg.json'), Path(stem + '_channels.tsv')]
+
+
+def _wall_time(plan_units, jobs):
+    # Units go to the first free worker, largest (by source size) first,
+    # ties in serial order (see helpers.parallel.run_parallel)
+    if jobs <= 1:
+        return sum(x['estimated_seconds'] for x in plan_units)
+    order = sorted(range(len(plan_units)), key=lambda i: (-plan_units[i]['size'], i))
+    workers = [0.0] * jobs
+    for i in order:
+        heapq.heappush(workers, heapq.heappop(workers) + plan_units[i]['estimated_seconds'])
+    return max(workers)
+
+
+def unit_to_dict(unit):
+    # A unit as JSON-able dict (plans, helpers/work_queue.py)
+    out = {key: str(value) if key in PATH_FIELDS else value
+           for key, value in unit.items() if key != 'inventory'}
+    out['inventory'] = unit['inventory'].to_dict()
+    return out
+
+
+def unit_from_dict(planned):
+    # Back from unit_to_dict (extra keys a plan adds are dropped)
+    unit = {key: Path(value) if key in PATH_FIELDS else value
+            for key, value in planned.items()
+            if key not in ['items', 'bytes', 'estimated_seconds']}
+    unit['inventory'] = Inventory.from_dict(planned['inventory'])
+    return unit
+
+
+def _relative(path, start):
+    try:
+        return Path(path).relative_to(start)
+    except ValueError:
+        return Path(path)
+
+
+def _format_bytes(n_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n_bytes < 1000:
+            return '{:.1f} {}'.format(n_bytes, unit)
+        n_bytes /= 1000
+    return '{:.1f} TB'.format(n_bytes)
+
+
+def _format_seconds(seconds):
+    if seconds < 60:
+        return '{:.1f} s'.format(seconds)
+    if seconds < 3600:
+        return '{:.1f} min'.format(seconds / 60)
+    return '{:.1f} h'.format(seconds / 3600)
@@ -0,0 +1,159 @@
+'''
+Progress measured in source bytes, with live throughput and an ETA
+
+A BOLD run is a hundred times the size of a T1w or an EEG recording, so
+the bar counts the source bytes of the work (EEG triplets, NIfTI images,
+behavioral files) instead of files. The total comes from the runs and
+images the writers will list, found in the units' inventories and sized
+from the inventory records (without scanning or statting the origin
+again).
+
+The writers report each run or image they finish as
+    progress_bar.update(n_bytes, kind, seconds)
+with kind 'eeg', 'fmri' or 'behav' and the seconds it took; outputs that
+were up to date pass no seconds, so they move the bar but not the rates.
+
+The bar shows the bytes per second measured so far for each kind and an
+ETA: each kind's remaining bytes at its rate, over the number of workers.
+Until a kind has been measured for a while, its rate leans on the
+throughput recorded by earlier runs into the same dataset (see
+helpers/throughput.py), so the first ETA is already a fair guess.
+'''
+
+import threading
+from pathlib import Path
+from tqdm import tqdm
+from helpers.basic_parsing import parse_data_type
+from helpers.throughput import load_throughput, KINDS
+from writers.eeg_tools import get_eeg_runs
+from writers.fmri_tools import get_fmri_scans, get_fmri_root
+from writers.behav_tools import get_behav_runs
+
+
+# Seconds of measurement the recorded throughput counts as in the live
+# rates (less when it's only the default)
+PRIOR_SECONDS = 30.0
+DEFAULT_PRIOR_SECONDS = 3.0
+
+BAR_FORMAT = '{desc}: {percentage:3.0f}%|{bar}| {n_fmt}B/{total_fmt}B [{elapsed}{postfix}]'
+
+
+class ByteProgress:
+    '''
+    A tqdm bar over source bytes, with per-kind rates and an ETA
+    totals: source bytes per kind; rates: recorded bytes per second per
+    kind (per worker) and measured: the number of runs behind each (see
+    load_throughput); workers: how many runs are converted at a time
+    Safe to update from several threads
+    '''
+
+    def __init__(self, totals, rates, measured, workers=1):
+        self.totals = totals
+        self.rates = rates
+        self.priors = {kind: PRIOR_SECONDS if measured[kind] else DEFAULT_PRIOR_SECONDS
+                       for kind in KINDS}
+        self.workers = max(workers, 1)
+        self.done = {kind: 0 for kind in KINDS}
+        self.work = {kind: [0, 0.0] for kind in KINDS}
+        self._lock = threading.Lock()
+        self.bar = tqdm(total=sum(totals.values()), desc='Processing', unit='B',
+                        unit_scale=True, bar_format=BAR_FORMAT)
+        self.bar.set_postfix_str(self.status(), refresh=True)
+
+    def update(self, n=1, kind=None, seconds=0.0):
+        '''
+        Takes as input the source bytes finished, their kind and the seconds
+        they took (0 for outputs skipped as up to date)
+        '''
+
+        with self._lock:
+            if kind is not None:
+                self.done[kind] += n
+                if seconds > 0:
+                    self.work[kind][0] += n
+                    self.work[kind][1] += seconds
+            self.bar.set_postfix_str(self.status(), refresh=False)
+            self.bar.update(n)
+
+    def rate(self, kind):
+        # Bytes per second per worker: what was measured this run, with the
+        # recorded rate counting as priors[kind] seconds of it
+        n_bytes, seconds = self.work[kind]
+        prior = self.priors[kind]
+        return (self.rates[kind] * prior + n_bytes) / (prior + seconds)
+
+    def eta(self):
+        # Seconds left for the remaining bytes of every kind
+        seconds = sum(max(self.totals[kind] - self.done[kind], 0) / self.rate(kind)
+                      for kind in KINDS)
+        return seconds / self.workers
+
+    def status(self):
+        # 'ETA 4:10, eeg 48.2 MB/s, fmri 61.0 MB/s' (kinds measured so far)
+        parts = ['ETA ' + tqdm.format_interval(self.eta())]
+        for kind in KINDS:
+            n_bytes, seconds = self.work[kind]
+            if seconds > 0:
+                parts.append('{} {:.1f} MB/s'.format(kind, n_bytes / seconds / 1e6))
+        return ', '.join(parts)
+
+    def close(self):
+        self.bar.close()
+
+
+def configure_progress_bar(units, settings, dataset_dir, workers=1):
+    '''
+    Takes as input the units to convert (from get_session_units), the
+    settings write_session runs with, the dataset dir (for the recorded
+    throughput) and the number of runs converted at a time
+    Returns a ByteProgress over the source bytes of the units
+    '''
+
+    totals = {kind: 0 for kind in KINDS}
+    for unit in units:
+        for kind, n_bytes in unit_bytes(unit, settings).items():
+            totals[kind] += n_bytes
+    rates, measured = load_throughput(dataset_dir)
+
+    return ByteProgress(totals, rates, measured, workers)
+
+
+def unit_bytes(unit, settings):
+    '''
+    Takes as input a unit from get_session_units and the settings
+    Returns the source bytes per kind the writers report for it: the
+    triplet of each EEG run, each NIfTI image and each behavioral file,
+    sized from the unit's inventory records
+    '''
+
+    seek_path = unit['seek_path']
+    inventory = unit['inventory']
+    out = {kind: 0 for kind in KINDS}
+
+    sizes = {x.path: x.size for x in inventory.files(seek_path)}
+
+    def size(path):
+        return sizes[Path(path)]
+
+    eeg, fmri, behav = parse_data_type(seek_path, inventory)
+
+    if eeg:
+        eeg_files = [x.path for x in inventory.files(seek_path, extension='.eeg')]
+        for eeg_run in get_eeg_runs(eeg_files, unit['write_path'] / Path('eeg'),
+                                    settings['make_edf'], settings['use_mne_bids'],
+                                    settings['edf_type']):
+            out['eeg'] += sum(size(x) for x in eeg_run['sources'])
+
+    if fmri:
+        meta_info = {'subject': str(unit['subject_arg']),
+                     'session': str(unit['session_arg'])}
+        for fmri_scan in get_fmri_scans(get_fmri_root(seek_path, inventory),
+                                        unit['write_path'], meta_info, inventory):
+            out['fmri'] += sum(size(x) for x in fmri_scan['niis'])
+
+    if behav and fmri:
+        for behav_run in get_behav_runs(unit['subject'], unit['session'], seek_path,
+                                        unit['dest_path'], eeg, inventory):
+            out['behav'] += size(behav_run['path'])
+
+    return out
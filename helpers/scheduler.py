@@ -0,0 +1,94 @@
+'''
+Running the tasks of a session in dependency order (tobids.py --run-jobs N)
+
+write_session splits a subject / session into one task per run and kind of
+data (see writers/session_tools.py). Each task names the tasks it has to
+wait for: an EEG-synced behavioral run waits for the EEG run it takes its
+clock from, and nothing else waits for anything. run_graph then runs the
+tasks on a thread pool, each as soon as what it waits for is done, so a
+session with many runs keeps several of them going at once.
+
+Threads (not processes) so tasks share the process's event cache (see
+helpers/event_cache.py); the slow parts (file I/O, zlib, numpy) release
+the GIL. mne-bids writes stay one at a time under the dataset lock (it
+updates participants.tsv and the scans file with every run), so with
+mne-bids only NIfTI images and behavioral runs actually run side by side.
+'''
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def make_task(name, work, after=None):
+    '''
+    Takes as input a unique name, the work (a function taking no
+    arguments) and the names of the tasks it waits for
+    Returns the task as a dict for run_graph
+    '''
+
+    return {'name': name, 'work': work, 'after': after or []}
+
+
+def run_graph(tasks, workers=1, done=None):
+    '''
+    Takes as input a list of tasks from make_task, the number of tasks to
+    run at a time and the names of tasks already done elsewhere (eg by
+    another queue item)
+    Runs each task once every task it waits for is done.
+    With one worker, tasks run in list order as far as that allows
+    Returns what each task's work returned, in task order
+    Raises ValueError if a task waits for a name that is neither among the
+    tasks nor in done, or if tasks wait on each other; otherwise the first
+    error, after the tasks already running finish (no new ones are started)
+    '''
+
+    names = {x['name'] for x in tasks}
+    external = set(done or [])
+    for task in tasks:
+        unknown = [y for y in task['after'] if y not in names and y not in external]
+        if unknown:
+            raise ValueError('Task {} waits for unknown tasks: {}'.format(
+                task['name'], ', '.join(unknown)))
+    done = set()
+    running = {}
+    results = {}
+
+    def ready():
+        return [x for x in tasks if x['name'] not in done and x['name'] not in running.values()
+                and all(y in done or y in external for y in x['after'])]
+
+    if workers <= 1:
+        while len(done) < len(tasks):
+            todo = ready()
+            if not todo:
+                raise ValueError('These tasks wait on each other: {}'.format(
+                    ', '.join(x['name'] for x in tasks if x['name'] not in done)))
+            results[todo[0]['name']] = todo[0]['work']()
+            done.add(todo[0]['name'])
+        return [results[x['name']] for x in tasks]
+
+    error = None
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='run-jobs') as pool:
+        while len(done) < len(tasks):
+            if error is None:
+                for task in ready()[:workers - len(running)]:
+                    running[pool.submit(task['work'])] = task['name']
+            if not running:
+                if error is not None:
+                    raise error
+                raise ValueError('These tasks wait on each other: {}'.format(
+                    ', '.join(x['name'] for x in tasks if x['name'] not in done)))
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as exc:
+                    if error is None:
+                        error = exc
+                # Failed tasks count as done so the loop ends; nothing new
+                # starts after an error
+                done.add(name)
+    if error is not None:
+        raise error
+
+    return [results[x['name']] for x in tasks]
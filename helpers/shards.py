@@ -0,0 +1,283 @@
+'''
+Splitting one conversion over independent jobs (tobids.py --shard i/N,
+then --merge-shards N)
+
+The first shard to start works out the subject / session units and saves
+them, with its settings and answers, as the split all N shards share
+(<dataset dir>/.tobids_shards/units-of-N.json, written once; the shards
+that come later take it as is, without scanning the origin or asking).
+So a source file that changes while the shards are queued can't move a
+unit from one shard to another. Units are handed out largest (by source
+bytes) first, each to the shard with the fewest bytes so far, so the split
+is balanced.
+
+Units write disjoint subject / session dirs. The few files that would be
+shared are kept per shard in <dataset dir>/.tobids_shards/<i>-of-<N>/
+instead: the conversion journals, what mne-bids keeps up to date at the
+BIDS root (participants.tsv, README, ...), the lock around mne-bids, the
+inventory cache and the run's stats (results.json, written last, marks the
+shard as finished, and lists the units it converted). So shards never
+write the same file.
+
+merge_shards checks that the shards converted every unit of the split
+exactly once, then folds those files into the dataset, and tobids runs
+the dataset-level steps (sidecar dedup, metadata, conversion logs, final
+validation) once over the whole tree.
+'''
+
+import os
+import json
+import shutil
+from pathlib import Path
+from helpers.metadata import merge_write_logs
+from helpers.plan import unit_to_dict, unit_from_dict
+
+
+SHARDS_DIR = '.tobids_shards'
+RESULTS_FILE = 'results.json'
+SPLIT_VERSION = 1
+
+# mne-bids' dataset-level files a shard may hold (participants.tsv is
+# merged row by row, the others are taken from the first shard that has
+# them if the dataset doesn't yet)
+DATASET_FILES = ['README', 'participants.json', 'dataset_description.json']
+
+
+def assign_shards(units, count):
+    '''
+    Takes as input the units from get_session_units and the shard count
+    Returns the shard (1 to count) of each unit, in unit order
+    Units go largest first to the shard with the fewest bytes so far (ties:
+    serial order, lowest shard), so the same units always split the same
+    way
+    '''
+
+    loads = [0] * count
+    shards = [None] * len(units)
+    for i in sorted(range(len(units)), key=lambda i: (-units[i]['size'], i)):
+        shard = loads.index(min(loads))
+        shards[i] = shard + 1
+        loads[shard] += units[i]['size']
+    return shards
+
+
+def select_shard(units, index, count):
+    # The units shard `index` of `count` converts (in serial order)
+    shards = assign_shards(units, count)
+    return [unit for unit, shard in zip(units, shards) if shard == index]
+
+
+def unit_key(unit):
+    # 'sub-001_ses-001' (or 'sub-001' without sessions)
+    key = 'sub-' + unit['subject']
+    if unit['session'] != '-999':
+        key += '_ses-' + unit['session']
+    return key
+
+
+def get_shard_dir(dataset_dir, index, count):
+    # Where shard `index` of `count` keeps its own files
+    return Path(dataset_dir) / Path(SHARDS_DIR) / Path('{}-of-{}'.format(index, count))
+
+
+def get_split_file(dataset_dir, count):
+    # The units and settings the shards of a split into `count` share
+    return Path(dataset_dir) / Path(SHARDS_DIR) / Path('units-of-{}.json'.format(count))
+
+
+def create_split(dataset_dir, count, units, settings):
+    '''
+    Takes as input the dataset dir, the shard count, the units from
+    get_session_units and the settings for write_session
+    Saves them as the split every shard takes its share from, unless
+    another shard got there first (then its split stands)
+    '''
+
+    filename = get_split_file(dataset_dir, count)
+    os.makedirs(filename.parent, exist_ok=True)
+    split = {'version': SPLIT_VERSION,
+             'settings': settings,
+             'units': [unit_to_dict(x) for x in units]}
+
+    temp = filename.with_name('.{}.{}.tmp'.format(filename.name, os.getpid()))
+    with open(temp, 'w') as file:
+        json.dump(split, file)
+    # A hard link can't replace an existing file: the first split wins
+    try:
+        os.link(temp, filename)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp)
+
+
+def load_split(dataset_dir, count):
+    '''
+    Takes as input the dataset dir and the shard count
+    Returns the split's (units, settings)
+    '''
+
+    filename = get_split_file(dataset_dir, count)
+    with open(filename, 'r') as file:
+        split = json.load(file)
+    if split.get('version') != SPLIT_VERSION:
+        raise ValueError('{} is from another version of tobids; remove it and run '
+                         'the shards again'.format(filename))
+    return [unit_from_dict(x) for x in split['units']], split['settings']
+
+
+def save_shard_results(shard_dir, results, compression, units, split):
+    '''
+    Takes as input the shard dir, the write_session stats of each unit the
+    shard converted, the NIfTI compression settings (for the report), the
+    keys (unit_key) of the units it converted and those of every unit in
+    the split
+    Saves them for merge_shards; the file marks the shard as finished
+    '''
+
+    os.makedirs(shard_dir, exist_ok=True)
+    filename = Path(shard_dir) / Path(RESULTS_FILE)
+    temp = filename.with_name('.{}.{}.tmp'.format(filename.name, os.getpid()))
+    with open(temp, 'w') as file:
+        json.dump({'compression': compression,
+                   'units': units,
+                   'split': split,
+                   'results': results_to_json(results)}, file)
+    os.replace(temp, filename)
+
+
+def merge_shards(dest_path, count):
+    '''
+    Takes as input the rawdata dir and the shard count
+    Folds the files of shards 1 to count into the dataset (conversion
+    journals, participants.tsv rows, mne-bids' README etc.) and removes the
+    shard dirs
+    Returns the write_session stats of all their units (as a serial run
+    would have them) and the compression settings they ran with
+    Raises an error (changing nothing) if a shard hasn't finished, or if
+    the shards didn't convert every unit of one split exactly once
+    '''
+
+    dest_path = Path(dest_path)
+    dataset_dir = dest_path.parent
+    shard_dirs = [get_shard_dir(dataset_dir, i, count) for i in range(1, count + 1)]
+
+    missing = [str(i) for i, x in enumerate(shard_dirs, start=1)
+               if not os.path.exists(x / Path(RESULTS_FILE))]
+    if missing:
+        raise ValueError('Shards {} (of {}) haven\'t finished (no {} in {}); '
+                         'run them before --merge-shards'.format(
+                             ', '.join(missing), count, RESULTS_FILE,
+                             dataset_dir / Path(SHARDS_DIR)))
+
+    saved = []
+    for shard_dir in shard_dirs:
+        with open(shard_dir / Path(RESULTS_FILE), 'r') as file:
+            saved.append(json.load(file))
+    _check_split(saved, count)
+
+    results = []
+    for shard in saved:
+        compression = shard['compression']
+        results += results_from_json(shard['results'])
+
+    fold_shard_dirs(dest_path, shard_dirs)
+    if os.path.exists(get_split_file(dataset_dir, count)):
+        os.remove(get_split_file(dataset_dir, count))
+    # Left over shards of some other split stay
+    if not os.listdir(dataset_dir / Path(SHARDS_DIR)):
+        os.rmdir(dataset_dir / Path(SHARDS_DIR))
+
+    return results, compression
+
+
+def fold_shard_dirs(dest_path, shard_dirs):
+    '''
+    Takes as input the rawdata dir and the dirs of finished shards (or
+    queue workers, see helpers/work_queue.py)
+    Folds their conversion journals, participants.tsv rows and mne-bids'
+    README etc. into the dataset, then removes them
+    '''
+
+    dest_path = Path(dest_path)
+    for shard_dir in shard_dirs:
+        merge_write_logs(shard_dir, dest_path.parent)
+        for name in DATASET_FILES:
+            if os.path.exists(shard_dir / Path(name)) and not os.path.exists(dest_path / Path(name)):
+                shutil.copyfile(shard_dir / Path(name), dest_path / Path(name))
+
+    _merge_participants([Path(x) / Path('participants.tsv') for x in shard_dirs],
+                        dest_path / Path('participants.tsv'))
+
+    for shard_dir in shard_dirs:
+        shutil.rmtree(shard_dir)
+
+
+def results_to_json(results):
+    # write_session stats as JSON-able lists (placements hold paths)
+    return [dict(result, placements=[[str(source), str(dest), method]
+                                     for source, dest, method in result['placements']])
+            for result in results]
+
+
+def results_from_json(saved):
+    # Back from results_to_json
+    return [dict(result, placements=[(Path(source), Path(dest), method)
+                                     for source, dest, method in result['placements']])
+            for result in saved]
+
+
+def _check_split(saved, count):
+    # The shards' results (in shard order) have to come from the same
+    # split, and between them hold each of its units exactly once
+    split = saved[0]['split']
+    if any(x['split'] != split for x in saved):
+        raise ValueError('The {} shards split different lists of subject / sessions; '
+                         'remove {} and run them again'.format(count, SHARDS_DIR))
+
+    seen = {}
+    for index, shard in enumerate(saved, start=1):
+        for key in shard['units']:
+            if key in seen:
+                raise ValueError('{} was converted by shards {} and {} (of {})'.format(
+                    key, seen[key], index, count))
+            seen[key] = index
+    problems = []
+    missing = [x for x in split if x not in seen]
+    if missing:
+        problems.append('not converted: ' + ', '.join(missing))
+    extra = [x for x in seen if x not in split]
+    if extra:
+        problems.append('not in the split: ' + ', '.join(extra))
+    if problems:
+        raise ValueError('The {} shards didn\'t convert the units of their split ({})'.format(
+            count, '; '.join(problems)))
+
+
+def _merge_participants(filenames, dest):
+    # Rows of every shard's participants.tsv added to dest (a subject
+    # written again replaces its old row), in subject order like
+    # helpers.parallel.sort_participants
+    # Columns only some files have (mne-bids adds them as it finds the
+    # info) are 'n/a' for the other rows
+    columns = []
+    rows = {}
+    for filename in [dest] + filenames:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, 'r') as file:
+            header, *lines = file.read().splitlines()
+        header = header.split('\t')
+        columns += [x for x in header if x not in columns]
+        for line in lines:
+            row = dict(zip(header, line.split('\t')))
+            rows[row[header[0]]] = row
+    if not columns:
+        return
+
+    lines = ['\t'.join(columns)]
+    lines += ['\t'.join(rows[x].get(column, 'n/a') for column in columns) for x in sorted(rows)]
+    temp = dest.with_name('.{}.{}.tmp'.format(dest.name, os.getpid()))
+    with open(temp, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temp, dest)
@@ -0,0 +1,244 @@
+'''
+Sidecar deduplication through the BIDS inheritance principle
+(tobids.py --dedup-sidecars)
+
+Runs recorded the same way get byte-identical sidecars (eg, every GradCPT
+run's _events.json, _eeg.json, _channels.tsv, _bold.json). A sidecar
+higher up the tree applies to every file below it whose name has all of
+its entities, so identical copies can be replaced by one file:
+    sub-001/ses-001/func/sub-001_ses-001_task-GradCPT_run-001_bold.json
+    sub-002/ses-001/func/sub-002_ses-001_task-GradCPT_run-001_bold.json
+    ...
+become
+    task-GradCPT_bold.json
+Each group goes as high as it can: the dataset root, else a subject,
+session or datatype dir, using only names the BIDS validator accepts. A
+file is only placed where EVERY file it would apply to had exactly that
+content, so what each recording's metadata resolves to never changes.
+
+The pass works on the whole tree each time, so re-runs (eg, --incremental
+adding new runs) fold per-run sidecars into, or back out of, the inherited
+files from earlier passes. Files are only ever replaced (written to a temp
+file and renamed) or removed, never written in place, in case a sidecar is
+a hardlink to a source file (see helpers/placement.py).
+'''
+
+import os
+from pathlib import Path
+from bids_validator import BIDSValidator
+
+
+# Entities that vary between the copies being merged
+PER_RUN = ['sub', 'ses', 'run']
+
+# Non-JSON sidecars that can be inherited, and the datatypes whose
+# recordings they describe
+TSV_SIDECARS = {'channels': ['eeg', 'ieeg', 'meg']}
+
+
+def dedup_sidecars(rawdata):
+    '''
+    Takes as input the rawdata dir
+    Replaces groups of identical sidecars with one inherited sidecar each
+    Returns a dict with the number of sidecar files 'before' and 'after'
+    '''
+
+    rawdata = Path(rawdata)
+    validator = BIDSValidator()
+    files = _scan(rawdata)
+
+    before = after = 0
+    for suffix, extension in sorted(_families(files)):
+        owners = _get_owners(files, suffix, extension)
+        if not owners:
+            continue
+        current = _read_family(rawdata, files, owners, suffix, extension)
+        contents = _effective_contents(owners, current, suffix, extension)
+
+        # Place inherited files, fewest entities (widest reach) first
+        placed = {}
+        covered = set()
+        keys = sorted(set(_key(ents) for _, ents in owners), key=lambda x: (len(x), x))
+        for key in keys:
+            affected = [x for x in owners if set(key) <= set(x[1])]
+            _place(Path('.'), key, affected, contents, suffix, extension,
+                   validator, placed, covered)
+
+        # Owners not covered by an inherited file keep (or get back) their
+        # own sidecar
+        desired = dict(placed)
+        for owner in owners:
+            if owner not in covered and contents[owner] is not None:
+                desired[_own_path(owner, suffix, extension)] = contents[owner]
+
+        for path, content in sorted(desired.items()):
+            if current.get(path) != content:
+                _replace(rawdata / path, content)
+        for path in sorted(current):
+            if path not in desired:
+                os.remove(rawdata / path)
+
+        before += len(current)
+        after += len(desired)
+
+    return {'before': before, 'after': after}
+
+
+def sidecar_report(counts):
+    # One-line summary of a dedup_sidecars pass
+    return 'Sidecars: {} files -> {} after deduplication'.format(counts['before'], counts['after'])
+
+
+def _scan(rawdata):
+    # (dir relative to rawdata, entities, suffix, extension) of every BIDS
+    # named file, skipping tobids bookkeeping (dot files and dirs)
+    files = []
+    for root, dirs, names in os.walk(rawdata):
+        dirs[:] = sorted(x for x in dirs if not x.startswith('.'))
+        rel = Path(root).relative_to(rawdata)
+        for name in sorted(names):
+            if name.startswith('.'):
+                continue
+            parsed = _parse_name(name)
+            if parsed is not None:
+                files.append((rel,) + parsed)
+    return files
+
+
+def _parse_name(name):
+    # 'sub-01_task-x_bold.nii.gz' -> ((('sub', '01'), ('task', 'x')), 'bold', '.nii.gz')
+    if '.' not in name:
+        return None
+    base, extension = name.split('.', 1)
+    parts = base.split('_')
+    ents = []
+    for part in parts[:-1]:
+        if '-' not in part:
+            return None
+        ents.append(tuple(part.split('-', 1)))
+    return tuple(ents), parts[-1], '.' + extension
+
+
+def _make_name(ents, suffix, extension):
+    return '_'.join(['-'.join(x) for x in ents] + [suffix]) + extension
+
+
+def _families(files):
+    # (suffix, extension) of the kinds of sidecar found
+    found = set()
+    for _, _, suffix, extension in files:
+        if extension == '.json' or (extension == '.tsv' and suffix in TSV_SIDECARS):
+            found.add((suffix, extension))
+    return found
+
+
+def _get_owners(files, suffix, extension):
+    # The recordings a sidecar kind describes, as (dir, entities): files
+    # with the same suffix (for JSON) or the recordings of the listed
+    # datatypes (for TSV sidecars)
+    owners = set()
+    for rel, ents, file_suffix, file_extension in files:
+        if 'sub' not in dict(ents):
+            continue
+        if extension == '.json':
+            match = file_suffix == suffix and file_extension != '.json'
+        else:
+            match = (file_suffix == rel.name and rel.name in TSV_SIDECARS[suffix]
+                     and file_extension not in ['.json', '.tsv'])
+        if match:
+            owners.add((rel, ents))
+    return sorted(owners)
+
+
+def _read_family(rawdata, files, owners, suffix, extension):
+    # path -> content of the existing sidecars of this kind that belong to
+    # (or are inherited by) an owner; anything else is left alone
+    own = set(_own_path(x, suffix, extension) for x in owners)
+    current = {}
+    for rel, ents, file_suffix, file_extension in files:
+        if file_suffix != suffix or file_extension != extension:
+            continue
+        path = rel / _make_name(ents, suffix, extension)
+        if path in own or any(_applies(path, x) for x in owners):
+            with open(rawdata / path, 'rb') as file:
+                current[path] = file.read()
+    return current
+
+
+def _effective_contents(owners, current, suffix, extension):
+    # What each owner's sidecar resolves to now: its own sidecar, else the
+    # most specific inherited one (deepest dir, then most entities)
+    contents = {}
+    for owner in owners:
+        own = _own_path(owner, suffix, extension)
+        if own in current:
+            contents[owner] = current[own]
+            continue
+        best = None
+        for path in current:
+            if _applies(path, owner):
+                rank = (len(path.parent.parts), len(_parse_name(path.name)[0]))
+                if best is None or rank > best[0]:
+                    best = (rank, current[path])
+        contents[owner] = best[1] if best else None
+    return contents
+
+
+def _applies(path, owner):
+    # Whether the sidecar at path is inherited by owner
+    rel, ents = owner
+    parent = path.parent
+    if parent != Path('.') and parent not in [rel] + list(rel.parents):
+        return False
+    return set(_parse_name(path.name)[0]) <= set(ents)
+
+
+def _place(scope, key, affected, contents, suffix, extension, validator,
+           placed, covered):
+    # Puts one sidecar for `key` at scope if every owner it would apply to
+    # (affected: the owners below scope with the key's entities) has the
+    # same content; otherwise tries each subdir
+    if len(affected) < 2 or all(x in covered for x in affected):
+        return
+
+    values = set(contents[x] for x in affected)
+    if len(values) == 1 and None not in values:
+        # Name: the key's entities plus those of the dirs above (sub, ses)
+        dir_ents = [tuple(x.split('-', 1)) for x in scope.parts if '-' in x]
+        ents = [x for x in affected[0][1] if x in key or x in dir_ents]
+        path = scope / _make_name(ents, suffix, extension)
+        if validator.is_bids('/' + path.as_posix()):
+            placed[path] = values.pop()
+            covered.update(affected)
+            return
+
+    children = {}
+    for owner in affected:
+        if owner[0] != scope:
+            children.setdefault(_child(owner[0], scope), []).append(owner)
+    for child in sorted(children):
+        _place(child, key, children[child], contents, suffix, extension,
+               validator, placed, covered)
+
+
+def _child(rel, scope):
+    # The dir one level below scope on the way to rel
+    depth = 0 if scope == Path('.') else len(scope.parts)
+    return Path(*rel.parts[:depth + 1])
+
+
+def _key(ents):
+    # Entities shared by the copies being merged
+    return tuple(x for x in ents if x[0] not in PER_RUN)
+
+
+def _own_path(owner, suffix, extension):
+    rel, ents = owner
+    return rel / _make_name(ents, suffix, extension)
+
+
+def _replace(filename, content):
+    temp = filename.with_name('.{}.{}.tmp'.format(filename.name, os.getpid()))
+    with open(temp, 'wb') as file:
+        file.write(content)
+    os.replace(temp, filename)
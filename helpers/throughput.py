@@ -0,0 +1,98 @@
+'''
+Measured conversion speed, kept across runs for time estimates
+
+Each writer adds the source bytes and seconds of the work it actually did
+(skipped outputs don't count) to a timing dict per kind of data ('eeg',
+'fmri', 'behav'). At the end of a run the totals are appended to
+<dataset dir>/.tobids_throughput.json, and estimates (eg, tobids.py --plan)
+use the bytes per second over the last HISTORY_LENGTH runs.
+'''
+
+import os
+import json
+from pathlib import Path
+
+
+THROUGHPUT_FILE = '.tobids_throughput.json'
+
+# Runs of history used for the estimates
+HISTORY_LENGTH = 10
+
+# Bytes per second (per worker) to assume before anything was measured
+DEFAULT_THROUGHPUT = {'eeg': 50e6, 'fmri': 40e6, 'behav': 1e6}
+
+KINDS = ['eeg', 'fmri', 'behav']
+
+
+def new_timing():
+    # Running totals for one kind of data
+    return {'items': 0, 'bytes': 0, 'seconds': 0.0}
+
+
+def new_timings():
+    return {kind: new_timing() for kind in KINDS}
+
+
+def add_timing(timing, n_bytes, seconds, items=1):
+    # Adds one piece of work to a timing dict (in place)
+    timing['items'] += items
+    timing['bytes'] += n_bytes
+    timing['seconds'] += seconds
+
+
+def add_timings(total, timings):
+    # Adds the per-kind timings onto total (in place) and returns total
+    for kind, timing in timings.items():
+        add_timing(total[kind], timing['bytes'], timing['seconds'], timing['items'])
+    return total
+
+
+def save_throughput(dataset_dir, timings):
+    '''
+    Takes as input the dataset dir and this run's summed timings (see
+    new_timings)
+    Appends the kinds that did any work to the history file, keeping the
+    last HISTORY_LENGTH entries of each
+    '''
+
+    history = _read_history(dataset_dir)
+    for kind, timing in timings.items():
+        if timing['items'] and timing['seconds'] > 0:
+            runs = history.setdefault(kind, [])
+            runs.append([timing['bytes'], timing['seconds']])
+            history[kind] = runs[-HISTORY_LENGTH:]
+
+    filename = Path(dataset_dir) / Path(THROUGHPUT_FILE)
+    os.makedirs(filename.parent, exist_ok=True)
+    temp = filename.with_name('{}.{}.tmp'.format(filename.name, os.getpid()))
+    with open(temp, 'w') as file:
+        json.dump(history, file)
+    os.replace(temp, filename)
+
+
+def load_throughput(dataset_dir):
+    '''
+    Takes as input the dataset dir
+    Returns ({kind: bytes per second}, {kind: number of runs measured});
+    kinds with no history get DEFAULT_THROUGHPUT (and 0 runs)
+    '''
+
+    history = _read_history(dataset_dir)
+    rates = dict(DEFAULT_THROUGHPUT)
+    measured = {kind: 0 for kind in KINDS}
+    for kind, runs in history.items():
+        n_bytes = sum(x[0] for x in runs)
+        seconds = sum(x[1] for x in runs)
+        if kind in rates and n_bytes and seconds:
+            rates[kind] = n_bytes / seconds
+            measured[kind] = len(runs)
+    return rates, measured
+
+
+def _read_history(dataset_dir):
+    filename = Path(dataset_dir) / Path(THROUGHPUT_FILE)
+    try:
+        with open(filename, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
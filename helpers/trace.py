@@ -0,0 +1,222 @@
+'''
+Where a conversion's time goes (tobids.py --trace FILE)
+
+Records nested spans: the whole run and its dataset-level steps (scanning
+the origin, validation, metadata, ...), and for each unit
+subject -> session -> modality -> run -> stage, eg reading a recording,
+mne-bids writing it, or the read / compress / write of a NIfTI image.
+Spans carry the bytes they worked on as args.
+
+The trace is saved as Chrome trace-event JSON ('X' complete events, in
+microseconds), which Perfetto (https://ui.perfetto.dev) and
+chrome://tracing open. Each process and thread gets its own track, so the
+--jobs workers, the --run-jobs threads and the NIfTI pipeline's read and
+write threads show side by side.
+
+Nothing is recorded unless start_trace was called: span() then returns a
+shared do-nothing span and traced() returns the work unchanged, so leaving
+the spans in costs a function call each.
+
+Worker processes call join_trace when they get work and flush_trace when
+it's done, appending their events to <pid>.jsonl in the parts dir of the
+run they work for (<FILE>.parts/<host>-<pid of the main process>). The
+main process folds its own parts in when it saves the trace at exit, so
+several tobids sharing one --trace FILE don't take each other's.
+'''
+
+import os
+import json
+import time
+import atexit
+import shutil
+import socket
+import threading
+from pathlib import Path
+
+
+# The trace of this process (None: not tracing)
+_trace = None
+
+
+def start_trace(filename):
+    '''
+    Takes as input the file to save the trace to
+    Starts recording in this (the main) process; the trace is saved when
+    the process exits, however it exits (see save_trace)
+    Returns the dir the worker processes of this run put their parts in
+    (for join_trace)
+    '''
+
+    global _trace
+    parts = _parts_dir(filename) / Path('{}-{}'.format(socket.gethostname(), os.getpid()))
+    _trace = _new_trace(parts, 'tobids', part=False, filename=filename)
+    atexit.register(save_trace)
+    return str(parts)
+
+
+def join_trace(parts):
+    # In a worker process: record into this process's part of the trace,
+    # in the parts dir start_trace returned (None: not tracing). A forked
+    # worker starts its own, not with its parent's events
+    global _trace
+    if parts is None:
+        return
+    if _trace is None or _trace['pid'] != os.getpid():
+        _trace = _new_trace(parts, 'tobids worker', part=True)
+
+
+def tracing():
+    # True if spans are being recorded in this process
+    return _trace is not None
+
+
+def span(name, cat='stage', **args):
+    '''
+    Takes as input the span's name, its category ('subject', 'session',
+    'modality', 'run', 'stage', ...) and any args to show with it (eg,
+    bytes=...)
+    Returns a context manager timing the block as one span; its
+    set(**args) adds args once they're known
+    '''
+
+    if _trace is None:
+        return _NO_SPAN
+    return _Span(name, cat, args)
+
+
+def traced(work, name, cat='stage', **args):
+    # work (a function taking no arguments) wrapped in a span, or work
+    # itself when not tracing
+    if _trace is None:
+        return work
+
+    def run():
+        with span(name, cat, **args):
+            return work()
+    return run
+
+
+def flush_trace():
+    # In a worker process: append the events so far to its part file
+    trace = _trace
+    if trace is None or not trace['part'] or trace['pid'] != os.getpid():
+        return
+    events, trace['events'] = trace['events'], []
+    parts = trace['parts']
+    os.makedirs(parts, exist_ok=True)
+    with open(parts / Path('{}.jsonl'.format(trace['pid'])), 'a') as file:
+        for event in events:
+            file.write(json.dumps(event) + '\n')
+
+
+def save_trace():
+    '''
+    In the main process: adds the span of the whole run, folds in the
+    parts its worker processes flushed and writes the trace file
+    (registered to run at exit by start_trace)
+    '''
+
+    global _trace
+    trace = _trace
+    if trace is None or trace['part'] or trace['pid'] != os.getpid():
+        return
+    _add('tobids', 'run', trace['started'], _now() - trace['started'], {})
+    _trace = None
+
+    events = trace['events']
+    parts = trace['parts']
+    if os.path.isdir(parts):
+        for name in sorted(os.listdir(parts)):
+            with open(parts / Path(name), 'r') as file:
+                events += [json.loads(line) for line in file if line.strip()]
+        shutil.rmtree(parts)
+    # Other runs may still be using the shared dir
+    try:
+        os.rmdir(parts.parent)
+    except OSError:
+        pass
+
+    filename = trace['file']
+    temp = filename.with_name('.{}.{}.tmp'.format(filename.name, os.getpid()))
+    with open(temp, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+    os.replace(temp, filename)
+    print('Trace saved to {} (open it in https://ui.perfetto.dev)'.format(filename))
+
+
+class _Span:
+    # One span being timed (see span)
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc_info):
+        _add(self.name, self.cat, self.start, _now() - self.start, self.args)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class _NoSpan:
+    # What span returns when not tracing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def _new_trace(parts, process, part, filename=None):
+    # filename: where the main process saves the trace (None in workers)
+    pid = os.getpid()
+    trace = {'file': Path(filename) if filename is not None else None,
+             'parts': Path(parts),
+             'pid': pid,
+             'part': part,
+             'started': _now(),
+             'threads': set(),
+             'events': [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                         'args': {'name': '{} ({})'.format(process, pid)}}]}
+    return trace
+
+
+def _add(name, cat, start, duration, args):
+    # Record a complete span on the calling thread's track
+    trace = _trace
+    if trace is None:
+        return
+    tid = threading.get_native_id()
+    if tid not in trace['threads']:
+        trace['threads'].add(tid)
+        trace['events'].append({'name': 'thread_name', 'ph': 'M', 'pid': trace['pid'],
+                                'tid': tid, 'args': {'name': threading.current_thread().name}})
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': start, 'dur': duration,
+             'pid': trace['pid'], 'tid': tid}
+    if args:
+        event['args'] = {key: value if isinstance(value, (int, float)) else str(value)
+                         for key, value in args.items()}
+    trace['events'].append(event)
+
+
+def _parts_dir(filename):
+    return Path(str(filename) + '.parts')
+
+
+def _now():
+    # Microseconds on the wall clock (comparable between processes)
+    return time.time_ns() // 1000
@@ -1,12 +1,25 @@
 # Dave Braun (2023)
 
+import bids_validator
 from bids_validator import BIDSValidator
-from glob import glob
 import os
 import re
 import sys
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from writers.fmri_tools import get_fmri_root
+from helpers.inventory import Inventory
+from helpers.basic_parsing import ask_yes_no
+
+# Per-file verdicts of the last final_validation (in rawdata)
+VALIDATION_CACHE = '.tobids_validation.json'
+# Machine readable verdicts (next to rawdata)
+VALIDATION_REPORT = 'validation_report.json'
+# Fewer files than this are checked in-process; a pool costs more than it
+# saves
+VALIDATION_POOL_MIN = 500
 
 class ValidateBasics:
     '''
@@ -15,28 +28,37 @@ class ValidateBasics:
     other basics.
     '''
 
-    def __init__(self, origin_dir):
+    def __init__(self, origin_dir, inventory=None):
         # Initialize the class
         self.origin_dir = origin_dir
+        if inventory is None:
+            inventory = Inventory(origin_dir)
+        self.inventory = inventory
 
-    def confirm_subject_count(self):
+    def confirm_subject_count(self, options=None):
         '''
-        Takes as input origin directory
+        Takes as input origin directory (and the options from
+        parse_command_line)
         Counts number of subjects (assumed to be number of subdirectories)
-        Confirms with user
+        Checks it against --expect-subjects if given, else confirms with
+        user
         Returns sample size
         '''
         # Import all first-level dirs
-        dirs = [d for d in os.listdir(self.origin_dir) if os.path.isdir(self.origin_dir/ Path(d))]
+        dirs = self.inventory.subdirs(self.origin_dir)
 
         # Only keep dir if there's a number in it
         dirs = [d for d in dirs if any(char.isdigit() for char in d)]
         N = len(dirs)
-        response = ''
+        expected = (options or {}).get('expect_subjects')
 
-        while response not in ['y', 'n']:
-            response = input("\nI'm counting {} subjects in this directory; does that seem right? [y/n] ".format(N)).lower()
-        if response == 'n':
+        if expected is not None:
+            right = N == expected
+            if not right:
+                print("\nI'm counting {} subjects in this directory, but {} were expected (--expect-subjects).".format(N, expected))
+        else:
+            right = ask_yes_no("\nI'm counting {} subjects in this directory; does that seem right? [y/n] ".format(N), options)
+        if not right:
             print('\nPlease inspect your source directory and try running the script again')
             sys.exit(1)
             
@@ -52,59 +74,54 @@ class ValidateBasics:
         drop the subject)
         '''
         # Import all first-level dirs
-        dirs = [d for d in os.listdir(self.origin_dir) if os.path.isdir(self.origin_dir/ Path(d))]
+        dirs = self.inventory.subdirs(self.origin_dir)
 
         # Only keep dir if there's a number in it
         subject_dirs = [d for d in dirs if any(char.isdigit() for char in d)]
 
         for subject_dir in subject_dirs:
             subject = subject_dir.split('/')[-1]
-            path = str(self.origin_dir / Path(subject_dir))
-            eeg = glob(path + '/**/*.eeg', recursive=True)
-            vhdr = glob(path + '/**/*.vhdr', recursive=True)
-            vmrk = glob(path + '/**/*.vmrk', recursive=True)
-            nii = glob(path + '/**/*.nii', recursive=True)
-            if not eeg and not vhdr and not vmrk and not nii:
+            # .eeg, .vhdr, .vmrk and .nii
+            brain_data = [x for x in self.inventory.subject_files(subject_dir)
+                          if x.modality in ['eeg', 'fmri']]
+            if not brain_data:
                 raise ValueError('Subject {} has no eeg or fMRI data. Check source.'.format(subject))
 
         self.subject_data_present = 'Yes'
 
 
 
-def final_validation(dest_dir):
+def final_validation(dest_dir, jobs=1):
     '''
     This function returns a score of the percentage of files in the final
     directory that are BIDS compatible.
-    '''
-    file_paths = []
 
-    for root, dirs, files in os.walk(dest_dir):
-        if files:
-            root_chop = 1
-            # Take out 'rawdata' dir if its there
-            if 'rawdata' in root:
-                root_chop = 2
-            root = '/'.join(root.split('/')[root_chop:])
-            for file in files:
-                file_paths.append('/' + os.path.join(root, file))
+    Verdicts are cached per relative path (rawdata/.tobids_validation.json),
+    so only paths that are new since the last run are checked again, on a
+    pool of `jobs` processes when there are enough of them. The validator
+    only looks at the path, never the contents, so a rewritten file keeps
+    its verdict. Every file's verdict is also written to
+    validation_report.json next to rawdata.
+    '''
+    dest_dir = Path(dest_dir)
+    paths = _list_output_files(dest_dir)
 
-    validator = BIDSValidator()
+    cache = _load_validation_cache(dest_dir)
+    # Validator apparently can't handle behavioral data
+    paths_to_score = [x for x in paths if 'beh' not in x]
+    todo = [x for x in paths_to_score if x not in cache]
+    checked = _check_paths(todo, jobs)
 
-    result = 0
-    bad_files = []
+    verdicts = {x: checked[x] if x in checked else cache[x] for x in paths_to_score}
+    _save_validation_cache(dest_dir, verdicts)
 
-    for path in file_paths:
-        # Validator apparently can't handle behavioral data
-        if 'beh' in path:
-            continue
-        if validator.is_bids(path):
-            result += 1
-        else:
-            bad_files.append(path)
+    result = sum(verdicts.values())
+    bad_files = sorted(x for x in verdicts if not verdicts[x])
+    score = round((result / len(verdicts))*100, 2)
+    _write_validation_report(dest_dir.parent, paths, verdicts, score)
 
-    file_paths = [x for x in file_paths if 'beh' not in x]
-    score = round((result / len(file_paths))*100, 2)
     print("\nFinal validation of output directory.\n{}% of files in the output directory are BIDs compatible.".format(score))
+    print('({} of {} files checked, the rest unchanged since the last run)'.format(len(todo), len(verdicts)))
     if bad_files:
         print('\n\n')
         print('Here are the incompatible files:')
@@ -112,24 +129,27 @@ def final_validation(dest_dir):
             print(file)
 
 
-def validate_task_names(subjects, origin_path):
+def validate_task_names(subjects, origin_path, inventory=None, options=None):
     # Subjects comes in as list of dicts
+    # Checks the task names against --expect-tasks if given (options from
+    # parse_command_line), else confirms with user
+
+    if inventory is None:
+        inventory = Inventory(origin_path)
 
     #  -- Try to first infer tasks from eeg data -- #
 
     tasks = []
-    tasks = glob('{}/**/*.eeg'.format(origin_path), recursive=True)
-    #for subject in subject_numbers:
-        #tasks += glob('**/{}/**/*.eeg'.format(subject), recursive=True)
-    tasks = [Path(x).parent.name for x in tasks]
+    tasks = inventory.files(extension='.eeg')
+    tasks = [x.path.parent.name for x in tasks]
 
     # -- If no eeg data, infer tasks from fmri data -- #
     if not tasks:
         subject_paths = [os.path.join(origin_path, x['path']) for x in subjects]
         for subject_path in subject_paths:
-            fmri_root = get_fmri_root(subject_path)
+            fmri_root = get_fmri_root(subject_path, inventory)
             # A whole thing to extract task names from BOLD dirs
-            bold_dirs = [x for x in os.listdir(fmri_root) if 'BOLD' in x] 
+            bold_dirs = [x for x in inventory.subdirs(fmri_root) if 'BOLD' in x] 
             tasks = []
             for bold_dir in bold_dirs:
                 arg_list = bold_dir.split('_')
@@ -139,10 +159,90 @@ def validate_task_names(subjects, origin_path):
             raise ValueError('Unable to infer task names.')
 
 
-    response = ''
-    while response != 'y':
-        response = input('\n\nAre these the task names: {}? (y/n) '.format(str(set(tasks))))
-        response = response.strip().lower()
-        if response == 'n':
-            raise ValueError('\n\nCheck directory structure. Directories one level above *.eeg data need to be named according to the corresponding task. Aborting.')
+    expected = (options or {}).get('expect_tasks')
+    if expected is not None:
+        right = set(tasks) == set(expected)
+        if not right:
+            print('\n\nFound task names {}, but expected {} (--expect-tasks).'.format(sorted(set(tasks)), sorted(set(expected))))
+    else:
+        right = ask_yes_no('\n\nAre these the task names: {}? (y/n) '.format(str(set(tasks))), options)
+    if not right:
+        raise ValueError('\n\nCheck directory structure. Directories one level above *.eeg data need to be named according to the corresponding task. Aborting.')
 	
+
+
+# --------- FINAL VALIDATION INTERNALS -----------
+
+def _list_output_files(dest_dir):
+    # '/'-rooted paths relative to rawdata of the output files, skipping
+    # tobids bookkeeping (eg, .tobids_lock)
+    paths = []
+    for root, dirs, files in os.walk(dest_dir):
+        dirs[:] = [x for x in dirs if not x.startswith('.')]
+        rel = os.path.relpath(root, dest_dir)
+        for file in files:
+            if file.startswith('.'):
+                continue
+            paths.append('/' + os.path.normpath(os.path.join(rel, file)))
+    return sorted(paths)
+
+
+def _check_paths(paths, jobs):
+    # path -> is_bids verdict, split over a process pool when there are
+    # enough paths to be worth it
+    if jobs < 2 or len(paths) < VALIDATION_POOL_MIN:
+        return dict(zip(paths, _validate_chunk(paths)))
+
+    size = -(-len(paths) // (jobs * 4))
+    chunks = [paths[i:i + size] for i in range(0, len(paths), size)]
+    verdicts = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for chunk, result in zip(chunks, pool.map(_validate_chunk, chunks)):
+            verdicts.update(zip(chunk, result))
+    return verdicts
+
+
+def _validate_chunk(paths):
+    validator = BIDSValidator()
+    return [bool(validator.is_bids(x)) for x in paths]
+
+
+def _load_validation_cache(dest_dir):
+    # Cached path -> verdict; empty if missing, unreadable or from another
+    # validator version
+    filename = Path(dest_dir) / Path(VALIDATION_CACHE)
+    try:
+        with open(filename, 'r') as file:
+            saved = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if saved.get('validator') != bids_validator.__version__:
+        return {}
+    return saved.get('verdicts', {})
+
+
+def _save_validation_cache(dest_dir, verdicts):
+    filename = Path(dest_dir) / Path(VALIDATION_CACHE)
+    temp = filename.with_name('{}.{}.tmp'.format(filename.name, os.getpid()))
+    with open(temp, 'w') as file:
+        json.dump({'validator': bids_validator.__version__, 'verdicts': verdicts}, file)
+    os.replace(temp, filename)
+
+
+def _write_validation_report(dataset_dir, paths, verdicts, score):
+    # Per-file verdicts ('valid', 'invalid', or 'skipped' for behavioral
+    # files) plus the summary, for scripts to pick up
+    files = {}
+    for path in paths:
+        if path not in verdicts:
+            files[path] = 'skipped'
+        else:
+            files[path] = 'valid' if verdicts[path] else 'invalid'
+    report = OrderedDict([('validator', bids_validator.__version__),
+                          ('score', score),
+                          ('valid', sum(1 for x in verdicts.values() if x)),
+                          ('invalid', sum(1 for x in verdicts.values() if not x)),
+                          ('skipped', len(paths) - len(verdicts)),
+                          ('files', files)])
+    with open(Path(dataset_dir) / Path(VALIDATION_REPORT), 'w') as file:
+        json.dump(report, file, indent=4)
@@ -0,0 +1,394 @@
+'''
+A shared work queue for any number of workers (tobids.py --queue)
+
+Every worker is started the same way (eg, one per cluster job, on any
+host) and takes (subject, session, kind of data) items from a queue kept in
+the output dir until none are left. There is no coordinator and nothing to
+run besides tobids: workers only share the file system.
+
+<dataset dir>/.tobids_queue/
+    queue.json              the units, settings and items, written once by
+                            the first worker (the others use them as is)
+    claims/<item>.<n>       who holds an item; its mtime is the lease
+    done/<item>.json        the write_session stats of a finished item
+    failed/<item>.txt       the error of an item that failed
+    workers/<worker>/       each worker's own copy of the files workers
+                            would otherwise share (like a shard's, see
+                            helpers/shards.py)
+    finished                once the queue's output has been merged
+
+Claims are files created with O_EXCL, so only one worker gets each. While
+it works, a worker touches its claim every HEARTBEAT_SECONDS; a claim not
+touched for LEASE_SECONDS belongs to a worker that died, and the next
+worker takes the item over by creating claim n + 1 (again O_EXCL, so only
+one does). Ages are measured against the queue file system's own clock, so
+hosts with skewed clocks agree.
+
+Behavioral items wait for the unit's EEG and fMRI items (EEG-synced events
+are read from the converted EEG). Once every item is done, the worker that
+claims the merge folds the workers' files into the dataset and runs the
+dataset-level steps; the others stop.
+'''
+
+import os
+import json
+import time
+import shutil
+import socket
+import threading
+import traceback
+from glob import glob
+from pathlib import Path
+from helpers.plan import unit_to_dict, unit_from_dict
+from helpers.shards import fold_shard_dirs, results_to_json, results_from_json
+from writers.session_tools import get_unit_modalities, write_session
+
+
+QUEUE_DIR = '.tobids_queue'
+QUEUE_VERSION = 1
+
+# A claim not renewed for this long is handed to another worker
+LEASE_SECONDS = 600
+HEARTBEAT_SECONDS = 30
+# How often a worker with nothing to claim looks again
+POLL_SECONDS = 5
+
+# The claim for folding everything together at the end
+MERGE_ITEM = 'merge'
+
+
+def get_queue_dir(dataset_dir):
+    return Path(dataset_dir) / Path(QUEUE_DIR)
+
+
+def queue_state(dataset_dir):
+    # None (no queue), 'open' or 'finished'
+    queue_dir = get_queue_dir(dataset_dir)
+    if os.path.exists(queue_dir / Path('finished')):
+        return 'finished'
+    if os.path.exists(queue_dir / Path('queue.json')):
+        return 'open'
+    return None
+
+
+def make_items(units):
+    '''
+    Takes as input the units from get_session_units
+    Returns the queue items, one per unit and kind of data, as dicts with
+    keys name (eg, sub-001_ses-001_eeg), unit (index into units), modality
+    and after (names of the items it has to wait for)
+    Largest units come first (like run_parallel), each unit's data in the
+    order write_session writes it
+    '''
+
+    items = []
+    for i in sorted(range(len(units)), key=lambda i: (-units[i]['size'], i)):
+        unit = units[i]
+        stem = 'sub-' + unit['subject']
+        if unit['session'] != '-999':
+            stem += '_ses-' + unit['session']
+        modalities = get_unit_modalities(unit)
+        for modality in modalities:
+            after = []
+            if modality == 'behav':
+                after = [stem + '_' + x for x in modalities if x != 'behav']
+            items.append({'name': stem + '_' + modality,
+                          'unit': i,
+                          'modality': modality,
+                          'after': after})
+    return items
+
+
+def create_queue(dataset_dir, units, settings):
+    '''
+    Takes as input the dataset dir, the units from get_session_units and
+    the settings for write_session
+    Saves them with their items as the queue, unless another worker got
+    there first (then its queue stands)
+    '''
+
+    queue_dir = get_queue_dir(dataset_dir)
+    os.makedirs(queue_dir, exist_ok=True)
+    queue = {'version': QUEUE_VERSION,
+             'settings': settings,
+             'units': [unit_to_dict(x) for x in units],
+             'items': make_items(units)}
+
+    filename = queue_dir / Path('queue.json')
+    temp = filename.with_name('.{}.{}.tmp'.format(filename.name, _worker_name()))
+    with open(temp, 'w') as file:
+        json.dump(queue, file)
+    # A hard link can't replace an existing file: the first queue wins
+    try:
+        os.link(temp, filename)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp)
+
+
+def load_queue(dataset_dir):
+    '''
+    Takes as input the dataset dir
+    Returns the queue's (items, units, settings)
+    '''
+
+    filename = get_queue_dir(dataset_dir) / Path('queue.json')
+    with open(filename, 'r') as file:
+        queue = json.load(file)
+    if queue.get('version') != QUEUE_VERSION:
+        raise ValueError('{} is from another version of tobids; remove {} and start '
+                         'the workers again'.format(filename, filename.parent))
+    units = [unit_from_dict(x) for x in queue['units']]
+    return queue['items'], units, queue['settings']
+
+
+def run_worker(dataset_dir, items, units, settings, progress_bar, worker=None):
+    '''
+    PARAMETERS
+    ----------
+    dataset_dir (pathlib.Path): the dir holding rawdata and the queue
+    items, units, settings: from load_queue (settings may be adjusted to
+                            this host, eg its threads)
+    progress_bar (ByteProgress): Anything with an update(n_bytes, kind,
+                                 seconds) method (see helpers/progress.py)
+    worker (str): this worker's name (default: host-pid)
+
+    Claims and converts items until every item is done; waits while other
+    workers still hold claims (their items come back if they die)
+    An item that fails is recorded and left alone; raises an error listing
+    the failures once nothing else can be done
+    '''
+
+    queue_dir = get_queue_dir(dataset_dir)
+    worker = worker or _worker_name()
+    worker_dir = queue_dir / Path('workers') / Path(worker)
+    os.makedirs(worker_dir, exist_ok=True)
+    for name in ['claims', 'done', 'failed']:
+        os.makedirs(queue_dir / Path(name), exist_ok=True)
+    # Files other workers would also write to stay in the worker's dir
+    settings = dict(settings, shard_dir=worker_dir)
+
+    while True:
+        done, failed, claims = _scan(queue_dir)
+        left = [x for x in items if x['name'] not in done]
+        # (a scan after the merge finds nothing done, but the queue
+        # finished)
+        if not left or queue_state(dataset_dir) == 'finished':
+            return
+        now = _now(queue_dir, worker)
+
+        lease = None
+        for item in items:
+            if item['name'] in done or item['name'] in failed:
+                continue
+            if not all(x in done for x in item['after']):
+                continue
+            lease = _claim(queue_dir, item['name'], worker, claims, now)
+            if lease is not None:
+                break
+
+        if lease is not None:
+            _run_item(queue_dir, item, units[item['unit']], settings, progress_bar,
+                      lease, worker)
+            continue
+
+        # Items that failed, or wait for one that did, won't get done
+        stuck = set(failed)
+        for item in left:
+            if any(x in stuck for x in item['after']):
+                stuck.add(item['name'])
+        if all(x['name'] in stuck for x in left):
+            errors = []
+            for name in sorted(failed):
+                with open(queue_dir / Path('failed') / Path(name + '.txt'), 'r') as file:
+                    errors.append('{}: {}'.format(name, file.read().strip().splitlines()[-1]))
+            raise ValueError('These queue items failed:\n{}\nSee {} for the details; remove it '
+                             'to try them again'.format('\n'.join(errors),
+                                                        queue_dir / Path('failed')))
+
+        time.sleep(POLL_SECONDS)
+
+
+def finish_queue(dataset_dir, worker=None):
+    '''
+    Takes as input the dataset dir, once run_worker returned (every item
+    is done)
+    The one worker that claims the merge folds every worker's files into
+    the dataset and marks the queue finished
+    Returns (the write_session stats of all items, the compression
+    settings) for that worker, None for the others
+    '''
+
+    dataset_dir = Path(dataset_dir)
+    queue_dir = get_queue_dir(dataset_dir)
+    worker = worker or _worker_name()
+
+    if queue_state(dataset_dir) == 'finished':
+        return None
+    claims = _scan(queue_dir)[2]
+    try:
+        now = _now(queue_dir, worker)
+    except FileNotFoundError:
+        # The merge just finished and cleared the claims
+        return None
+    lease = _claim(queue_dir, MERGE_ITEM, worker, claims, now)
+    if lease is None:
+        return None
+    # Merged by another worker between our check and the claim
+    if queue_state(dataset_dir) == 'finished':
+        _release(queue_dir, MERGE_ITEM)
+        return None
+
+    with lease:
+        items, _, settings = load_queue(dataset_dir)
+        results = []
+        for item in items:
+            with open(queue_dir / Path('done') / Path(item['name'] + '.json'), 'r') as file:
+                results += results_from_json([json.load(file)])
+
+        fold_shard_dirs(dataset_dir / Path('rawdata'),
+                        sorted(glob(str(queue_dir / Path('workers') / Path('*')))))
+        _save(queue_dir / Path('finished'),
+              json.dumps({'items': len(items), 'merged_by': worker}))
+
+    for name in ['claims', 'done', 'failed', 'workers']:
+        shutil.rmtree(queue_dir / Path(name), ignore_errors=True)
+    os.remove(queue_dir / Path('queue.json'))
+
+    return results, settings['compression']
+
+
+class Lease:
+    '''
+    A worker's claim on one queue item
+    Inside a with block, a thread renews it every HEARTBEAT_SECONDS so
+    other workers see its holder is alive; lost turns True if another
+    worker took the item over anyway (the holder stalled past the lease)
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def renew(self):
+        name, n = self.path.name.rsplit('.', 1)
+        if os.path.exists(self.path.with_name('{}.{}'.format(name, int(n) + 1))):
+            self.lost = True
+            return
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _beat(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            self.renew()
+
+
+def _run_item(queue_dir, item, unit, settings, progress_bar, lease, worker):
+    # Convert one claimed item and record how it went
+    name = item['name']
+    print('\nProcessing {} ({})'.format(name, worker))
+    with lease:
+        try:
+            result = write_session(unit, settings, progress_bar, modalities=[item['modality']])
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+            _save(queue_dir / Path('failed') / Path(name + '.txt'),
+                  'worker {}\n{}'.format(worker, error))
+            _release(queue_dir, name)
+            return
+
+    lease.renew()
+    if lease.lost:
+        # The worker that took it over records it
+        print('\n{} was taken over by another worker while this one stalled'.format(name))
+        return
+    # Done before the claim goes, so no one claims it in between
+    _save(queue_dir / Path('done') / Path(name + '.json'), json.dumps(results_to_json([result])[0]))
+    _release(queue_dir, name)
+
+
+def _scan(queue_dir):
+    # The names of the done and failed items, and per claimed item its
+    # latest claim as (n, mtime)
+    done = {Path(x).stem for x in glob(str(queue_dir / Path('done') / Path('*.json')))}
+    failed = {Path(x).stem for x in glob(str(queue_dir / Path('failed') / Path('*.txt')))}
+    claims = {}
+    for path in glob(str(queue_dir / Path('claims') / Path('*'))):
+        name, n = Path(path).name.rsplit('.', 1)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+        if int(n) > claims.get(name, (0, None))[0]:
+            claims[name] = (int(n), mtime)
+    return done, failed, claims
+
+
+def _claim(queue_dir, name, worker, claims, now):
+    # Returns a Lease on the item, or None if another worker holds it (or
+    # beat us to it)
+    n = 0
+    if name in claims:
+        n, mtime = claims[name]
+        if now - mtime < LEASE_SECONDS:
+            return None
+
+    path = queue_dir / Path('claims') / Path('{}.{}'.format(name, n + 1))
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except FileExistsError:
+        return None
+    with os.fdopen(fd, 'w') as file:
+        file.write(worker)
+
+    # Finished (and released) between our scan and the claim
+    if os.path.exists(queue_dir / Path('done') / Path(name + '.json')):
+        os.remove(path)
+        return None
+    if n:
+        print('\nTaking over {} from a worker that stopped renewing its claim'.format(name))
+    return Lease(path)
+
+
+def _release(queue_dir, name):
+    # Remove every claim on the item
+    for path in glob(str(queue_dir / Path('claims') / Path(name + '.*'))):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _now(queue_dir, worker):
+    # The queue file system's clock (claims are aged by their mtime)
+    clock = queue_dir / Path('claims') / Path('.{}.clock'.format(worker))
+    with open(clock, 'a'):
+        pass
+    os.utime(clock)
+    return os.stat(clock).st_mtime
+
+
+def _save(filename, text):
+    # Write text atomically
+    temp = filename.with_name('.{}.{}.tmp'.format(filename.name, _worker_name()))
+    with open(temp, 'w') as file:
+        file.write(text)
+    os.replace(temp, filename)
+
+
+def _worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
@@ -0,0 +1,84 @@
+import json
+import pytest
+from helpers.basic_parsing import parse_command_line, ask_yes_no, get_overwrite
+from helpers.validations import validate_task_names
+
+
+@pytest.fixture
+def origin(tmp_path):
+    origin = tmp_path / 'orig'
+    (origin / 'sub_01' / 'GradCPT').mkdir(parents=True)
+    (origin / 'sub_01' / 'GradCPT' / 'rec.eeg').write_bytes(b'')
+    return origin
+
+
+@pytest.fixture
+def no_stdin(monkeypatch):
+    # Fail any test that would read an answer from stdin
+    def fail(question):
+        raise AssertionError('asked: ' + question)
+    monkeypatch.setattr('builtins.input', fail)
+
+
+def test_config_defaults(origin, tmp_path):
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps({'jobs': 3, 'expect_tasks': ['GradCPT'],
+                                  'no-overwrite': True, 'non-interactive': True}))
+
+    _, _, options = parse_command_line(['--config', str(config), str(origin)])
+
+    assert options['jobs'] == 3
+    assert options['expect_tasks'] == ['GradCPT']
+    assert options['overwrite'] is False
+    assert options['interactive'] is False
+
+
+def test_command_line_overrides_config(origin, tmp_path):
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps({'jobs': 3, 'expect-tasks': 'GradCPT,ES'}))
+
+    _, _, options = parse_command_line(['--config', str(config), str(origin),
+                                        '--jobs', '2', '--overwrite'])
+
+    assert options['jobs'] == 2
+    assert options['expect_tasks'] == ['GradCPT', 'ES']
+    assert options['overwrite'] is True
+
+
+def test_unknown_config_key(origin, tmp_path):
+    config = tmp_path / 'config.json'
+    config.write_text(json.dumps({'jobz': 3}))
+    with pytest.raises(ValueError, match='jobz'):
+        parse_command_line(['--config', str(config), str(origin)])
+
+
+def test_yes_and_non_interactive_exclusive(origin):
+    with pytest.raises(ValueError):
+        parse_command_line([str(origin), '--yes', '--non-interactive'])
+
+
+def test_yes_answers(no_stdin):
+    assert ask_yes_no('Go on? ', {'yes': True}) is True
+
+
+def test_non_interactive_raises(no_stdin):
+    with pytest.raises(ValueError, match='Go on?'):
+        ask_yes_no('Go on? ', {'interactive': False})
+
+
+def test_asks_until_answered(monkeypatch):
+    answers = iter(['maybe', ' N '])
+    monkeypatch.setattr('builtins.input', lambda question: next(answers))
+    assert ask_yes_no('Go on? ') is False
+
+
+def test_overwrite_option_answers(no_stdin):
+    assert get_overwrite({'overwrite': False, 'interactive': False}) is False
+    assert get_overwrite({'overwrite': None, 'yes': True}) is True
+
+
+def test_expected_tasks(origin, no_stdin):
+    subjects = [{'path': 'sub_01'}]
+    validate_task_names(subjects, origin, options={'expect_tasks': ['GradCPT']})
+    with pytest.raises(ValueError):
+        validate_task_names(subjects, origin, options={'expect_tasks': ['ES']})
@@ -0,0 +1,93 @@
+import mne
+import numpy as np
+import pytest
+from helpers.brainvision import read_events, read_markers
+
+
+VHDR = '''Brain Vision Data Exchange Header File Version 1.0
+; Data created by the test suite
+
+[Common Infos]
+Codepage={codepage}
+DataFile=rec.eeg
+MarkerFile=rec.vmrk
+DataFormat=BINARY
+DataOrientation=MULTIPLEXED
+NumberOfChannels=2
+SamplingInterval={interval}
+
+[Binary Infos]
+BinaryFormat=INT_16
+
+[Channel Infos]
+Ch1=Fp1,,0.1,µV
+Ch2=Fp2,,0.1,µV
+'''
+
+VMRK = '''Brain Vision Data Exchange Marker File, Version 1.0
+
+[Common Infos]
+Codepage={codepage}
+DataFile=rec.eeg
+
+[Marker Infos]
+; Each entry: Mk<Marker number>=<Type>,<Description>,<Position in data points>,
+; <Size in data points>, <Channel number (0 = marker is related to all channels)>
+Mk1=New Segment,,1,1,0,20240101120000000000
+Mk2=Stimulus,S255,101,1,0
+Mk3=Stimulus,S  1,101,1,0
+Mk4=Response,R  3,250,1,0
+Mk5=Stimulus,S 12,400,1,0
+Mk6=SyncStatus,Sync On,410,1,0
+Mk7=Comment,note\\1 with comma,500,1,0
+Mk8=Bad Interval,,600,50,0
+Mk9=Optic,O  2,700,1,0
+Mk10=Stimulus,S255,900,1,0
+Mk11=Stimulus,S  1,900,3,0
+Mk12=Comment,Grüße,950,1,0
+'''
+
+
+def _write_recording(path, codepage='UTF-8', interval=2000):
+    # A two channel, 1000 sample BrainVision recording with the markers
+    # above
+    encoding = 'cp1252' if codepage == 'ANSI' else 'utf-8'
+    (path / 'rec.vhdr').write_bytes(VHDR.format(codepage=codepage,
+                                                interval=interval).encode(encoding))
+    (path / 'rec.vmrk').write_bytes(VMRK.format(codepage=codepage).encode(encoding))
+    data = np.random.default_rng(0).integers(-100, 100, (1000, 2), dtype=np.int16)
+    (path / 'rec.eeg').write_bytes(data.tobytes())
+    return path / 'rec.vhdr'
+
+
+def test_events_match_mne(tmp_path):
+    vhdr = _write_recording(tmp_path)
+
+    raw = mne.io.read_raw_brainvision(vhdr, preload=False, verbose='error')
+    mne_events, mne_event_id = mne.events_from_annotations(raw, verbose='error')
+    events, event_id, sfreq = read_events(vhdr)
+
+    assert event_id == mne_event_id
+    np.testing.assert_array_equal(events, mne_events)
+    assert sfreq == raw.info['sfreq']
+
+
+# (mne reads markers as UTF-8 only, so ANSI is checked here)
+@pytest.mark.parametrize('codepage', ['UTF-8', 'ANSI'])
+def test_markers(tmp_path, codepage):
+    vhdr = _write_recording(tmp_path, codepage)
+    markers = read_markers(vhdr.with_suffix('.vmrk'))
+
+    assert len(markers) == 12
+    # Positions count from 1 in the file, from 0 here
+    assert markers['sample'][1] == 100
+    assert markers['duration'][7] == 50
+    # Commas in descriptions are stored as \1
+    assert markers['description'][6] == 'note, with comma'
+    assert markers['description'][11] == 'Grüße'
+
+
+def test_no_markers(tmp_path):
+    vmrk = tmp_path / 'empty.vmrk'
+    vmrk.write_text('Brain Vision Data Exchange Marker File, Version 1.0\n')
+    assert len(read_markers(vmrk)) == 0
@@ -0,0 +1,84 @@
+import mne
+import numpy as np
+import pytest
+from writers.edf_tools import write_edf, _get_record_samples
+
+
+READERS = {'.edf': mne.io.read_raw_edf, '.bdf': mne.io.read_raw_bdf}
+
+# Digital steps over each format's range
+STEPS = {'.edf': 2 ** 16, '.bdf': 2 ** 24}
+
+
+def _raw(seconds, sfreq):
+    # EEG in volts (tens of uV), one channel with an offset and one flat
+    n_times = int(round(seconds * sfreq))
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 20e-6, (4, n_times))
+    data[2] += 50e-6
+    data[3] = 0
+    info = mne.create_info(['Fp1', 'Fp2', 'Cz', 'Pz'], sfreq, 'eeg')
+    return mne.io.RawArray(data, info, verbose='error')
+
+
+def _read(filename):
+    return READERS[filename.suffix](filename, preload=True, verbose='error')
+
+
+@pytest.mark.parametrize('extension', ['.edf', '.bdf'])
+@pytest.mark.parametrize('threads', [1, 3])
+def test_amplitude_round_trip(tmp_path, extension, threads):
+    raw = _raw(7.3, 500)
+    filename = tmp_path / ('rec' + extension)
+    write_edf(raw, filename, threads)
+
+    back = _read(filename)
+    assert back.info['sfreq'] == 500
+    # 0.73 s records hold the 3650 samples exactly: nothing padded
+    assert back.n_times == raw.n_times == 3650
+
+    data = raw.get_data()
+    # Within one digital step of each channel's range (in volts)
+    span = (np.ceil(data.max(axis=1) * 1e6) - np.floor(data.min(axis=1) * 1e6)) * 1e-6
+    span[span == 0] = 2e-6
+    error = np.abs(back.get_data() - data).max(axis=1)
+    assert np.all(error <= span / STEPS[extension])
+    # Still volts, not uV or V mixed up
+    np.testing.assert_allclose(back.get_data()[2].mean(), data[2].mean(), rtol=1e-3)
+
+
+def test_blocks_cover_the_recording(tmp_path, monkeypatch):
+    # Several blocks of whole records, read one ahead of the writing
+    from writers import edf_tools
+    monkeypatch.setattr(edf_tools, 'BLOCK_BYTES', 4 * 8 * 250 * 3)
+    raw = _raw(20, 250)
+    filename = tmp_path / 'rec.edf'
+    write_edf(raw, filename, 2)
+    back = _read(filename)
+    np.testing.assert_allclose(back.get_data(), raw.get_data(), atol=1e-8)
+
+
+@pytest.mark.parametrize('extension', ['.edf', '.bdf'])
+def test_padding_is_zero_volts(tmp_path, extension):
+    # 3001 samples at 1000 Hz: no record length of at least 0.1 s divides
+    # them, so the last 1 s record is padded
+    raw = _raw(3.001, 1000)
+    assert _get_record_samples(raw.n_times, 1000) is None
+    filename = tmp_path / ('rec' + extension)
+    write_edf(raw, filename)
+
+    back = _read(filename)
+    assert back.n_times == 4000
+    data = raw.get_data()
+    np.testing.assert_allclose(back.get_data()[:, :raw.n_times], data, atol=1e-8)
+    # Padding reads back as 0 V (to within a digital step)
+    assert np.abs(back.get_data()[:, raw.n_times:]).max() < 1e-8
+
+
+def test_record_samples():
+    # The most samples up to 1 s that divide the recording
+    assert _get_record_samples(3650, 500) == 365
+    assert _get_record_samples(5000, 500) == 500
+    assert _get_record_samples(3001, 1000) is None
+    # Non-integer rates keep pyedflib's record length
+    assert _get_record_samples(1000, 499.5) is None
@@ -0,0 +1,55 @@
+import numpy as np
+from writers.eeg_tools import get_event_summary, get_true_event_label, SUMMARY_SAMPLES
+
+
+EVENT_ID = {'Stimulus/S255': 255, 'Stimulus/S  1': 1, 'Stimulus/S  2': 2}
+
+
+def _events(*pairs):
+    # (sample, code) pairs to an mne-style events array
+    return np.array([[sample, 0, code] for sample, code in pairs])
+
+
+def test_summary_matches_masking():
+    rng = np.random.default_rng(0)
+    events = np.column_stack([np.sort(rng.choice(10000, 300, replace=False)),
+                              np.zeros(300, int),
+                              rng.choice([1, 2, 3, 255, 99], 300)])
+    events = np.vstack([events, [[20000, 0, 7]]])
+
+    summary = get_event_summary(events)
+
+    assert set(summary) == set(events[:, 2].tolist())
+    for code, (n, firsts) in summary.items():
+        samples = events[events[:, 2] == code, 0]
+        assert n == len(samples)
+        assert firsts == tuple(samples[:SUMMARY_SAMPLES])
+
+
+def test_label_in_sync_with_s255():
+    events = _events((10, 255), (10, 1), (50, 2), (80, 2), (90, 2),
+                     (500, 255), (500, 1))
+    assert get_true_event_label(events, EVENT_ID, 'GradCPT') == 'Stimulus/S  1'
+
+
+def test_no_s255():
+    event_id = {'Stimulus/S  1': 1}
+    assert get_true_event_label(_events((10, 1), (20, 1)), event_id, 'GradCPT') is None
+
+
+def test_ambiguous_labels():
+    events = _events((10, 255), (10, 1), (12, 2), (500, 255), (500, 1), (502, 2))
+    assert get_true_event_label(events, EVENT_ID, 'GradCPT') is None
+
+
+def test_gradcpt_needs_two_onsets():
+    events = _events((10, 255), (10, 1), (300, 255), (300, 1), (500, 255), (500, 1))
+    assert get_true_event_label(events, EVENT_ID, 'GradCPT') is None
+    assert get_true_event_label(events, EVENT_ID, 'ES') == 'Stimulus/S  1'
+
+
+def test_summary_passed_in():
+    events = _events((10, 255), (10, 1), (500, 255), (500, 1))
+    summary = get_event_summary(events)
+    assert (get_true_event_label(events, EVENT_ID, 'GradCPT', summary)
+            == get_true_event_label(events, EVENT_ID, 'GradCPT'))
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from helpers import event_cache
+from helpers.event_cache import put_events, get_events, drop_events, run_key
+
+
+EVENTS = np.array([[10, 0, 255], [10, 0, 1]])
+EVENT_ID = {'Stimulus/S255': 255, 'Stimulus/S  1': 1}
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(event_cache, '_events', {})
+
+
+def test_drop_forgets_one_unit():
+    for session in ['001', '002']:
+        for run in ['001', '002']:
+            put_events(run_key('sub-001', session, 'GradCPT', run), EVENTS, EVENT_ID, 500.0)
+
+    drop_events('001', 'ses-001')
+
+    assert sorted(event_cache._events) == [('001', '002', 'GradCPT', '001'),
+                                           ('001', '002', 'GradCPT', '002')]
+
+
+def test_saved_entries_outlive_the_drop(tmp_path):
+    vmrk = tmp_path / 'rec.vmrk'
+    vmrk.write_text('markers')
+    key = run_key('001', '-999', 'GradCPT', 1)
+    put_events(key, EVENTS, EVENT_ID, 500.0, cache_dir=tmp_path / 'cache', vmrk=vmrk)
+    drop_events('001', '-999')
+    assert not event_cache._events
+
+    # Read back from the saved entry (there is no converted EEG to read)
+    events, event_id, sfreq = get_events(key, tmp_path / 'missing.vhdr', tmp_path / 'cache')
+
+    np.testing.assert_array_equal(events, EVENTS)
+    assert event_id == EVENT_ID
+    assert sfreq == 500.0
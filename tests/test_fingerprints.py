@@ -0,0 +1,78 @@
+import os
+import pytest
+from helpers.fingerprints import needs_write, record, MANIFEST_NAME
+
+
+@pytest.fixture
+def files(tmp_path):
+    # An output made from two sources, with its fingerprints recorded
+    sources = [tmp_path / 'run.eeg', tmp_path / 'run.vmrk']
+    sources[0].write_bytes(b'data' * 100)
+    sources[1].write_text('markers')
+    out = tmp_path / 'out'
+    out.mkdir()
+    dest = out / 'sub-001_eeg.edf'
+    dest.write_text('converted')
+    record(dest, sources)
+    return dest, sources
+
+
+def _touch(path, seconds=10):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+
+def test_missing_output_is_written(tmp_path):
+    assert needs_write(tmp_path / 'missing.tsv', [], overwrite=False, incremental=True)
+    assert needs_write(tmp_path / 'missing.tsv', [], overwrite=False)
+
+
+def test_without_incremental_the_overwrite_answer_decides(files):
+    dest, sources = files
+    assert needs_write(dest, sources, overwrite=True)
+    assert not needs_write(dest, sources, overwrite=False)
+
+
+def test_unchanged_sources_are_skipped(files):
+    dest, sources = files
+    assert (dest.parent / MANIFEST_NAME).exists()
+    assert not needs_write(dest, sources, overwrite=True, incremental=True)
+
+
+def test_changed_source_is_rewritten(files):
+    dest, sources = files
+    with open(sources[1], 'a') as file:
+        file.write('more')
+    assert needs_write(dest, sources, overwrite=False, incremental=True)
+
+
+def test_touched_source(files):
+    dest, sources = files
+    _touch(sources[0])
+    # Same size, new mtime: without hashes that counts as changed
+    assert needs_write(dest, sources, overwrite=False, incremental=True)
+
+
+def test_touched_source_with_hash(files):
+    dest, sources = files
+    record(dest, sources, use_hash=True)
+    _touch(sources[0])
+    assert not needs_write(dest, sources, overwrite=False, incremental=True, use_hash=True)
+
+    # Same size, other contents
+    sources[0].write_bytes(b'DATA' * 100)
+    assert needs_write(dest, sources, overwrite=False, incremental=True, use_hash=True)
+
+
+def test_other_sources_are_rewritten(files):
+    dest, sources = files
+    assert needs_write(dest, sources[:1], overwrite=False, incremental=True)
+    os.remove(sources[1])
+    assert needs_write(dest, sources, overwrite=False, incremental=True)
+
+
+def test_never_recorded_is_rewritten(files):
+    dest, sources = files
+    other = dest.with_name('sub-002_eeg.edf')
+    other.write_text('converted elsewhere')
+    assert needs_write(other, sources, overwrite=False, incremental=True)
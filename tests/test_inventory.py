@@ -0,0 +1,123 @@
+import os
+from glob import glob
+from pathlib import Path
+import pytest
+from helpers.inventory import Inventory
+
+
+FILES = ['sub_01/ses_01/EEG/GradCPT/rec_1.eeg',
+         'sub_01/ses_01/EEG/GradCPT/rec_1.vhdr',
+         'sub_01/ses_01/XNAT/scan_BOLD_1/DICOM/run.nii',
+         'sub_01/ses_01/behav/run_city_mnt_1.mat',
+         'sub_01/ses_02/behav/es.csv',
+         'sub_02/EEG/ES/rec.eeg',
+         'sub_02/notes.txt',
+         'sub_02/.hidden/skip.eeg',
+         'sub_02/.skip.eeg',
+         'readme.txt']
+
+
+@pytest.fixture
+def origin(tmp_path):
+    for i, name in enumerate(FILES):
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'x' * (i + 1))
+    return tmp_path
+
+
+def test_files_match_glob(origin):
+    inventory = Inventory(origin)
+    found = [x.path for x in inventory.files(extension='.eeg')]
+    assert found == sorted(Path(x) for x in glob(str(origin / '**' / '*.eeg'), recursive=True))
+
+    under = origin / 'sub_01'
+    found = [x.path for x in inventory.files(under, pattern='*_city_mnt_*.mat')]
+    assert found == [Path(x) for x in glob(str(under / '**' / '*_city_mnt_*.mat'), recursive=True)]
+
+
+def test_hidden_files_are_left_out(origin):
+    inventory = Inventory(origin)
+    names = [x.path.name for x in inventory.files()]
+    assert 'skip.eeg' not in names and '.skip.eeg' not in names
+    assert '.hidden' not in inventory.subdirs(origin / 'sub_02')
+
+
+def test_records(origin):
+    inventory = Inventory(origin)
+    record = inventory.files(extension='.nii')[0]
+    assert (record.subject, record.session, record.modality) == ('sub_01', 'ses_01', 'fmri')
+    assert record.size == os.path.getsize(record.path)
+    # No session dir: the subject's own files have no session
+    assert inventory.files(origin / 'sub_02', extension='.eeg')[0].session == ''
+
+
+def test_queries(origin):
+    inventory = Inventory(origin)
+    assert [x.path.name for x in inventory.files(origin / 'sub_01', within='*_BOLD_*')] == ['run.nii']
+    assert [x.path.name for x in inventory.files(origin / 'sub_02', recursive=False)] == ['notes.txt']
+    assert inventory.subdirs(origin / 'sub_01') == ['ses_01', 'ses_02']
+    assert [x.path.name for x in inventory.files(modality='behav')] == ['run_city_mnt_1.mat', 'es.csv']
+    # Every file but the two hidden ones (FILES sizes are 1 to 10 bytes)
+    assert inventory.size() == sum(range(1, 11)) - 8 - 9
+
+
+def test_subset(origin):
+    inventory = Inventory(origin)
+    subset = inventory.subset(origin / 'sub_01' / 'ses_02')
+    assert [x.path for x in subset.files()] == [origin / 'sub_01/ses_02/behav/es.csv']
+    assert [x.path for x in subset.files(origin / 'sub_01' / 'ses_02')] == \
+        [x.path for x in inventory.files(origin / 'sub_01' / 'ses_02')]
+
+
+def _age_dirs(root, seconds=3600):
+    # Dir mtimes from an hour ago, so the cache trusts them (see
+    # RACY_WINDOW)
+    for dirpath, _, _ in os.walk(root):
+        stamp = os.stat(dirpath).st_mtime - seconds
+        os.utime(dirpath, (stamp, stamp))
+
+
+def test_cache_hit(origin, tmp_path_factory):
+    cache = tmp_path_factory.mktemp('cache') / 'inventory'
+    _age_dirs(origin)
+    first = Inventory(origin, cache=cache)
+    assert first.rescanned > 0
+
+    second = Inventory(origin, cache=cache)
+    assert second.rescanned == 0
+    assert second.files() == first.files()
+
+
+def test_cache_miss_when_a_dir_changes(origin, tmp_path_factory):
+    cache = tmp_path_factory.mktemp('cache') / 'inventory'
+    _age_dirs(origin)
+    Inventory(origin, cache=cache)
+
+    (origin / 'sub_01' / 'ses_02' / 'behav' / 'es_2.csv').write_text('new')
+    inventory = Inventory(origin, cache=cache)
+    # Only the dir that got a new entry is listed again
+    assert inventory.rescanned == 1
+    assert [x.path.name for x in inventory.files(origin / 'sub_01' / 'ses_02')] == ['es.csv', 'es_2.csv']
+
+
+def test_fresh_dirs_are_listed_again(origin, tmp_path_factory):
+    # Modified within RACY_WINDOW of the scan: could still change
+    # unnoticed, so not trusted
+    cache = tmp_path_factory.mktemp('cache') / 'inventory'
+    Inventory(origin, cache=cache)
+    assert Inventory(origin, cache=cache).rescanned > 0
+
+
+def test_unusable_cache_rescans(origin, tmp_path_factory):
+    cache = tmp_path_factory.mktemp('cache') / 'inventory'
+    cache.write_bytes(b'not a pickle')
+    inventory = Inventory(origin, cache=cache)
+    assert inventory.rescanned == len(list(inventory.walk_dirs()))
+
+    # A cache of another origin isn't used either
+    other = tmp_path_factory.mktemp('other')
+    (other / 'sub_09').mkdir()
+    _age_dirs(other)
+    Inventory(other, cache=cache)
+    assert Inventory(origin, cache=cache).rescanned == inventory.rescanned
@@ -0,0 +1,82 @@
+import json
+import pickle
+from multiprocessing import Pool
+from pathlib import Path
+from helpers.metadata import make_write_log, finalize_write_logs, merge_write_logs
+
+
+def _outs(dataset_dir, names):
+    return [dataset_dir / 'rawdata' / 'sub-001' / name for name in names]
+
+
+def _journal(dataset_dir, modality='eeg'):
+    lines = (dataset_dir / 'conversion_log_{}.jsonl'.format(modality)).read_text().splitlines()
+    return [json.loads(x) for x in lines]
+
+
+def test_appends_one_record_per_pair(tmp_path):
+    make_write_log(['a.eeg', 'b.eeg'], _outs(tmp_path, ['a.vhdr', 'b.vhdr']), 'eeg')
+    make_write_log(['c.eeg'], _outs(tmp_path, ['c.vhdr']), 'eeg')
+    make_write_log([], [], 'eeg')
+    assert [x['in'] for x in _journal(tmp_path)] == ['a.eeg', 'b.eeg', 'c.eeg']
+    assert _journal(tmp_path)[0]['out'] == str(_outs(tmp_path, ['a.vhdr'])[0])
+
+
+def test_merge_shard_journals(tmp_path):
+    shard_dirs = [tmp_path / '.tobids_shards' / '{}-of-2'.format(i) for i in [1, 2]]
+    for i, shard_dir in enumerate(shard_dirs):
+        shard_dir.mkdir(parents=True)
+        make_write_log(['{}.eeg'.format(i)], _outs(tmp_path, ['{}.vhdr'.format(i)]), 'eeg',
+                       log_dir=shard_dir)
+    make_write_log(['x.nii'], _outs(tmp_path, ['x.nii.gz']), 'fmri', log_dir=shard_dirs[1])
+    make_write_log(['old.eeg'], _outs(tmp_path, ['old.vhdr']), 'eeg')
+    # A shard killed mid-append
+    with open(shard_dirs[0] / 'conversion_log_eeg.jsonl', 'a') as file:
+        file.write('{"in": "c.ee')
+
+    for shard_dir in shard_dirs:
+        merge_write_logs(shard_dir, tmp_path)
+
+    assert [x['in'] for x in _journal(tmp_path)] == ['old.eeg', '0.eeg', '1.eeg']
+    assert [x['in'] for x in _journal(tmp_path, 'fmri')] == ['x.nii']
+
+
+def _log(args):
+    dataset_dir, i = args
+    make_write_log(['{}.eeg'.format(i)], _outs(Path(dataset_dir), ['{}.vhdr'.format(i)]), 'eeg')
+
+
+def test_concurrent_appends(tmp_path):
+    with Pool(4) as pool:
+        pool.map(_log, [(str(tmp_path), i) for i in range(200)])
+    assert sorted(x['in'] for x in _journal(tmp_path)) == sorted('{}.eeg'.format(i) for i in range(200))
+
+
+def test_finalize(tmp_path):
+    make_write_log(['b.eeg', 'a.eeg'], _outs(tmp_path, ['b1', 'a1']), 'eeg')
+    # Converted again later: the latest record wins
+    make_write_log(['b.eeg'], _outs(tmp_path, ['b2']), 'eeg')
+    # A writer killed mid-append
+    with open(tmp_path / 'conversion_log_eeg.jsonl', 'a') as file:
+        file.write('{"in": "c.ee')
+    finalize_write_logs(tmp_path)
+
+    expected = {'a.eeg': str(_outs(tmp_path, ['a1'])[0]),
+                'b.eeg': str(_outs(tmp_path, ['b2'])[0])}
+    with open(tmp_path / 'conversion_log_eeg.json') as file:
+        view = json.load(file)
+    assert view == expected
+    assert list(view) == ['a.eeg', 'b.eeg']
+    with open(tmp_path / 'conversion_log_eeg.pkl', 'rb') as file:
+        assert pickle.load(file) == expected
+    # Compacted down to the live records
+    assert len(_journal(tmp_path)) == 2
+
+
+def test_old_pickle_log_is_imported(tmp_path):
+    with open(tmp_path / 'conversion_log_fmri.pkl', 'wb') as file:
+        pickle.dump({'old.nii': 'sub-001/old.nii.gz'}, file)
+    make_write_log(['new.nii'], _outs(tmp_path, ['new.nii.gz']), 'fmri')
+    finalize_write_logs(tmp_path)
+    with open(tmp_path / 'conversion_log_fmri.json') as file:
+        assert set(json.load(file)) == {'old.nii', 'new.nii'}
@@ -0,0 +1,83 @@
+import gzip
+import zlib
+import numpy as np
+import pytest
+from helpers.pgzip import ParallelGzipWriter, get_backend, BACKENDS, BACKEND_ORDER, WINDOW
+
+
+def _data(n_bytes):
+    # Compressible but not trivial: a noisy ramp, like image data
+    rng = np.random.default_rng(0)
+    ramp = np.arange(n_bytes // 2, dtype=np.int16)
+    return (ramp + rng.integers(0, 8, ramp.size, dtype=np.int16)).tobytes()
+
+
+@pytest.mark.parametrize('backend', sorted(BACKENDS))
+@pytest.mark.parametrize('threads', [1, 4])
+@pytest.mark.parametrize('n_bytes', [0, 1, WINDOW - 1, WINDOW + 1, 300000])
+def test_round_trip(tmp_path, backend, threads, n_bytes):
+    data = _data(n_bytes) if n_bytes > 1 else b'x' * n_bytes
+    filename = tmp_path / 'out.gz'
+    # Small blocks so the data spans many of them
+    with ParallelGzipWriter(filename, threads=threads, block_size=WINDOW + 7,
+                            backend=backend) as writer:
+        # Uneven writes cross the block boundaries
+        for start in range(0, len(data), 10007):
+            writer.write(data[start:start + 10007])
+        assert writer.tell() == len(data)
+
+    with gzip.open(filename, 'rb') as file:
+        assert file.read() == data
+
+
+def test_one_gzip_member(tmp_path):
+    # The blocks join into one stream, not one member per block
+    data = _data(200000)
+    filename = tmp_path / 'out.gz'
+    with ParallelGzipWriter(filename, threads=3, block_size=WINDOW) as writer:
+        writer.write(data)
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert decompressor.decompress(filename.read_bytes()) == data
+    assert decompressor.eof and decompressor.unused_data == b''
+
+
+def test_same_output_for_any_threads(tmp_path):
+    data = _data(200000)
+    outputs = []
+    for threads in [1, 2, 5]:
+        filename = tmp_path / '{}.gz'.format(threads)
+        with ParallelGzipWriter(filename, threads=threads, block_size=WINDOW) as writer:
+            writer.write(data)
+        outputs.append(filename.read_bytes())
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+def test_seek_only_to_current_position(tmp_path):
+    with ParallelGzipWriter(tmp_path / 'out.gz') as writer:
+        writer.write(b'abc')
+        assert writer.seek(3) == 3
+        with pytest.raises(OSError):
+            writer.seek(0)
+
+
+@pytest.mark.parametrize('level', [0, 1, 6, 9])
+def test_levels(tmp_path, level):
+    data = _data(100000)
+    filename = tmp_path / 'out.gz'
+    with ParallelGzipWriter(filename, threads=2, level=level, block_size=WINDOW) as writer:
+        writer.write(data)
+    assert gzip.decompress(filename.read_bytes()) == data
+    if level:
+        assert filename.stat().st_size < len(data)
+
+
+def test_get_backend():
+    assert get_backend('auto') in BACKENDS
+    assert get_backend('zlib') == 'zlib'
+    with pytest.raises(ValueError, match='Unknown'):
+        get_backend('lz4')
+    for name in BACKEND_ORDER:
+        if name not in BACKENDS:
+            with pytest.raises(ValueError, match='not installed'):
+                get_backend(name)
@@ -0,0 +1,80 @@
+import os
+import errno
+import shutil
+import pytest
+from helpers import placement
+from helpers.placement import place_file, placement_report, write_placement_log, METHODS
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'rec.eeg'
+    source.write_bytes(b'raw data' * 1000)
+    return source
+
+
+def _failing(calls, name):
+    # A placer that records the call, leaves a partial file and fails
+    def place(source, dest):
+        calls.append(name)
+        with open(dest, 'wb') as file:
+            file.write(b'partial')
+        raise OSError(errno.EXDEV, '{} not supported here'.format(name))
+    return place
+
+
+def test_copy_mode_copies(source, tmp_path):
+    dest = tmp_path / 'out.eeg'
+    assert place_file(source, dest) == 'copy'
+    assert dest.read_bytes() == source.read_bytes()
+    assert os.stat(dest).st_ino != os.stat(source).st_ino
+
+
+def test_auto_hardlinks_on_the_same_filesystem(source, tmp_path):
+    dest = tmp_path / 'out.eeg'
+    assert place_file(source, dest, 'auto') == 'hardlink'
+    assert os.stat(dest).st_ino == os.stat(source).st_ino
+
+
+@pytest.mark.parametrize('works', METHODS)
+def test_fallback_order(source, tmp_path, monkeypatch, works):
+    # Every method before `works` fails (each failure is cleaned up), and
+    # `works` does (whatever this filesystem supports)
+    calls = []
+    placers = {name: _failing(calls, name) for name in METHODS}
+
+    def place(source, dest):
+        calls.append(works)
+        assert not os.path.exists(dest)
+        shutil.copy(source, dest)
+    placers[works] = place
+    monkeypatch.setattr(placement, '_PLACERS', placers)
+
+    dest = tmp_path / 'out.eeg'
+    assert place_file(source, dest, 'auto') == works
+    assert calls == METHODS[:METHODS.index(works) + 1]
+    assert dest.read_bytes() == source.read_bytes()
+
+
+def test_existing_link_is_replaced_not_written_through(source, tmp_path):
+    dest = tmp_path / 'out.eeg'
+    os.link(source, dest)
+    other = tmp_path / 'other.eeg'
+    other.write_bytes(b'other data')
+    place_file(other, dest)
+    assert dest.read_bytes() == b'other data'
+    # The raw data it was linked to is untouched
+    assert source.read_bytes() == b'raw data' * 1000
+
+
+def test_report_and_log(source, tmp_path):
+    assert placement_report([]) == 'Placed files: none'
+    placements = [(source, tmp_path / 'b.eeg', 'copy'),
+                  (source, tmp_path / 'a.eeg', 'hardlink'),
+                  (source, tmp_path / 'c.eeg', 'hardlink')]
+    assert placement_report(placements) == 'Placed files: 3 (hardlink 2, copy 1)'
+
+    write_placement_log(placements, tmp_path)
+    lines = (tmp_path / 'placement_log.tsv').read_text().splitlines()
+    assert lines[0] == 'dest\tsource\tmethod'
+    assert [x.split('\t')[0] for x in lines[1:]] == [str(tmp_path / x) for x in ['a.eeg', 'b.eeg', 'c.eeg']]
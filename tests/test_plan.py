@@ -0,0 +1,93 @@
+import pytest
+from pathlib import Path
+from helpers.inventory import Inventory
+from helpers.basic_parsing import parse_subjects
+from writers.session_tools import get_session_units
+from helpers.plan import make_plan, save_plan, load_plan, plan_report
+
+
+SETTINGS = {'make_edf': False,
+            'edf_type': '.edf',
+            'use_mne_bids': False,
+            'overwrite': False,
+            'threads': 1,
+            'compression': {'enabled': True, 'level': 6, 'backend': 'zlib'},
+            'placement': 'copy',
+            'incremental': False,
+            'use_hash': False}
+
+
+@pytest.fixture
+def origin(tmp_path):
+    # Two BrainVision GradCPT runs for one subject (contents don't matter
+    # for a plan)
+    origin = tmp_path / 'orig'
+    task_dir = origin / 'sub_01' / 'EEG' / 'GradCPT'
+    task_dir.mkdir(parents=True)
+    for run in [1, 2]:
+        for extension, size in [('.vhdr', 10), ('.vmrk', 20), ('.eeg', 100 * run)]:
+            (task_dir / 'sub_GradCPT_{}{}'.format(run, extension)).write_bytes(b'x' * size)
+    return origin
+
+
+def _plan(origin, jobs=1, settings=SETTINGS):
+    dest = origin.parent / 'BIDS' / 'rawdata'
+    inventory = Inventory(origin)
+    units = get_session_units(parse_subjects(origin, inventory), origin, dest, inventory)
+    return units, make_plan(units, settings, origin, dest, jobs)
+
+
+def test_plan_lists_work_and_writes_nothing(origin):
+    _, plan = _plan(origin)
+
+    items = plan['units'][0]['items']
+    assert [x['action'] for x in items] == ['write', 'write']
+    assert [x['bytes'] for x in items] == [130, 230]
+    assert plan['totals']['bytes'] == 360
+    assert not (origin.parent / 'BIDS').exists()
+    assert 'sub-001: 360.0 B to write' in plan_report(plan)
+
+
+def test_existing_output_skipped(origin):
+    _, plan = _plan(origin)
+    out = Path(plan['units'][0]['items'][0]['dests'][0])
+    out.parent.mkdir(parents=True)
+    out.write_text('x')
+
+    _, plan = _plan(origin)
+
+    assert [x['action'] for x in plan['units'][0]['items']] == ['skip', 'write']
+    assert plan['totals']['bytes'] == 230
+
+
+def test_round_trip(origin, tmp_path):
+    units, plan = _plan(origin)
+    save_plan(plan, tmp_path / 'plan.json')
+
+    loaded, loaded_units = load_plan(tmp_path / 'plan.json')
+
+    assert loaded['settings'] == SETTINGS
+    assert len(loaded_units) == len(units)
+    for unit, loaded_unit in zip(units, loaded_units):
+        for key in unit:
+            if key == 'inventory':
+                assert loaded_unit[key].to_dict() == unit[key].to_dict()
+            else:
+                assert loaded_unit[key] == unit[key]
+
+
+def test_changed_source_refused(origin, tmp_path):
+    _, plan = _plan(origin)
+    save_plan(plan, tmp_path / 'plan.json')
+    (origin / 'sub_01' / 'EEG' / 'GradCPT' / 'sub_GradCPT_2.eeg').write_bytes(b'x')
+
+    with pytest.raises(ValueError, match='make the plan again'):
+        load_plan(tmp_path / 'plan.json')
+
+
+def test_wall_time_with_jobs(origin):
+    _, serial = _plan(origin, jobs=1)
+    _, parallel = _plan(origin, jobs=2)
+    # One unit, so more workers don't help
+    assert (parallel['totals']['estimated_wall_seconds']
+            == serial['totals']['estimated_wall_seconds'])
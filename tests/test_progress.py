@@ -0,0 +1,69 @@
+import pytest
+from helpers.inventory import Inventory
+from helpers.basic_parsing import parse_subjects
+from writers.session_tools import get_session_units
+from helpers.progress import ByteProgress, unit_bytes, PRIOR_SECONDS, DEFAULT_PRIOR_SECONDS
+
+
+SETTINGS = {'make_edf': False, 'edf_type': '.edf', 'use_mne_bids': False}
+RATES = {'eeg': 100.0, 'fmri': 50.0, 'behav': 10.0}
+
+
+@pytest.fixture
+def units(tmp_path):
+    # Two BrainVision GradCPT runs for one subject
+    origin = tmp_path / 'orig'
+    task_dir = origin / 'sub_01' / 'EEG' / 'GradCPT'
+    task_dir.mkdir(parents=True)
+    for run in [1, 2]:
+        for extension, size in [('.vhdr', 10), ('.vmrk', 20), ('.eeg', 100 * run)]:
+            (task_dir / 'sub_GradCPT_{}{}'.format(run, extension)).write_bytes(b'x' * size)
+    inventory = Inventory(origin)
+    return get_session_units(parse_subjects(origin, inventory), origin,
+                             tmp_path / 'BIDS' / 'rawdata', inventory)
+
+
+def test_unit_bytes(units):
+    assert unit_bytes(units[0], SETTINGS) == {'eeg': 360, 'fmri': 0, 'behav': 0}
+
+
+def test_unit_bytes_from_inventory(units):
+    # A file grown after the scan keeps its inventory size
+    unit = units[0]
+    eeg = unit['seek_path'] / 'EEG' / 'GradCPT' / 'sub_GradCPT_1.eeg'
+    eeg.write_bytes(b'x' * 5000)
+    assert unit_bytes(unit, SETTINGS)['eeg'] == 360
+
+
+def _progress(totals, measured, workers=1):
+    return ByteProgress(totals, RATES, measured, workers)
+
+
+def test_eta_from_recorded_rates():
+    progress = _progress({'eeg': 1000, 'fmri': 500, 'behav': 0},
+                         {'eeg': 3, 'fmri': 0, 'behav': 0}, workers=2)
+    assert progress.priors['eeg'] == PRIOR_SECONDS
+    assert progress.priors['fmri'] == DEFAULT_PRIOR_SECONDS
+    # (1000 / 100 + 500 / 50) over 2 workers
+    assert progress.eta() == pytest.approx(10)
+
+
+def test_measured_rate_takes_over():
+    progress = _progress({'eeg': 10 ** 6, 'fmri': 0, 'behav': 0},
+                         {'eeg': 0, 'fmri': 0, 'behav': 0})
+    progress.update(1000, 'eeg', 1.0)
+    # 3 s of the recorded 100 B/s plus 1 s at 1000 B/s
+    assert progress.rate('eeg') == pytest.approx(1300 / 4)
+    progress.update(10 ** 5, 'eeg', 100.0)
+    assert progress.rate('eeg') == pytest.approx((300 + 101000) / 104)
+    assert progress.done['eeg'] == 101000
+    assert 'eeg' in progress.status()
+
+
+def test_skipped_outputs_move_the_bar_only():
+    progress = _progress({'eeg': 1000, 'fmri': 0, 'behav': 0},
+                         {'eeg': 0, 'fmri': 0, 'behav': 0})
+    progress.update(400, 'eeg')
+    assert progress.rate('eeg') == RATES['eeg']
+    assert progress.bar.n == 400
+    assert progress.eta() == pytest.approx(6)
@@ -0,0 +1,110 @@
+import threading
+import time
+import pytest
+from helpers.scheduler import make_task, run_graph
+
+
+def _recording_tasks(specs, log, lock, seconds=0.0):
+    # Tasks from (name, after) pairs that log when they start and finish
+    def work(name):
+        def run():
+            with lock:
+                log.append(('start', name))
+            time.sleep(seconds)
+            with lock:
+                log.append(('end', name))
+            return name
+        return run
+    return [make_task(name, work(name), after) for name, after in specs]
+
+
+SPECS = [('events', []),
+         ('eeg 1', ['events']),
+         ('eeg 2', ['events']),
+         ('fmri', []),
+         ('behav 1', ['events', 'eeg 1']),
+         ('behav 2', ['events', 'eeg 2'])]
+
+
+def test_serial_runs_in_list_order():
+    log = []
+    tasks = _recording_tasks(SPECS, log, threading.Lock())
+    assert run_graph(tasks) == [x[0] for x in SPECS]
+    assert [x[1] for x in log if x[0] == 'start'] == [x[0] for x in SPECS]
+
+
+def test_serial_waits_when_the_list_is_out_of_order():
+    log = []
+    specs = [('behav', ['eeg']), ('eeg', [])]
+    tasks = _recording_tasks(specs, log, threading.Lock())
+    assert run_graph(tasks) == ['behav', 'eeg']
+    assert [x[1] for x in log if x[0] == 'start'] == ['eeg', 'behav']
+
+
+@pytest.mark.parametrize('workers', [2, 4])
+def test_parallel_respects_dependencies(workers):
+    log = []
+    tasks = _recording_tasks(SPECS, log, threading.Lock(), seconds=0.01)
+    # Results stay in task order however the tasks finished
+    assert run_graph(tasks, workers) == [x[0] for x in SPECS]
+    for name, after in SPECS:
+        start = log.index(('start', name))
+        for other in after:
+            assert log.index(('end', other)) < start
+
+
+def test_parallel_overlaps_independent_tasks():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+
+    run_graph([make_task(str(i), work) for i in range(4)], workers=4)
+    assert max(peak) > 1
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_cycle_raises(workers):
+    tasks = [make_task('a', lambda: 1, ['c']),
+             make_task('b', lambda: 2, ['a']),
+             make_task('c', lambda: 3, ['b']),
+             make_task('d', lambda: 4)]
+    with pytest.raises(ValueError, match='wait on each other'):
+        run_graph(tasks, workers)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_unknown_dependency_raises(workers):
+    ran = []
+    tasks = [make_task('a', lambda: ran.append('a')),
+             make_task('b', lambda: ran.append('b'), ['a', 'typo'])]
+    with pytest.raises(ValueError, match='unknown tasks: typo'):
+        run_graph(tasks, workers)
+    # Checked before anything runs
+    assert ran == []
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_done_elsewhere(workers):
+    tasks = [make_task('behav', lambda: 'behav', ['eeg 1'])]
+    assert run_graph(tasks, workers, done=['eeg 1']) == ['behav']
+
+
+def test_error_stops_new_tasks():
+    ran = []
+
+    def fail():
+        raise RuntimeError('boom')
+
+    tasks = [make_task('a', fail),
+             make_task('b', lambda: ran.append('b'), ['a'])]
+    with pytest.raises(RuntimeError, match='boom'):
+        run_graph(tasks, workers=2)
+    assert ran == []
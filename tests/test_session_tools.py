@@ -0,0 +1,76 @@
+import pytest
+from pathlib import Path
+from helpers.inventory import Inventory
+from helpers.basic_parsing import parse_subjects
+from helpers import event_cache
+from helpers.event_cache import put_events, run_key
+from writers import session_tools
+from writers.session_tools import get_session_units, write_session
+
+
+SETTINGS = {'overwrite': True,
+            'incremental': False,
+            'use_hash': False,
+            'shard_dir': None}
+
+
+@pytest.fixture
+def unit(tmp_path):
+    # An fMRI session with two GradCPT behavioral runs (the writers are
+    # stubbed, so the files can be empty)
+    origin = tmp_path / 'orig'
+    for scan in ['1_AAHScout', '2_Localizer', '4_B0map', '5_BOLD_GradCPT_run1']:
+        nifti = origin / 'sub_01' / 'XNAT' / scan / 'NIFTI'
+        nifti.mkdir(parents=True)
+        (nifti / 'image.nii').write_bytes(b'')
+    behav = origin / 'sub_01' / 'behav'
+    behav.mkdir()
+    for run in [1, 2]:
+        (behav / 'sub_city_mnt_run_{}.mat'.format(run)).write_bytes(b'')
+    inventory = Inventory(origin)
+    units = get_session_units(parse_subjects(origin, inventory), origin,
+                              tmp_path / 'BIDS' / 'rawdata', inventory)
+    return units[0]
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    # What the stubbed behavioral writer, clean-up and journal were called
+    # with, in order
+    calls = []
+
+    def write_behav(*args, runs=None, log=None, **kwargs):
+        for behav_run in runs:
+            calls.append(('run', behav_run['run']))
+            log.append((behav_run['path'], Path('out') / behav_run['run']))
+
+    monkeypatch.setattr(session_tools, 'get_fmri_scans', lambda *args: [])
+    monkeypatch.setattr(session_tools, '_write_fmri_scans',
+                        lambda *args: session_tools._new_task_stats())
+    monkeypatch.setattr(session_tools, 'write_behav', write_behav)
+    monkeypatch.setattr(session_tools, 'clear_behav_events',
+                        lambda *args: calls.append(('clear',)))
+    monkeypatch.setattr(session_tools, 'make_write_log',
+                        lambda ins, outs, modality, log_dir: calls.append(('log', modality, outs)))
+    return calls
+
+
+@pytest.mark.parametrize('run_jobs', [1, 2])
+def test_behav_session_work_done_once(unit, calls, run_jobs):
+    stats = write_session(unit, dict(SETTINGS, run_jobs=run_jobs), None)
+
+    assert calls[0] == ('clear',)
+    assert sorted(calls[1:3]) == [('run', '001'), ('run', '002')]
+    assert calls[3:] == [('log', 'behav', [Path('out/001'), Path('out/002')])]
+    # The journal pairs aren't part of the stats
+    assert 'behav_log' not in stats
+
+
+def test_unit_events_dropped(unit, calls, monkeypatch):
+    monkeypatch.setattr(event_cache, '_events', {})
+    for subject in ['001', '002']:
+        put_events(run_key(subject, '-999', 'GradCPT', '001'), None, {}, 500.0)
+
+    write_session(unit, dict(SETTINGS, run_jobs=1), None)
+
+    assert list(event_cache._events) == [('002', '', 'GradCPT', '001')]
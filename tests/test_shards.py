@@ -0,0 +1,122 @@
+import random
+import pytest
+from pathlib import Path
+from helpers.inventory import Inventory
+from helpers.shards import (assign_shards, select_shard, unit_key, create_split, load_split,
+                            get_shard_dir, save_shard_results, merge_shards,
+                            SHARDS_DIR, RESULTS_FILE)
+from helpers.basic_parsing import parse_shard
+
+
+def _units(sizes):
+    return [{'subject': '{:03d}'.format(i), 'size': size} for i, size in enumerate(sizes)]
+
+
+def test_largest_first_to_the_lightest_shard():
+    units = _units([10, 50, 30, 20, 40])
+    # 50 -> 1, 40 -> 2, 30 -> 2 (40 < 50), 20 -> 1 (50 < 70), 10 -> 1 (tie
+    # at 70, lowest shard)
+    assert assign_shards(units, 2) == [1, 1, 2, 1, 2]
+
+
+def test_same_split_every_time():
+    rng = random.Random(0)
+    units = _units([rng.choice([1, 2, 3, 5, 8]) * 1000 for _ in range(40)])
+    first = assign_shards(units, 7)
+    for _ in range(5):
+        assert assign_shards([dict(x) for x in units], 7) == first
+
+
+def test_ties_go_in_serial_order():
+    units = _units([5, 5, 5, 5])
+    assert assign_shards(units, 2) == [1, 2, 1, 2]
+    assert assign_shards(units, 3) == [1, 2, 3, 1]
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 8])
+def test_shards_partition_the_units(count):
+    rng = random.Random(count)
+    units = _units([rng.randint(1, 10 ** 6) for _ in range(25)])
+    picked = []
+    for index in range(1, count + 1):
+        shard = select_shard(units, index, count)
+        # Each shard keeps serial order
+        assert shard == [x for x in units if x in shard]
+        picked += [x['subject'] for x in shard]
+    assert sorted(picked) == [x['subject'] for x in units]
+
+
+def test_balanced():
+    rng = random.Random(1)
+    units = _units([rng.randint(1, 100) for _ in range(200)])
+    loads = [sum(x['size'] for x in select_shard(units, i, 4)) for i in range(1, 5)]
+    # Greedy largest-first: no shard is more than one unit heavier
+    assert max(loads) - min(loads) <= 100
+
+
+def test_parse_shard():
+    assert parse_shard('3/8') == (3, 8)
+    for value in ['0/8', '9/8', '3', 'a/b']:
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def _split_units(tmp_path, sizes):
+    # Units with the fields a split saves
+    inventory = Inventory(tmp_path)
+    return [dict(x, session='-999', seek_path=tmp_path, write_path=tmp_path,
+                 dest_path=tmp_path, subject_arg=Path('sub-' + x['subject']),
+                 session_arg=Path(''), inventory=inventory)
+            for x in _units(sizes)]
+
+
+def test_first_split_stands(tmp_path):
+    units = _split_units(tmp_path, [10, 20, 30])
+    create_split(tmp_path, 2, units, {'overwrite': True})
+    # A later shard whose own scan found other sizes
+    create_split(tmp_path, 2, _split_units(tmp_path, [30, 20, 10, 5]), {'overwrite': False})
+
+    loaded, settings = load_split(tmp_path, 2)
+
+    assert settings == {'overwrite': True}
+    assert [x['size'] for x in loaded] == [10, 20, 30]
+    assert loaded[0]['seek_path'] == tmp_path
+    assert [unit_key(x) for x in loaded] == ['sub-000', 'sub-001', 'sub-002']
+
+
+def _finish_shards(tmp_path, shards, split):
+    # results.json of shards 1, 2, ... that converted the given unit keys
+    for index, keys in enumerate(shards, start=1):
+        save_shard_results(get_shard_dir(tmp_path, index, len(shards)), [], {}, keys, split)
+    return tmp_path / 'rawdata'
+
+
+def test_merge(tmp_path):
+    split = ['sub-001', 'sub-002', 'sub-003']
+    create_split(tmp_path, 2, [], {})
+    dest_path = _finish_shards(tmp_path, [['sub-002'], ['sub-001', 'sub-003']], split)
+    dest_path.mkdir()
+
+    assert merge_shards(dest_path, 2) == ([], {})
+    assert not (tmp_path / SHARDS_DIR).exists()
+
+
+@pytest.mark.parametrize('shards, split, match', [
+    ([['sub-001', 'sub-002'], ['sub-002', 'sub-003']], ['sub-001', 'sub-002', 'sub-003'],
+     'sub-002 was converted by shards 1 and 2'),
+    ([['sub-002'], ['sub-003']], ['sub-001', 'sub-002', 'sub-003'], 'not converted: sub-001'),
+    ([['sub-002'], ['sub-001', 'sub-004']], ['sub-001', 'sub-002'], 'not in the split: sub-004'),
+])
+def test_merge_refuses_a_bad_split(tmp_path, shards, split, match):
+    dest_path = _finish_shards(tmp_path, shards, split)
+    with pytest.raises(ValueError, match=match):
+        merge_shards(dest_path, 2)
+    # Nothing was merged
+    assert (get_shard_dir(tmp_path, 1, 2) / RESULTS_FILE).exists()
+
+
+def test_merge_refuses_different_splits(tmp_path):
+    save_shard_results(get_shard_dir(tmp_path, 1, 2), [], {}, ['sub-001'], ['sub-001', 'sub-002'])
+    save_shard_results(get_shard_dir(tmp_path, 2, 2), [], {}, ['sub-003'], ['sub-001', 'sub-003'])
+    with pytest.raises(ValueError, match='different lists'):
+        merge_shards(tmp_path / 'rawdata', 2)
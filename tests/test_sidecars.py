@@ -0,0 +1,66 @@
+from helpers.sidecars import dedup_sidecars
+
+
+def _run(rawdata, sub, run, sidecar):
+    # One BOLD run with its JSON sidecar
+    func = rawdata / 'sub-{}'.format(sub) / 'ses-001' / 'func'
+    func.mkdir(parents=True, exist_ok=True)
+    stem = 'sub-{}_ses-001_task-GradCPT_run-{}_bold'.format(sub, run)
+    (func / (stem + '.nii.gz')).write_bytes(b'')
+    (func / (stem + '.json')).write_text(sidecar)
+    return func / (stem + '.json')
+
+
+def _sidecars(rawdata):
+    return sorted(str(x.relative_to(rawdata)) for x in rawdata.rglob('*.json'))
+
+
+def test_identical_sidecars_go_to_root(tmp_path):
+    for sub in ['001', '002']:
+        for run in ['001', '002']:
+            _run(tmp_path, sub, run, '{"RepetitionTime": 2}')
+
+    counts = dedup_sidecars(tmp_path)
+
+    assert counts == {'before': 4, 'after': 1}
+    assert _sidecars(tmp_path) == ['task-GradCPT_bold.json']
+    assert (tmp_path / 'task-GradCPT_bold.json').read_text() == '{"RepetitionTime": 2}'
+
+
+def test_differing_subject_stays_below(tmp_path):
+    for run in ['001', '002']:
+        _run(tmp_path, '001', run, '{"RepetitionTime": 2}')
+        _run(tmp_path, '002', run, '{"RepetitionTime": 1}')
+
+    dedup_sidecars(tmp_path)
+
+    assert _sidecars(tmp_path) == [
+        'sub-001/ses-001/func/sub-001_ses-001_task-GradCPT_bold.json',
+        'sub-002/ses-001/func/sub-002_ses-001_task-GradCPT_bold.json']
+
+
+def test_one_odd_run_keeps_its_own(tmp_path):
+    for sub in ['001', '002']:
+        _run(tmp_path, sub, '001', '{"RepetitionTime": 2}')
+    odd = _run(tmp_path, '002', '002', '{"RepetitionTime": 3}')
+
+    dedup_sidecars(tmp_path)
+
+    assert odd.read_text() == '{"RepetitionTime": 3}'
+    assert 'task-GradCPT_bold.json' not in _sidecars(tmp_path)
+
+
+def test_new_run_folds_back_out(tmp_path):
+    # A re-run adding a different run splits the inherited file back up
+    for sub in ['001', '002']:
+        _run(tmp_path, sub, '001', '{"RepetitionTime": 2}')
+    dedup_sidecars(tmp_path)
+    assert _sidecars(tmp_path) == ['task-GradCPT_bold.json']
+    _run(tmp_path, '001', '002', '{"RepetitionTime": 3}')
+
+    counts = dedup_sidecars(tmp_path)
+
+    assert counts == {'before': 2, 'after': 3}
+    for sidecar in _sidecars(tmp_path):
+        expected = '3' if 'run-002' in sidecar else '2'
+        assert (tmp_path / sidecar).read_text() == '{"RepetitionTime": %s}' % expected
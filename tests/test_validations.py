@@ -0,0 +1,89 @@
+import json
+import pytest
+from helpers import validations
+from helpers.validations import final_validation, VALIDATION_CACHE, VALIDATION_REPORT
+
+
+FILES = ['sub-001/eeg/sub-001_task-GradCPT_eeg.vhdr',
+         'sub-001/eeg/sub-001_task-GradCPT_eeg.json',
+         'sub-001/eeg/not_bids.txt',
+         'sub-001/beh/sub-001_task-GradCPT_beh.tsv']
+
+
+@pytest.fixture
+def rawdata(tmp_path):
+    rawdata = tmp_path / 'rawdata'
+    for name in FILES:
+        (rawdata / name).parent.mkdir(parents=True, exist_ok=True)
+        (rawdata / name).write_text('x')
+    return rawdata
+
+
+@pytest.fixture
+def checked(monkeypatch):
+    # Paths given to the validator, per final_validation call
+    calls = []
+    real = validations._validate_chunk
+    def spy(paths):
+        calls.extend(paths)
+        return real(paths)
+    monkeypatch.setattr(validations, '_validate_chunk', spy)
+    return calls
+
+
+def test_verdicts_and_report(rawdata, checked):
+    final_validation(rawdata)
+
+    report = json.loads((rawdata.parent / VALIDATION_REPORT).read_text())
+    assert report['valid'] == 2
+    assert report['invalid'] == 1
+    assert report['skipped'] == 1
+    assert report['files']['/sub-001/eeg/not_bids.txt'] == 'invalid'
+    assert len(checked) == 3
+
+
+def test_unchanged_files_not_checked_again(rawdata, checked):
+    final_validation(rawdata)
+    del checked[:]
+
+    final_validation(rawdata)
+
+    assert checked == []
+    report = json.loads((rawdata.parent / VALIDATION_REPORT).read_text())
+    assert report['valid'] == 2
+
+
+def test_only_new_paths_checked(rawdata, checked):
+    final_validation(rawdata)
+    del checked[:]
+    # The verdict depends on the path only, so a rewrite keeps it
+    (rawdata / FILES[1]).write_text('changed')
+    (rawdata / 'sub-001/eeg/sub-001_task-Other_eeg.vhdr').write_text('x')
+
+    final_validation(rawdata)
+
+    assert checked == ['/sub-001/eeg/sub-001_task-Other_eeg.vhdr']
+    report = json.loads((rawdata.parent / VALIDATION_REPORT).read_text())
+    assert report['valid'] == 3
+
+
+def test_removed_paths_dropped(rawdata, checked):
+    final_validation(rawdata)
+    (rawdata / FILES[2]).unlink()
+
+    final_validation(rawdata)
+
+    cache = json.loads((rawdata / VALIDATION_CACHE).read_text())
+    assert '/' + FILES[2] not in cache['verdicts']
+
+
+def test_other_validator_version_discarded(rawdata, checked):
+    final_validation(rawdata)
+    cache = json.loads((rawdata / VALIDATION_CACHE).read_text())
+    cache['validator'] = 'old'
+    (rawdata / VALIDATION_CACHE).write_text(json.dumps(cache))
+    del checked[:]
+
+    final_validation(rawdata)
+
+    assert len(checked) == 3
@@ -0,0 +1,97 @@
+import os
+import time
+import pytest
+from helpers import work_queue
+from helpers.work_queue import (_claim, _scan, _now, _release, _save, get_queue_dir,
+                                LEASE_SECONDS)
+
+
+@pytest.fixture
+def queue_dir(tmp_path):
+    queue_dir = get_queue_dir(tmp_path)
+    for name in ['claims', 'done', 'failed']:
+        os.makedirs(queue_dir / name)
+    return queue_dir
+
+
+def _try_claim(queue_dir, name, worker):
+    claims = _scan(queue_dir)[2]
+    return _claim(queue_dir, name, worker, claims, _now(queue_dir, worker))
+
+
+def _age(path, seconds):
+    # Make a claim look as if it was last renewed `seconds` ago
+    mtime = os.stat(path).st_mtime - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_only_one_worker_claims_an_item(queue_dir):
+    lease = _try_claim(queue_dir, 'sub-001_eeg', 'host-1')
+    assert lease is not None
+    assert lease.path.name == 'sub-001_eeg.1'
+    assert lease.path.read_text() == 'host-1'
+    assert _try_claim(queue_dir, 'sub-001_eeg', 'host-2') is None
+    # Other items are still free
+    assert _try_claim(queue_dir, 'sub-001_fmri', 'host-2') is not None
+
+
+def test_claims_race_on_the_file(queue_dir):
+    # Both scanned before either claimed: O_EXCL lets only one through
+    claims = _scan(queue_dir)[2]
+    now = _now(queue_dir, 'host-1')
+    first = _claim(queue_dir, 'sub-001_eeg', 'host-1', claims, now)
+    second = _claim(queue_dir, 'sub-001_eeg', 'host-2', claims, now)
+    assert first is not None and second is None
+
+
+def test_live_lease_is_kept(queue_dir):
+    lease = _try_claim(queue_dir, 'sub-001_eeg', 'host-1')
+    _age(lease.path, LEASE_SECONDS - 60)
+    assert _try_claim(queue_dir, 'sub-001_eeg', 'host-2') is None
+    # A renewal resets the age
+    _age(lease.path, LEASE_SECONDS + 60)
+    lease.renew()
+    assert not lease.lost
+    assert _try_claim(queue_dir, 'sub-001_eeg', 'host-2') is None
+
+
+def test_expired_lease_is_taken_over(queue_dir):
+    stalled = _try_claim(queue_dir, 'sub-001_eeg', 'host-1')
+    _age(stalled.path, LEASE_SECONDS + 60)
+
+    taken = _try_claim(queue_dir, 'sub-001_eeg', 'host-2')
+    assert taken is not None
+    assert taken.path.name == 'sub-001_eeg.2'
+    # Only one worker takes it over
+    assert _try_claim(queue_dir, 'sub-001_eeg', 'host-3') is None
+
+    # The stalled worker finds out when it next renews
+    stalled.renew()
+    assert stalled.lost
+    taken.renew()
+    assert not taken.lost
+
+
+def test_done_items_are_not_claimed(queue_dir):
+    lease = _try_claim(queue_dir, 'sub-001_eeg', 'host-1')
+    _save(queue_dir / 'done' / 'sub-001_eeg.json', '{}')
+    _release(queue_dir, 'sub-001_eeg')
+    assert not os.path.exists(lease.path)
+
+    done, failed, claims = _scan(queue_dir)
+    assert done == {'sub-001_eeg'} and not failed and not claims
+    # Even with a stale scan that still shows no claim
+    assert _claim(queue_dir, 'sub-001_eeg', 'host-2', {}, _now(queue_dir, 'host-2')) is None
+
+
+def test_heartbeat_renews_the_claim(queue_dir, monkeypatch):
+    monkeypatch.setattr(work_queue, 'HEARTBEAT_SECONDS', 0.01)
+    lease = _try_claim(queue_dir, 'sub-001_eeg', 'host-1')
+    _age(lease.path, LEASE_SECONDS + 60)
+    stale = os.stat(lease.path).st_mtime
+    with lease:
+        deadline = time.time() + 5
+        while os.stat(lease.path).st_mtime == stale and time.time() < deadline:
+            time.sleep(0.01)
+    # Renewed within the block, so no one else can take it
+    assert _try_claim(queue_dir, 'sub-001_eeg', 'host-2') is None
@@ -2,36 +2,47 @@
 # Dave Braun (2024)
 import os
 import sys
-from tqdm import tqdm
-from glob import glob
-from collections import OrderedDict
-import json
 from pathlib import Path
-from mne_bids.path import BIDSPath
 # Import custom modules
 from helpers.validations import ValidateBasics, final_validation
 from helpers.validations import validate_task_names
-from helpers.modality_specific import (
-        get_eeg_json, 
-        get_channels_tsv,
-        get_electrodes_tsv
-)
 from helpers.basic_parsing import (
         parse_command_line, 
         parse_subjects, 
-        parse_data_type,
-        make_skeleton,
-        configure_progress_bar,
         get_overwrite
 )
-from writers.eeg_tools import (
-        write_eeg,
-        delete_eeg_events
+from writers.session_tools import (
+        get_session_units,
+        write_session
+)
+from helpers.parallel import run_parallel, run_queue_workers
+from helpers.metadata import make_metadata, finalize_write_logs
+from helpers.inventory import Inventory
+from helpers.pgzip import new_stats, add_stats, compression_report, get_backend
+from helpers.placement import placement_report, write_placement_log
+from helpers.sidecars import dedup_sidecars, sidecar_report
+from helpers.plan import make_plan, plan_report, save_plan, load_plan
+from helpers.throughput import new_timings, add_timings, save_throughput
+from helpers.progress import configure_progress_bar
+from helpers.trace import start_trace, span
+from helpers.shards import (
+        select_shard,
+        unit_key,
+        get_shard_dir,
+        get_split_file,
+        create_split,
+        load_split,
+        save_shard_results,
+        merge_shards
+)
+from helpers.work_queue import (
+        queue_state,
+        create_queue,
+        load_queue,
+        run_worker,
+        finish_queue,
+        get_queue_dir
 )
-from helpers.mne_bids_mods import _write_dig_bids
-from writers.fmri_tools import (write_fmri, get_fmri_root)
-from helpers.metadata import make_metadata
-from writers.behav_tools import write_behav
 
 
 '''
@@ -42,111 +53,277 @@ A destination directory can optionally be provided
 Otherwise, destination directory will be the dataset name (set in the
 dataset_description.json) with suffix _BIDS
 
+--jobs N converts N subject / session units at a time on a process pool
+--run-jobs N converts N runs of a session at a time (each behavioral run
+after the EEG run it is synced to); with mne-bids, EEG runs are still
+written one at a time, so this speeds up NIfTI images and behavioral runs
+--threads N gzips each NIfTI (and converts each EDF) on N threads
+(default: CPU count / jobs)
+--compress-level / --compress-backend / --no-compress pick how NIfTI images
+are compressed (a speed / ratio summary is printed at the end)
+--read-depth / --write-depth bound how far NIfTI reading runs ahead of
+compression and writing behind it (the stages overlap)
+--placement auto hardlinks / reflinks unchanged files into the output
+instead of copying them (placement_log.tsv lists the method per file)
+--dedup-sidecars replaces identical per-run sidecars with one file at the
+highest BIDS inheritance level (eg, task-GradCPT_events.json at the root)
+--incremental only regenerates outputs whose sources changed (--hash to
+compare contents when just the mtime changed)
+--overwrite / --no-overwrite, --expect-subjects N and --expect-tasks A,B
+answer the questions asked along the way; with --yes anything not answered
+is a yes, with --non-interactive it's an error. --config FILE reads any
+option from a JSON file (for unattended / cluster jobs)
+--plan prints every output a run would write, with sizes and an estimated
+time, without writing anything; --plan-file FILE also saves it as JSON and
+--from-plan FILE converts exactly what a saved plan lists
+--shard i/N converts only shard i of N (balanced by size, eg one per array
+job) and --merge-shards N then combines them and writes the dataset-level
+files
+--queue works from a queue in the destination shared by every tobids
+started with --queue, on any host (workers that die hand their work back);
+once it is empty one of them writes the dataset-level files
+--trace FILE saves how long each subject / session / modality / run / stage
+took as Chrome trace-event JSON, to open in Perfetto
+
 
 '''
 
 # Decide whether to write raw data to .edf or just copy it as is
 make_edf = False
+# Format for make_edf: '.edf' (16 bit EDF+) or '.bdf' (24 bit BDF+)
+edf_type = '.edf'
 # Rely on mne_bids for writing eeg data and meta data?
 use_mne_bids = True
 
 if __name__ == '__main__':
 
     # Parse user command line input
-    origin_path, dest_path = parse_command_line(sys.argv[1:])
-
-    # Put everthing inside 'rawdata'
-    dest_path = dest_path / Path('rawdata')
-
-    # Whether to overwrite existing data
-    overwrite = get_overwrite()
-
-    # Initialize and run basic validation
-    # see helpers/validation.py
-    vb = ValidateBasics(origin_path)
-    vb.confirm_subject_count()
-    vb.confirm_subject_data()
-
-    # Get subject info
-    # list of dict (each subject is element) with keys
-        # number, path, sessions
-        # sessions is a dict with key session number and value as path
-    subjects = parse_subjects(origin_path)
-
-    # Check with user
-    validate_task_names(subjects, origin_path)
-    
-    # Init progress bar
-    progress_bar = configure_progress_bar(origin_path)
-
-    # Iterate over subjects
-    for subject in subjects:
-        print('\nProcessing Subject {}'.format(subject['number']))
-
-        # Handle sessions
-        if subject['sessions']:
-            sessions = list(subject['sessions'].keys())
+    origin_path, dest_path, options = parse_command_line(sys.argv[1:])
+
+    # Record where the time goes (saved at exit); worker processes put
+    # their part in trace_parts
+    # see helpers/trace.py
+    trace_parts = None
+    if options['trace']:
+        trace_parts = start_trace(options['trace'])
+
+    # A finished queue isn't started over by a worker that comes late
+    if options['queue'] and queue_state(dest_path) == 'finished':
+        print('The queue in {} is finished; remove it to convert again.'.format(get_queue_dir(dest_path)))
+        sys.exit(0)
+
+    if options['merge_shards']:
+        # The shards did the converting; fold their own files into the
+        # dataset and finish up below
+        # see helpers/shards.py
+        dest_path = dest_path / Path('rawdata')
+        with span('merge shards'):
+            results, compression = merge_shards(dest_path, options['merge_shards'])
+        settings = {'compression': compression}
+    else:
+        sharded = False
+        if options['from_plan']:
+            # Everything was worked out (and asked) when the plan was made
+            # see helpers/plan.py
+            plan, units = load_plan(options['from_plan'])
+            origin_path = Path(plan['origin'])
+            dest_path = Path(plan['dest'])
+            # Threads (and the memory the pipeline may use) depend on the
+            # machine doing the work, not the one planning
+            settings = dict(plan['settings'], threads=options['threads'],
+                            run_jobs=options['run_jobs'], pipeline=options['pipeline'],
+                            trace=trace_parts)
+            settings['compression']['backend'] = get_backend(settings['compression']['backend'])
+            # A shard's plan only holds that shard's units
+            if plan['shard'] is not None:
+                if options['shard'] is not None:
+                    raise ValueError('{} is already the plan of shard {}/{}'.format(
+                        options['from_plan'], *plan['shard']))
+                options['shard'] = tuple(plan['shard'])
+                split = plan['split']
+                sharded = True
+        elif options['queue'] and queue_state(dest_path) == 'open':
+            # Join the queue another worker set up (its settings and
+            # answers stand; nothing to scan or ask)
+            dest_path = dest_path / Path('rawdata')
+        elif options['shard'] and os.path.exists(get_split_file(dest_path, options['shard'][1])):
+            # Take a share of the split the first shard saved (likewise)
+            dest_path = dest_path / Path('rawdata')
         else:
-            sessions = ['-999']
+            # Put everthing inside 'rawdata'
+            dest_path = dest_path / Path('rawdata')
 
-        # Iterate over sessions
-        for session in sessions:
-            if sessions[0] == '-999':
-                session_path = Path('')
-                session_arg = Path('')
+            # Whether to overwrite existing data
+            # (incremental mode decides per output instead)
+            if options['incremental']:
+                overwrite = False
             else:
-                session_path = subject['sessions'][session]
-                session_arg = Path('ses-' + session)
-
-            seek_path = origin_path / subject['path'] / session_path
-            # Build write path
-            subject_arg = Path('sub-' + subject['number'])
-
-            write_path = dest_path / subject_arg / session_arg
-
-            # Determine whether there is eeg and / or fmri data
-            eeg, fmri, behav = parse_data_type(seek_path)
-
-            if behav and not fmri:
-                raise ValueError('tobids is only configured to process behavioral data when fMRI data are present.')
-
-            if eeg:
-                print('Writing EEG data')
-                # Get all *.eeg files for that subject/session
-                eeg_files = glob(str(seek_path) + '/**/*.eeg', recursive=True)
-                eeg_files = [Path(x) for x in eeg_files]
-                write_eeg(eeg_files, 
-                          write_path, 
-                          make_edf,
-                          overwrite,
-                          use_mne_bids,
-                          progress_bar)
-                # Clear out mne-bids created events
-                delete_eeg_events(subject['number'], session, write_path)
-
-            if fmri:
-                print('Writing fMRI data')
-                # Get root fmri dir 
-                # (the one with all the fmri dirs from the scan nested inside)
-                fmri_root = get_fmri_root(seek_path)
-                meta_info = {'subject': str(subject_arg), 'session': str(session_arg)}
-                write_fmri(fmri_root, write_path, meta_info, overwrite, progress_bar)
-    
-            if behav:
-                print('Writing behavioral data')
-                write_behav(subject['number'], 
-                    session, # Goes in as -999 if no sessions
-                    seek_path,
-                    dest_path, # writedir/rawdata
-                    overwrite,
-                    eeg,
-                    fmri)
+                overwrite = get_overwrite(options)
 
+            # Scan the origin tree once; everything below queries this
+            # Unchanged dirs are read back from the cache of the last run
+            # (a plan only reads the cache, it writes nothing; each shard
+            # keeps its own; queue workers leave it alone)
+            # see helpers/inventory.py
+            cache = dest_path / Path('.tobids_cache')
+            if options['shard']:
+                cache = get_shard_dir(dest_path.parent, *options['shard']) / Path('inventory_cache')
+            with span('scan origin'):
+                inventory = Inventory(origin_path, cache=cache,
+                                      update_cache=not (options['plan'] or options['queue']))
 
-    # Make metadata if it doesn't exist
-    make_metadata(dest_path)
+            # Initialize and run basic validation
+            # see helpers/validation.py
+            with span('validate origin'):
+                vb = ValidateBasics(origin_path, inventory)
+                vb.confirm_subject_count(options)
+                vb.confirm_subject_data()
 
-    # Validate final directory
-    final_validation(dest_path)
+            # Get subject info
+            # list of dict (each subject is element) with keys
+                # number, path, sessions
+                # sessions is a dict with key session number and value as path
+            subjects = parse_subjects(origin_path, inventory)
+
+            # Check with user
+            validate_task_names(subjects, origin_path, inventory, options)
+
+            # One unit of work per subject / session
+            with span('find units'):
+                units = get_session_units(subjects, origin_path, dest_path, inventory)
+            settings = {'make_edf': make_edf,
+                        'edf_type': edf_type,
+                        'use_mne_bids': use_mne_bids,
+                        'overwrite': overwrite,
+                        'threads': options['threads'],
+                        'run_jobs': options['run_jobs'],
+                        'compression': options['compression'],
+                        'pipeline': options['pipeline'],
+                        'placement': options['placement'],
+                        'incremental': options['incremental'],
+                        'use_hash': options['use_hash'],
+                        'shard_dir': None,
+                        'trace': trace_parts}
+
+        # Only this shard's share of the units, out of the one split every
+        # shard uses: the first shard saves its units (and settings), the
+        # rest take them as they are (a plan only reads the split)
+        # see helpers/shards.py
+        if options['shard'] and not sharded:
+            count = options['shard'][1]
+            if not options['plan'] and not os.path.exists(get_split_file(dest_path.parent, count)):
+                create_split(dest_path.parent, count, units, settings)
+            if os.path.exists(get_split_file(dest_path.parent, count)):
+                units, settings = load_split(dest_path.parent, count)
+                # Threads, pipeline depths and the deflate backend are this host's
+                settings = dict(settings, threads=options['threads'], run_jobs=options['run_jobs'],
+                                pipeline=options['pipeline'], trace=trace_parts)
+                settings['compression']['backend'] = get_backend(settings['compression']['backend'])
+            split = [unit_key(x) for x in units]
+            units = select_shard(units, *options['shard'])
+
+        # Dry run: list the work and stop
+        if options['plan']:
+            plan = make_plan(units, settings, origin_path, dest_path, options['jobs'],
+                             shard=options['shard'],
+                             split=split if options['shard'] else None)
+            print(plan_report(plan))
+            if options['plan_file']:
+                save_plan(plan, options['plan_file'])
+                print('Plan saved to {}'.format(options['plan_file']))
+            sys.exit(0)
+
+        if options['queue']:
+            # Take items from the shared queue until there are none left
+            # see helpers/work_queue.py
+            if queue_state(dest_path.parent) is None:
+                create_queue(dest_path.parent, units, settings)
+            items, units, settings = load_queue(dest_path.parent)
+            # Threads, pipeline depths and the deflate backend are this host's
+            settings = dict(settings, threads=options['threads'], run_jobs=options['run_jobs'],
+                            pipeline=options['pipeline'], trace=trace_parts)
+            settings['compression']['backend'] = get_backend(settings['compression']['backend'])
+            with span('size units'):
+                progress_bar = configure_progress_bar(units, settings, dest_path.parent,
+                                                      options['jobs'] * settings['run_jobs'])
+            if options['jobs'] > 1:
+                run_queue_workers(dest_path.parent, items, units, settings, options['jobs'],
+                                  progress_bar)
+            else:
+                run_worker(dest_path.parent, items, units, settings, progress_bar)
+            progress_bar.close()
+
+            # The worker that claims the merge finishes up below
+            with span('finish queue'):
+                finished = finish_queue(dest_path.parent)
+            if finished is None:
+                print('\nThe queue is empty; another worker is writing the dataset-level files.')
+                sys.exit(0)
+            results, compression = finished
+            settings = {'compression': compression}
+        else:
+            # Init progress bar (over the source bytes of the units)
+            with span('size units'):
+                progress_bar = configure_progress_bar(units, settings, dest_path.parent,
+                                                      options['jobs'] * settings['run_jobs'])
+
+            # A shard keeps the files other shards would also write to itself
+            if options['shard']:
+                settings['shard_dir'] = get_shard_dir(dest_path.parent, *options['shard'])
+
+            if options['jobs'] > 1:
+                results = run_parallel(units, settings, options['jobs'], progress_bar)
+            else:
+                results = []
+                last_subject = None
+                for unit in units:
+                    if unit['subject'] != last_subject:
+                        print('\nProcessing Subject {}'.format(unit['subject']))
+                        last_subject = unit['subject']
+                    results.append(write_session(unit, settings, progress_bar))
+            progress_bar.close()
+
+            # The dataset-level steps wait for --merge-shards
+            if options['shard']:
+                save_shard_results(settings['shard_dir'], results, settings['compression'],
+                                   [unit_key(x) for x in units], split)
+                print('\nShard {}/{} done ({} subject / session units). Once all {} '
+                      'shards are done, run tobids with --merge-shards {}.'.format(
+                          *options['shard'], len(units), options['shard'][1], options['shard'][1]))
+                sys.exit(0)
 
+    # Report how the NIfTI compression went
+    nifti_stats = new_stats()
+    for result in results:
+        add_stats(nifti_stats, result['nifti'])
+    print('\n' + compression_report(nifti_stats, settings['compression']))
 
+    # Keep this run's throughput for the estimates of later plans
+    timings = new_timings()
+    for result in results:
+        add_timings(timings, result['timings'])
+    save_throughput(dest_path.parent, timings)
+
+    # Merge identical sidecars into inherited ones
+    if options['dedup_sidecars']:
+        with span('dedup sidecars'):
+            print(sidecar_report(dedup_sidecars(dest_path)))
+
+    # And how each unchanged file got into the output (leaving out sidecars
+    # merged away just above)
+    placements = [x for result in results for x in result['placements']
+                  if os.path.exists(x[1])]
+    write_placement_log(placements, dest_path.parent)
+    print(placement_report(placements))
+
+    # Make metadata if it doesn't exist
+    with span('metadata'):
+        make_metadata(dest_path)
+
+    # Build the readable conversion logs from the journals
+    with span('conversion logs'):
+        finalize_write_logs(dest_path.parent)
+
+    # Validate final directory
+    with span('final validation'):
+        final_validation(dest_path, options['jobs'])
@@ -2,14 +2,14 @@ import os
 from scipy.io import loadmat
 import sys
 from glob import glob
-import mne
 import warnings
 from pathlib import Path
 import shutil
 import re
 import numpy as np
 import pandas as pd
-from writers.eeg_tools import get_true_event_label
+import time
+from writers.eeg_tools import get_true_event_label, get_event_summary
 from helpers.metadata import make_write_log
 from helpers.behav_task_data import (
     gradcpt_json,
@@ -19,9 +19,16 @@ from helpers.behav_task_data import (
 from writers.eegfmri_behav import get_eegfmri_behav
 import json
 from mne_bids import BIDSPath
+from helpers.inventory import Inventory
+from helpers.fingerprints import needs_write, record
+from helpers.event_cache import get_events, run_key, get_cache_dir
+from helpers.throughput import add_timing
+from helpers.trace import span
 
 
-def write_behav(subject, session, seek_path, dest_path, overwrite, eeg, fmri):
+def write_behav(subject, session, seek_path, dest_path, overwrite, eeg, fmri,
+                inventory=None, incremental=False, use_hash=False, timing=None,
+                shard_dir=None, runs=None, progress_bar=None, log=None):
     '''
     Nested within a subject and session loop
     Moves each behavioral CSV file to its events.tsv BIDS dest in func
@@ -37,6 +44,24 @@ def write_behav(subject, session, seek_path, dest_path, overwrite, eeg, fmri):
     overwrite: boolean indicating whether to overwrite existing data
     eeg (boolean): Whether or not there is EEG data
     fmri (boolean): Whether or not there is fMRI data
+    inventory (helpers.inventory.Inventory): origin inventory to find the
+                behavioral files in (scanned from seek_path if not given)
+    incremental (boolean): Only rewrite runs whose inputs changed (the
+                behavioral file, plus the run's EEG markers if EEG-synced)
+    use_hash (boolean): Compare contents when only the mtime changed
+    timing (dict): if given, the source bytes and seconds of each run
+                written are added to it (see helpers/throughput.py)
+    shard_dir (pathlib.Path): with tobids --shard, where this shard keeps
+                its dataset-level files (see helpers/shards.py)
+    runs (list): only write these runs, as dicts from get_behav_runs
+                (default: all the runs get_behav_runs finds). The caller
+                then does the session's clean-up (clear_behav_events) once,
+                before the first of them
+    progress_bar (ByteProgress): if given, each run's behavioral file is
+                reported to it (see helpers/progress.py)
+    log (list): if given, the (input, output) pairs written are added to it
+                for the caller to journal once per session, instead of
+                being journaled here
 
     ------------
 
@@ -58,152 +83,233 @@ def write_behav(subject, session, seek_path, dest_path, overwrite, eeg, fmri):
     EEG-fMRI...
     '''
 
-    # Find all existing *_events in EEG data and delete
-    path = BIDSPath(subject = subject,
-                    datatype = 'eeg',
-                    suffix = 'events',
-                    extension = '.tsv',
-                    root = dest_path / Path('rawdata'))
-    if session != '-999':
-        path.session = session
-    events = glob(str(path.fpath.parent / Path('*events*')))
-    for event in events:
-        os.remove(event)
+    if runs is None:
+        clear_behav_events(subject, session, dest_path)
 
+    if inventory is None:
+        inventory = Inventory(seek_path)
 
-   # IO
-    ptbps = glob(str(seek_path / Path('**/*ptbP.mat')), recursive=True)
-    ptbps = [(Path(x), 'ptbp') for x in ptbps]
-    ESs = glob(str(seek_path / Path('**/*.csv')), recursive=True)
-    ESs = [x for x in ESs if '_city_mnt_' not in x]
-    ESs = [(Path(x), 'csv') for x in ESs]
-    ESs = ptbps + ESs
-
-    gradcpts = glob(str(seek_path / Path('**/*_city_mnt_*.mat')), recursive=True)
-    gradcpts = [(Path(x), 'gradcpt') for x in gradcpts]
-
-    out_bids = BIDSPath(subject=subject,
-                        suffix='events',
-                        extension='.tsv',
-                        root=dest_path,
-                        check=False)
     # For logging
     ins = []    
     outs = []
 
-    # Update subject and session information
-    ses_string = ''
-    if session != '-999':
-        out_bids.session = session
-        ses_string = 'ses-{}'.format(session)
-
-    sub_string = 'sub-{}'.format(subject)
-
     # Make compact dict of args
     args = {'subject': subject,
             'session': session,
             'dest_path': dest_path}
 
-    _validate_not_identical(gradcpts + ESs)
+    if runs is None:
+        runs = get_behav_runs(subject, session, seek_path, dest_path, eeg, inventory)
 
-    # GradCPT
-    gradcpts = _sort_by_run(gradcpts)
-    for run, gradcpt in enumerate(gradcpts, start=1):
-        # gradcpt is (path, 'type')
-        
-        args['run'] = str(run).zfill(3)
-        mat = loadmat(gradcpt[0])
-        d_eeg, d_fmri = _format_gradcpt(mat, gradcpt_headers, args, eeg)
-
-        # Out dir
-        out_bids.task = 'GradCPT'
-        out_bids.run = str(run).zfill(3)
-        datatypes = ['eeg', 'func']
-
-        # Iterate over EEG/fMRI modalities
+    for behav_run in runs:
+        behav_file = behav_run['path']
+        file_type = behav_run['file_type']
+        run = behav_run['run']
+        sources = behav_run['sources']
+        out_bids = behav_run['out_bids']
+        args['run'] = run
+        if 'eeg' in behav_run['datatypes']:
+            # The run may have been listed before its EEG was written
+            sources = [behav_file] + _get_eeg_sources(args, out_bids.task)
+
+        # Skip the whole run if nothing it writes is out of date
+        if incremental and not _run_needs_write(out_bids, behav_run['datatypes'],
+                                                sources, overwrite, use_hash):
+            if progress_bar is not None:
+                progress_bar.update(os.path.getsize(behav_file), 'behav')
+            continue
+        started = time.perf_counter()
+        written = len(outs)
+
+        # Convert path to data frame
         # (Modality here just refers to which clock the behavioral data is
         # synced to)
-        for d, datatype in zip([d_eeg, d_fmri], datatypes):
-            
+        if file_type == 'gradcpt':
+            with span('loadmat'):
+                mat = loadmat(behav_file)
+            with span('format gradcpt'):
+                d_eeg, d_fmri = _format_gradcpt(mat, gradcpt_headers, args, eeg)
+            d_hold = {'eeg': d_eeg, 'func': d_fmri}
+            sidecar = gradcpt_json
+        elif file_type == 'ptbp':
+            # Assuming this is fMRI only data
+            with span('read ptbp'):
+                d = _format_ptbp(behav_file, args)
+            d_hold = {'func': d}
+            sidecar = es_json
+        elif file_type == 'csv':
+            # Assuming this is EEG-fMRI ES data
+            # Should add some logic down in _format_es somewhere to check
+            # whether it's EEG, fMRI, or both
+            with span('read csv'):
+                d_eeg, d_fmri = _format_es(behav_file, args, dest_path)
+            d_hold = {'eeg': d_eeg, 'func': d_fmri}
+            sidecar = es_json
+        else:
+            raise ValueError('Unable to infer ExperienceSampling data type')
+
+        for datatype, d in d_hold.items():
+
             if d is None:
                 continue
 
             out_bids.datatype = datatype
             out_bids.update(extension = '.tsv')
 
-            if not os.path.exists(out_bids.fpath.parent):
-                os.makedirs(out_bids.fpath.parent)
+            os.makedirs(out_bids.fpath.parent, exist_ok=True)
 
             # Skip if exists and overwrite=False
-            if os.path.exists(out_bids.fpath) and not overwrite:
+            # (or, if incremental, if it's up to date)
+            if not needs_write(out_bids.fpath, sources, overwrite, incremental, use_hash):
                 continue
 
             # Write tsv
-            d.to_csv(out_bids.fpath, index=False, sep='\t')
+            with span('write ' + out_bids.fpath.name):
+                d.to_csv(out_bids.fpath, index=False, sep='\t')
+            if incremental:
+                record(out_bids.fpath, sources, use_hash)
 
             # Logging
-            ins.append(gradcpt[0])
+            ins.append(behav_file)
             outs.append(out_bids.fpath)
 
             # Write json
             out_bids.update(extension='.json')
             with open(out_bids.fpath, 'w') as file:
-                json.dump(gradcpt_json, file, indent=4)
+                json.dump(sidecar, file, indent=4)
             file.close()
 
-    # ESs
-    # Assuming CSV or ptbp
-    # Structure: (data, 'csv' or 'ptbp')
-    ESs = _sort_by_run(ESs)
-    for run, es in enumerate(ESs, start=1):
-        run = str(run).zfill(3)
-        args['run'] = run
+        seconds = time.perf_counter() - started if len(outs) > written else 0.0
+        if timing is not None and seconds:
+            add_timing(timing, sum(os.path.getsize(x) for x in sources), seconds)
+        if progress_bar is not None:
+            progress_bar.update(os.path.getsize(behav_file), 'behav', seconds)
 
-        # Convert path to data frame
-        if es[1] == 'ptbp':
-            # Assuming this is fMRI only data
-            d = _format_ptbp(es[0], args)
-            d_hold = {'func': d}
-        elif es[1] == 'csv':
-            # Assuming this is EEG-fMRI ES data
-            # Should add some logic down in _format_es somewhere to check
-            # whether it's EEG, fMRI, or both
-            d_eeg, d_fmri = _format_es(es[0], args, dest_path)
-            d_hold = {'eeg': d_eeg, 'func': d_fmri}
-        else:
-            raise ValueError('Unable to infer ExperienceSampling data type')
+    # Log writing
+    if log is not None:
+        log += list(zip(ins, outs))
+    elif all([ins, outs]):
+        make_write_log(ins, outs, 'behav', shard_dir)
 
-        # Out dir
-        out_bids.task = 'ExperienceSampling'
-        out_bids.run = run
-        
-        for datatype in d_hold.keys():
-            out_bids.extension = '.tsv'
-            out_bids.datatype = datatype
 
-            if os.path.exists(out_bids.fpath) and not overwrite:
-                continue
+def clear_behav_events(subject, session, dest_path):
+    '''
+    Session-level clean-up before the behavioral runs are written (once per
+    subject / session, whether the runs go in one write_behav call or one
+    each)
+    dest_path: *_BIDS/rawdata as pathlib.Path
+    '''
 
-            if not os.path.exists(out_bids.fpath.parent):
-                os.makedirs(out_bids.fpath.parent)
+    # Find all existing *_events in EEG data and delete
+    path = BIDSPath(subject = subject,
+                    datatype = 'eeg',
+                    suffix = 'events',
+                    extension = '.tsv',
+                    root = dest_path / Path('rawdata'))
+    if session != '-999':
+        path.session = session
+    events = glob(str(path.fpath.parent / Path('*events*')))
+    for event in events:
+        os.remove(event)
 
-            # Write tsv
-            d_hold[datatype].to_csv(out_bids.fpath, index=False, sep='\t')
 
-            # Logging
-            ins.append(es[0])
-            outs.append(out_bids.fpath)
+def get_behav_runs(subject, session, seek_path, dest_path, eeg, inventory):
+    '''
+    Finds the behavioral files of one subject / session (see the
+    assumptions in write_behav)
+    Returns a dict per run, GradCPT runs first, with
+        path: the behavioral file
+        file_type: 'gradcpt', 'ptbp' or 'csv'
+        run: run number string with three zero pads
+        datatypes: the dirs an events.tsv is written to ('eeg', 'func')
+        sources: the files the run's events.tsv are made from (the
+                 EEG-synced ones also read the run's converted EEG markers,
+                 if they've been written)
+        out_bids: BIDSPath of the run's events (datatype / extension unset)
+    '''
 
-            # Write json
-            out_bids.extension = '.json'
-            with open(out_bids.fpath, 'w') as file:
-                json.dump(es_json, file, indent=4)
-            file.close()
+    ptbps = inventory.files(seek_path, pattern='*ptbP.mat')
+    ptbps = [(x.path, 'ptbp') for x in ptbps]
+    ESs = inventory.files(seek_path, extension='.csv')
+    ESs = [x for x in ESs if '_city_mnt_' not in str(x.path)]
+    ESs = [(x.path, 'csv') for x in ESs]
+    ESs = ptbps + ESs
 
+    gradcpts = inventory.files(seek_path, pattern='*_city_mnt_*.mat')
+    gradcpts = [(x.path, 'gradcpt') for x in gradcpts]
 
-    # Log writing
-    if all([ins, outs]):
-        make_write_log(ins, outs, 'behav')
+    _validate_not_identical(gradcpts + ESs)
+
+    args = {'subject': subject,
+            'session': session,
+            'dest_path': dest_path}
+    runs_out = []
+
+    # GradCPT, then ESs (CSV or ptbp), each numbered in run order
+    for task, behav_files in [('GradCPT', _sort_by_run(gradcpts)),
+                              ('ExperienceSampling', _sort_by_run(ESs))]:
+        for run, (behav_file, file_type) in enumerate(behav_files, start=1):
+            run = str(run).zfill(3)
+            args['run'] = run
+
+            out_bids = BIDSPath(subject=subject,
+                                task=task,
+                                run=run,
+                                suffix='events',
+                                root=dest_path,
+                                check=False)
+            if session != '-999':
+                out_bids.session = session
+
+            if file_type == 'ptbp':
+                sources = [behav_file, _get_underp_path(behav_file, args)]
+                datatypes = ['func']
+            elif file_type == 'gradcpt' and not eeg:
+                sources = [behav_file]
+                datatypes = ['func']
+            else:
+                sources = [behav_file] + _get_eeg_sources(args, task)
+                datatypes = ['eeg', 'func']
+
+            runs_out.append({'path': behav_file,
+                             'file_type': file_type,
+                             'run': run,
+                             'datatypes': datatypes,
+                             'sources': sources,
+                             'out_bids': out_bids})
+
+    return runs_out
+
+
+def _run_needs_write(out_bids, datatypes, sources, overwrite, use_hash):
+    # True if any of the run's events.tsv (one per datatype) needs writing
+
+    for datatype in datatypes:
+        dest = out_bids.copy().update(datatype=datatype, extension='.tsv').fpath
+        if needs_write(dest, sources, overwrite, True, use_hash):
+            return True
+    return False
+
+
+def _get_eeg_sources(args, task):
+    '''
+    Returns the already-converted EEG header and markers for this run
+    (the EEG-synced behavioral timing is read from them)
+    Empty list if they haven't been written
+    '''
+
+    eeg_path = BIDSPath(subject = args['subject'],
+                        run = args['run'],
+                        task = task,
+                        suffix = 'eeg',
+                        datatype = 'eeg',
+                        extension = '.vhdr',
+                        root = args['dest_path'])
+    if args['session'] != '-999':
+        eeg_path.session = args['session']
+
+    out = [eeg_path.fpath, eeg_path.copy().update(extension='.vmrk').fpath]
+    return [x for x in out if os.path.exists(x)]
 
 
 def _validate_not_identical(paths):
@@ -309,12 +415,17 @@ def _format_gradcpt(mat, gradcpt_headers, args, eeg):
         if args['session'] != '-999':
             eeg_path.session = args['session']
 
-        raw = mne.io.read_raw_brainvision(eeg_path.fpath)
-        events, event_id = mne.events_from_annotations(raw)
+        # Events were kept when the EEG run was written
+        # (see helpers/event_cache.py)
+        key = run_key(args['subject'], args['session'], 'GradCPT', args['run'])
+        events, event_id, sfreq = get_events(key, eeg_path.fpath,
+                                             get_cache_dir(args['dest_path']))
         raw_onsets = mat['data'][:, 8]
 
         # Extract event onset label from EEG data
-        stim_label = get_true_event_label(events, event_id, task='GradCPT')
+        summary = get_event_summary(events)
+        stim_label = get_true_event_label(events, event_id, task='GradCPT',
+                                          summary=summary)
 
         # If no event labels are found, fill in NAs
         if stim_label is None:
@@ -334,14 +445,15 @@ def _format_gradcpt(mat, gradcpt_headers, args, eeg):
             return d_eeg, d_fmri
 
 
-        d_eeg, gcpt_start_e = _format_gradcpt_eeg(stim_label, events, event_id, raw, raw_onsets, mat)
-        d_fmri = _format_gradcpt_fmri(stim_label, events, event_id, raw, raw_onsets, gcpt_start_e, mat)
+        d_eeg, gcpt_start_e = _format_gradcpt_eeg(stim_label, summary, event_id, sfreq, raw_onsets, mat)
+        d_fmri = _format_gradcpt_fmri(stim_label, summary, event_id, sfreq, raw_onsets, gcpt_start_e, mat)
 
         return d_eeg, d_fmri
 
-def _format_gradcpt_eeg(stim_label, events, event_id, raw, raw_onsets, mat):
+def _format_gradcpt_eeg(stim_label, summary, event_id, sfreq, raw_onsets, mat):
     '''
     Format gradcpt data timelocked to EEG start
+    summary is the run's event summary (see eeg_tools.get_event_summary)
     '''
 
     # Get GradCPT onset in EEG time
@@ -349,12 +461,13 @@ def _format_gradcpt_eeg(stim_label, events, event_id, raw, raw_onsets, mat):
     gcpt_end_b = raw_onsets[-1] + avg_duration # Find last trial *offset*
     gcpt_duration_b = gcpt_end_b - raw_onsets[0]
     stim_numeric = event_id[stim_label]
-    gcpt_end_e = events[events[:,2]==stim_numeric,:][:,0][1] / raw.info['sfreq']
+    # Second stimulus marker
+    gcpt_end_e = summary[stim_numeric][1][1] / sfreq
     gcpt_start_e = gcpt_end_e - gcpt_duration_b
 
     return _make_df(raw_onsets, gcpt_start_e, mat), gcpt_start_e
 
-def _format_gradcpt_fmri(stim_label, events, event_id, raw, raw_onsets, gcpt_start_e, mat):
+def _format_gradcpt_fmri(stim_label, summary, event_id, sfreq, raw_onsets, gcpt_start_e, mat):
     '''
     Format gradcpt data timelocked to fMRI start
     *Not* using starttime var
@@ -362,7 +475,8 @@ def _format_gradcpt_fmri(stim_label, events, event_id, raw, raw_onsets, gcpt_sta
     '''
     # Get gradcpt start in fMRI time
     stim_numeric = event_id[stim_label]
-    fmri_onset_e = events[events[:,2]==stim_numeric,:][:,0][0] / raw.info['sfreq']
+    # First stimulus marker
+    fmri_onset_e = summary[stim_numeric][1][0] / sfreq
     gcpt_start_f = gcpt_start_e - fmri_onset_e
 
 
@@ -427,9 +541,7 @@ def _format_ptbp(ptbp, args):
     trigger_codes =  {1: 'brain', 2: 'timeout'}
 
     # Get triggers
-    sub_twopad = str(int(args['subject'])).zfill(2) 
-    run_zeropad = str(int(args['run']))
-    underp_path = ptbp.parent / Path(f'../P/sub-{sub_twopad}_{run_zeropad}_P.mat')
+    underp_path = _get_underp_path(ptbp, args)
     underp_mat = loadmat(str(underp_path))
     triggers_full = underp_mat['eventType'][0]  
     trigger_idxs = np.where(np.isin(triggers_full, [1, 2]))[0]
@@ -478,6 +590,13 @@ def _format_ptbp(ptbp, args):
     return d
 
 
+def _get_underp_path(ptbp, args):
+    # The *_P.mat holding trigger timing for a ptbP.mat
+    sub_twopad = str(int(args['subject'])).zfill(2) 
+    run_zeropad = str(int(args['run']))
+    return ptbp.parent / Path(f'../P/sub-{sub_twopad}_{run_zeropad}_P.mat')
+
+
 def _format_es(behav_path, args, dest_path):
     '''
     es is path to behav data
@@ -0,0 +1,184 @@
+'''
+Writes an mne Raw (read with preload=False) to EDF+ / BDF+ one block of data
+records at a time, so memory use doesn't depend on the recording length
+
+Two passes over the data: the first finds each channel's physical range
+(for the EDF scaling), the second converts and writes. Within a block the
+channels are split over worker threads for the physical -> digital
+conversion, and the next block is read while the current one is written.
+
+EDF data come in records of equal length. Where it can, the record length
+is picked so the records hold exactly the recording's samples (eg 0.73 s
+records for a 7.3 s recording at 500 Hz); otherwise records are 1 s long
+and the last one is padded with the digital value of 0 (physical), so
+readers see that many extra samples of flat signal at the end.
+'''
+
+import warnings
+
+import numpy as np
+import pyedflib
+from pyedflib import highlevel
+from concurrent.futures import ThreadPoolExecutor
+from mne.io.constants import FIFF
+
+
+# Roughly how many bytes of float64 data to read at a time
+BLOCK_BYTES = 8 << 20
+
+# Shortest record length (as a fraction of a second) used to avoid padding
+# the last record; every record also carries an EDF+ annotation signal
+MIN_RECORD_SECONDS = 0.1
+
+# EDF+ record lengths are stored in units of 10 us
+RECORD_UNITS = 100000
+
+# Digital range of each format
+DIGITAL_RANGE = {'.edf': (-32768, 32767),
+                 '.bdf': (-8388608, 8388607)}
+
+FILE_TYPES = {'.edf': pyedflib.FILETYPE_EDFPLUS,
+              '.bdf': pyedflib.FILETYPE_BDFPLUS}
+
+
+def write_edf(raw, filename, threads=1):
+    '''
+    Writes raw to filename (.edf for 16 bit EDF+, .bdf for 24 bit BDF+)
+
+    PARAMETERS
+    ----------
+    raw (mne.io.Raw): the recording; data are read from disk block by block
+    filename (str): output file, the extension picks the format
+    threads (int): worker threads for the per-block conversion
+
+    Voltage channels are written in uV, everything else in its own unit
+    '''
+
+    extension = str(filename)[-4:].lower()
+    dmin, dmax = DIGITAL_RANGE[extension]
+    n_channels = len(raw.ch_names)
+    sfreq = raw.info['sfreq']
+    scales = np.array([1e6 if ch['unit'] == FIFF.FIFF_UNIT_V else 1.0
+                       for ch in raw.info['chs']])
+
+    pool = ThreadPoolExecutor(max_workers=max(1, threads))
+    groups = np.array_split(np.arange(n_channels), max(1, min(threads, n_channels)))
+
+    def read(block):
+        start, stop = block
+        return raw.get_data(start=start, stop=stop) * scales[:, None]
+
+    try:
+        # First pass: physical range per channel
+        pmin = np.full(n_channels, np.inf)
+        pmax = np.full(n_channels, -np.inf)
+        blocks = _get_blocks(raw.n_times, n_channels, int(round(sfreq)))
+        for data in _prefetch(pool, read, blocks):
+            pmin = np.minimum(pmin, data.min(axis=1))
+            pmax = np.maximum(pmax, data.max(axis=1))
+        pmin, pmax = _header_range(pmin, pmax)
+
+        signal_headers = highlevel.make_signal_headers(raw.ch_names,
+                                                       sample_frequency=sfreq)
+        for header, ch_min, ch_max, scale in zip(signal_headers, pmin, pmax, scales):
+            header.update(dimension='uV' if scale != 1 else '',
+                          physical_min=ch_min, physical_max=ch_max,
+                          digital_min=dmin, digital_max=dmax)
+
+        gain = (dmax - dmin) / (pmax - pmin)
+        # Digital value of physical 0 per channel, to pad the last record
+        zero = np.clip(np.rint(-pmin * gain + dmin), dmin, dmax).astype(np.int32)
+        record_samples = _get_record_samples(raw.n_times, sfreq)
+
+        # Second pass: convert and write, one data record at a time
+        with pyedflib.EdfWriter(str(filename), n_channels=n_channels,
+                                file_type=FILE_TYPES[extension]) as writer:
+            writer.setSignalHeaders(signal_headers)
+            writer.setHeader(highlevel.make_header())
+            if record_samples is not None:
+                with warnings.catch_warnings():
+                    # pyedflib warns about any record length it didn't pick
+                    warnings.simplefilter('ignore')
+                    writer.setDatarecordDuration(record_samples / sfreq)
+            # Blocks have to hold whole data records
+            per_record = writer.get_smp_per_record(0)
+            blocks = _get_blocks(raw.n_times, n_channels, per_record)
+            for data in _prefetch(pool, read, blocks):
+                digital = np.empty(data.shape, dtype=np.int32)
+                futures = [pool.submit(_to_digital, data, digital, group,
+                                       pmin, gain, dmin, dmax)
+                           for group in groups]
+                for future in futures:
+                    future.result()
+                _write_records(writer, digital, per_record, zero)
+    finally:
+        pool.shutdown()
+
+
+def _get_blocks(n_times, n_channels, per_record):
+    # (start, stop) sample ranges of about BLOCK_BYTES, in whole records
+    records = max(1, BLOCK_BYTES // (8 * n_channels * per_record))
+    size = per_record * records
+    return [(start, min(start + size, n_times)) for start in range(0, n_times, size)]
+
+
+def _get_record_samples(n_times, sfreq):
+    # Samples per record that divide the recording exactly: the most, up to
+    # one second's worth, for a record length EDF can store; None if there
+    # is none of at least MIN_RECORD_SECONDS (records stay 1 s, the last one
+    # padded)
+    if sfreq != int(sfreq):
+        return None
+    sfreq = int(sfreq)
+    for samples in range(min(sfreq, n_times), 0, -1):
+        if samples < sfreq * MIN_RECORD_SECONDS:
+            return None
+        if n_times % samples == 0 and (samples * RECORD_UNITS) % sfreq == 0:
+            return samples
+    return None
+
+
+def _prefetch(pool, read, blocks):
+    # Yields read(block) for each block, reading the next one on the pool
+    # while the caller works on the current one
+    if not blocks:
+        return
+    future = pool.submit(read, blocks[0])
+    for block in blocks[1:]:
+        data = future.result()
+        future = pool.submit(read, block)
+        yield data
+    yield future.result()
+
+
+def _header_range(pmin, pmax):
+    # EDF headers hold the physical range as 8-character strings; round
+    # outwards to whole units so the header says exactly what we scale with
+    # (and never let a flat channel have an empty range)
+    pmin = np.floor(pmin)
+    pmax = np.ceil(pmax)
+    flat = pmax <= pmin
+    pmin[flat] -= 1
+    pmax[flat] += 1
+    return pmin, pmax
+
+
+def _to_digital(data, out, rows, pmin, gain, dmin, dmax):
+    # Physical -> digital for some of the channels (rows), written into out
+    # (numpy releases the GIL, so groups run in parallel)
+    scaled = (data[rows] - pmin[rows, None]) * gain[rows, None] + dmin
+    out[rows] = np.clip(np.rint(scaled), dmin, dmax)
+
+
+def _write_records(writer, digital, per_record, zero):
+    # One record holds per_record samples of every channel, channel after
+    # channel; a short last record is padded with each channel's digital
+    # value of 0 (physical)
+    n_channels, n_times = digital.shape
+    for start in range(0, n_times, per_record):
+        record = digital[:, start:start + per_record]
+        if record.shape[1] < per_record:
+            padded = np.repeat(zero[:, None], per_record, axis=1)
+            padded[:, :record.shape[1]] = record
+            record = padded
+        writer.blockWriteDigitalSamples(np.ascontiguousarray(record).ravel())
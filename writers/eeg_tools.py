@@ -3,31 +3,165 @@ import os
 import json
 from glob import glob
 import shutil
+import tempfile
+import time
 from pathlib import Path
-from pyedflib import highlevel
 from helpers.modality_specific import (
     get_eeg_json,
     get_channels_tsv
 )
+import numpy as np
 import mne
 import mne_bids
-from helpers.metadata import make_write_log
+from helpers.metadata import make_write_log, dataset_lock
+from helpers.fingerprints import needs_write, record
+from helpers.placement import place_file
+from writers.edf_tools import write_edf
+from helpers.event_cache import put_events, run_key, get_cache_dir
+from helpers.brainvision import read_markers, markers_to_events
+from helpers.throughput import add_timing
+from helpers.trace import span
+from contextlib import contextmanager
 from mne_bids import BIDSPath
+import mne_bids.copyfiles
+import mne_bids.write
 
 
 
-def write_eeg(eeg_files, write_path, make_edf, overwrite, use_mne_bids, progress_bar):
+def write_eeg(eeg_files, write_path, make_edf, overwrite, use_mne_bids, progress_bar,
+              incremental=False, use_hash=False, placement='copy', placements=None,
+              edf_type='.edf', threads=1, timing=None, shard_dir=None, runs=None):
     '''
     Takes as input list of *.eeg files for one subject / session
     And the start of the write path (dest/sub-<>/ses-<>/eeg)
+    With incremental=True, a run is only rewritten if its .eeg / .vhdr /
+    .vmrk changed since it was last written (see helpers/fingerprints.py);
+    use_hash=True compares contents when only the mtime changed
+    placement is how unchanged files (the .eeg) get into the output (see
+    helpers/placement.py); (source, dest, method) for each is appended to
+    the placements list if one is given
+    With make_edf, edf_type picks '.edf' (16 bit) or '.bdf' (24 bit) and
+    threads is the number of threads used converting each recording
+    The source bytes and seconds of each run written are added to timing
+    if one is given (see helpers/throughput.py); every run, written or
+    not, is reported to progress_bar (see helpers/progress.py)
+    With tobids --shard, shard_dir is where this shard keeps its
+    dataset-level files (see helpers/shards.py)
+    runs (from get_eeg_runs) limits the writing to those runs (eg, one
+    task of a session's graph, see writers/session_tools.py)
     '''
 
+    if placements is None:
+        placements = []
+
     write_path = write_path / Path('eeg')
 
     # Logging
     ins = []
     outs = []
 
+    if runs is None:
+        runs = get_eeg_runs(eeg_files, write_path, make_edf, use_mne_bids, edf_type)
+
+    for eeg_run in runs:
+        read_path = eeg_run['read_path']
+        subject = eeg_run['subject']
+        session = eeg_run['session']
+        task_name = eeg_run['task_name']
+        run = eeg_run['run']
+        write_stem = eeg_run['write_stem']
+        sources = eeg_run['sources']
+        main_out = eeg_run['main_out']
+        n_bytes = sum(os.path.getsize(x) for x in sources)
+        if use_mne_bids:
+            write_path_mne = _trim_path_to_dir(write_path, 'rawdata')
+
+        run_overwrite = overwrite
+        if incremental:
+            if not needs_write(main_out, sources, overwrite, incremental, use_hash):
+                ins.append(read_path)
+                if use_mne_bids:
+                    outs.append(main_out)
+                progress_bar.update(n_bytes, 'eeg')
+                continue
+            run_overwrite = True
+        existed = os.path.exists(main_out)
+        started = time.perf_counter()
+
+        # Logging
+        ins.append(read_path)
+
+        # Read through a corrected copy of the vhdr in a temp dir (the
+        # source files are never modified)
+        with tempfile.TemporaryDirectory(prefix='tobids_') as temp_dir:
+            with span('read raw', bytes=n_bytes):
+                temp_path = _make_temp_vhdr(read_path, temp_dir)
+                # Load raw data
+                raw = _load_raw_brainvision(temp_path)
+            # Keep the events for the behavioral writers (see
+            # helpers/event_cache.py)
+            with span('read markers'):
+                events, event_id = markers_to_events(read_markers(read_path.with_suffix('.vmrk')))
+
+            # Use mne_bids to write?
+            if use_mne_bids:
+                outs.append(_make_mne_bids_data(raw,
+                                    write_path_mne,
+                                    subject=_get_number(subject),
+                                    session=_get_number(session),
+                                    task=bandaid_es(task_name),
+                                    run=_get_number(run),
+                                    overwrite=run_overwrite,
+                                    placement=placement,
+                                    placements=placements,
+                                    shard_dir=shard_dir))
+            else:
+                _make_bids_data(temp_path,
+                                write_stem, 
+                                raw, 
+                                make_edf,
+                                run_overwrite,
+                                placement=placement,
+                                placements=placements,
+                                edf_type=edf_type,
+                                threads=threads)
+
+                # Compile and write eeg metadata
+                with span('sidecars'):
+                    eeg_json = get_eeg_json(task_name, raw)
+                    _write_file(eeg_json, write_stem, 'eeg', '.json')
+                    channels_tsv = get_channels_tsv(raw)
+                    _write_file(channels_tsv, write_stem, 'channels', '.tsv')
+
+        # Fingerprint the sources if this run was written (incremental)
+        seconds = 0.0
+        if os.path.exists(main_out) and (run_overwrite or not existed):
+            if incremental:
+                record(main_out, sources, use_hash)
+            seconds = time.perf_counter() - started
+            if timing is not None:
+                add_timing(timing, n_bytes, seconds)
+        progress_bar.update(n_bytes, 'eeg', seconds)
+
+        put_events(run_key(subject, session, bandaid_es(task_name), run),
+                   events, event_id, raw.info['sfreq'],
+                   cache_dir=get_cache_dir(_trim_path_to_dir(write_path, 'rawdata')),
+                   vmrk=read_path.with_suffix('.vmrk'))
+
+    make_write_log(ins, outs, 'eeg', shard_dir)
+
+def get_eeg_runs(eeg_files, write_path, make_edf, use_mne_bids, edf_type='.edf'):
+    '''
+    Takes as input the *.eeg files for one subject / session, the eeg dir
+    in the BIDS dest (dest/sub-<>/ses-<>/eeg) and how the data get written
+    Returns a dict per run with the source and output names write_eeg
+    uses: read_path, subject, session, task_name, run, write_stem,
+    sources (the BrainVision triplet) and main_out (the output file whose
+    fingerprints are kept)
+    '''
+
+    runs_out = []
+
     # Get list of task names
     tasks = list(set([x.parent.name for x in eeg_files]))
 
@@ -56,45 +190,31 @@ def write_eeg(eeg_files, write_path, make_edf, overwrite, use_mne_bids, progress
             write_filename = '_'.join([subject, session, task, run])
             write_stem = write_path / Path(write_filename)
 
-            # Make corrected vhdr with original vhdr filename
-            # Rename old one to .bak
-            _make_temp_vhdr(read_path)
-            # Load raw data
-            raw = _load_raw_brainvision(read_path)
-
-            # Logging
-            ins.append(read_path)
-
-            # Use mne_bids to write?
+            # The BrainVision triplet this run is made from, and the output
+            # file we keep its fingerprints against
+            sources = [read_path.with_suffix(x) for x in ['.eeg', '.vhdr', '.vmrk']]
             if use_mne_bids:
                 write_path_mne = _trim_path_to_dir(write_path, 'rawdata')
-
-                outs.append(_make_mne_bids_data(raw,
-                                    write_path_mne,
-                                    subject=_get_number(subject),
-                                    session=_get_number(session),
-                                    task=bandaid_es(task_name),
-                                    run=_get_number(run),
-                                    overwrite=overwrite,
-                                    progress_bar=progress_bar))
+                main_out = _get_mne_bids_vhdr(write_path_mne,
+                                              subject=_get_number(subject),
+                                              session=_get_number(session),
+                                              task=bandaid_es(task_name),
+                                              run=_get_number(run))
+            elif make_edf:
+                main_out = Path(str(write_stem) + '_eeg' + edf_type)
             else:
-                _make_bids_data(read_path, 
-                                write_stem, 
-                                raw, 
-                                make_edf,
-                                overwrite,
-                                progress_bar)
-
-                # Compile and write eeg metadata
-                eeg_json = get_eeg_json(task_name, raw)
-                _write_file(eeg_json, write_stem, 'eeg', '.json')
-                channels_tsv = get_channels_tsv(raw) 
-                _write_file(channels_tsv, write_stem, 'channels', '.tsv')
+                main_out = Path(str(write_stem) + '_eeg.vhdr')
 
-            # Rename original vhdr to it's original extension
-            _restore_vhdr(read_path)
+            runs_out.append({'read_path': read_path,
+                             'subject': subject,
+                             'session': session,
+                             'task_name': task_name,
+                             'run': run,
+                             'write_stem': write_stem,
+                             'sources': sources,
+                             'main_out': main_out})
 
-    make_write_log(ins, outs, 'eeg')
+    return runs_out
 
 def bandaid_es(task_name):
     # Takes in task name as string
@@ -103,9 +223,17 @@ def bandaid_es(task_name):
         return 'ExperienceSampling'
     return task_name
 
-def get_true_event_label(events, event_id, task):
+def get_true_event_label(events, event_id, task, summary=None):
     # If there's more than one non 255 'Stimulus' marker, take only the one
     # occuring more than once in the data and at the same frequency as 255
+    # summary (from get_event_summary) can be passed in if the caller
+    # already has it
+
+    if summary is None:
+        summary = get_event_summary(events)
+
+    def count(label):
+        return summary[event_id[label]][0] if event_id[label] in summary else 0
 
     # Find first item onset
     item_labels = [x for x in event_id.keys() if 'Stimulus' in x and 'S255' not in x]
@@ -114,39 +242,51 @@ def get_true_event_label(events, event_id, task):
     # If no S255 present, assume no event labels
     if not len(s255):
         return None
-    s255 = s255[0]
-
-    # If there's only one event label and it's in sync with label S255
-    s255_sync = _ensure_s255_sync(events, event_id, item_labels[0], s255)
-    if len(item_labels) == 1 and s255_sync:
-        label = item_labels[0]
-        # If there's not only two labels, return None
-        label_freq = _get_label_frequency(events, event_id, label)
-        if label_freq != 2 and task=='GradCPT':
-            return None
-        return item_labels[0]
+    s255_freq = count(s255[0])
+
     # If there are no event labels, return None
-    elif not len(item_labels):
+    if not len(item_labels):
         return None
 
-
-    # If there's more than one event label
-        # keep only the label occuring in sync with S255
-    out = []
-    for label in item_labels:
-        if _ensure_s255_sync(events, event_id, label, s255):
-            out.append(label)
-
-    if len(out) > 1:
+    # Keep only the labels occuring as often as S255; anything but exactly
+    # one is ambiguous
+    out = [x for x in item_labels if count(x) == s255_freq]
+    if len(out) != 1:
         return None
 
     # Ensure the label only occurs twice
-    label_freq = _get_label_frequency(events, event_id, out[0])
-    if label_freq != 2 and task == 'GradCPT':
+    if count(out[0]) != 2 and task == 'GradCPT':
         return None
     return out[0]
 
 
+# Samples kept per code in get_event_summary (the ES writer looks at the
+# first three item markers)
+SUMMARY_SAMPLES = 3
+
+
+def get_event_summary(events):
+    '''
+    Takes as input an mne-style events array (sample, 0, code)
+    Returns a dict of code -> (count, first samples) built in one pass over
+    the events; first samples are those of the code's first
+    SUMMARY_SAMPLES events, in time order (fewer if it has fewer)
+    '''
+
+    codes = events[:, 2]
+    # Stable sort keeps each code's events in time order
+    order = np.argsort(codes, kind='stable')
+    unique, starts, counts = np.unique(codes[order], return_index=True,
+                                       return_counts=True)
+    samples = events[order, 0]
+
+    summary = {}
+    for code, start, n in zip(unique.tolist(), starts.tolist(), counts.tolist()):
+        firsts = samples[start:start + min(n, SUMMARY_SAMPLES)]
+        summary[code] = (n, tuple(int(x) for x in firsts))
+    return summary
+
+
 def delete_eeg_events(subject, session, write_path):
     '''
     Delete EEG data with "events" suffix
@@ -175,24 +315,6 @@ def delete_eeg_events(subject, session, write_path):
 
 # --------- INTERNAL FUNCTIONS -----------
 
-def _get_label_frequency(events, event_id, label):
-    # Return an int conut of how many times a label occurs in the data
-
-    label_numeric = event_id[label]
-    label_freq = len(events[events[:,2] == label_numeric, :])
-    return label_freq
-
-
-def _ensure_s255_sync(events, event_id, label, s255):
-    # Return True if label occurs equally often as s255
-    # False otherwise
-
-    label_numeric = event_id[label]
-    s255_numeric = event_id[s255]
-    label_freq = len(events[events[:,2] == label_numeric, :])
-    s255_freq = len(events[events[:,2] == s255_numeric, :])
-    return s255_freq == label_freq
-
 def _trim_path_to_dir(path, target_dir_name):
     '''
     Trims a pathlib.Path to end with target_dir_name
@@ -212,7 +334,8 @@ def _trim_path_to_dir(path, target_dir_name):
 
 
 def _make_mne_bids_data(raw, write_path, subject, session, task, run,
-                        overwrite, progress_bar):
+                        overwrite, placement='copy', placements=None,
+                        shard_dir=None):
     '''
     Write a raw BrainVision eeg file to BIDS format using mne bids
 
@@ -226,6 +349,11 @@ def _make_mne_bids_data(raw, write_path, subject, session, task, run,
     task (str): Task name
     run (str): Run number
     overwrite (str): Whether to overwrite existing data
+    placement (str): How to place the .eeg (see helpers/placement.py)
+    placements (list): (source, dest, method) is appended for the .eeg
+    shard_dir (pathlib.Path): with tobids --shard, the dataset-level files
+                              mne-bids keeps up to date go here instead
+                              (see _mne_bids_dataset_files)
     '''
 
 
@@ -236,18 +364,120 @@ def _make_mne_bids_data(raw, write_path, subject, session, task, run,
     if session:
         bids_path.update(session=session)
 
-    write = 0
-    if not os.path.exists(bids_path):
-        write = 1
-    elif overwrite:
-        write = 1
+    vhdr_path = _get_mne_bids_vhdr(write_path, subject, session, task, run)
+    write = needs_write(vhdr_path, [], overwrite)
 
     if write:
-        mne_bids.write_raw_bids(raw, bids_path, overwrite=True, verbose='ERROR')
+        # mne-bids also updates dataset-level files (participants.tsv etc.)
+        # so only one process (of this shard) can be in here at a time
+        # (traced with the wait for the lock, then the write itself)
+        with span('mne-bids'), dataset_lock(shard_dir or write_path), \
+                _mne_bids_dataset_files(shard_dir), _mne_bids_placement(placement, placements), \
+                span('mne_bids.write_raw_bids'):
+            mne_bids.write_raw_bids(raw, bids_path, overwrite=True, verbose='ERROR')
+        # Drop the placeholder events mne-bids wrote for this run; the
+        # behavioral writers make the real ones
+        for extension in ['.tsv', '.json']:
+            events = vhdr_path.with_name(vhdr_path.name.replace('_eeg.vhdr', '_events' + extension))
+            if os.path.exists(events):
+                os.remove(events)
+
+    return bids_path.fpath
+
+
+@contextmanager
+def _mne_bids_placement(placement, placements):
+    '''
+    Route the file copies mne-bids makes (for BrainVision, just the .eeg;
+    it rewrites the .vhdr / .vmrk itself) through place_file
+    mne-bids copies through its module-level `sh` (shutil); swap that for
+    a stand-in while write_raw_bids runs
+    '''
+
+    if placements is None:
+        placements = []
+    original = getattr(mne_bids.copyfiles, 'sh', None)
+    if original is None:
+        # Some other mne-bids layout; let it copy by itself
+        yield
+        return
+
+    mne_bids.copyfiles.sh = _PlacingShutil(placement, placements)
+    try:
+        yield
+    finally:
+        mne_bids.copyfiles.sh = original
+
+
+@contextmanager
+def _mne_bids_dataset_files(shard_dir):
+    '''
+    With tobids --shard, send the dataset-level files write_raw_bids keeps
+    up to date (README, participants.tsv / .json, dataset_description.json)
+    to the shard's own dir instead of the BIDS root, so shards never write
+    the same file; --merge-shards combines them (see helpers/shards.py)
+    Does nothing if shard_dir is None
+    '''
+
+    if shard_dir is None:
+        yield
+        return
+
+    write = mne_bids.write
+    names = ['_readme', '_participants_tsv', '_participants_json', 'make_dataset_description']
+    originals = {name: getattr(write, name, None) for name in names}
+    if None in originals.values():
+        raise ValueError('This mne-bids version can\'t be used with --shard')
+
+    def redirect(fname):
+        return os.path.join(shard_dir, os.path.basename(fname))
+
+    write._readme = lambda datatype, fname, overwrite=False: \
+        originals['_readme'](datatype, redirect(fname), overwrite)
+    write._participants_tsv = lambda raw, subject_id, fname, overwrite=False: \
+        originals['_participants_tsv'](raw, subject_id, redirect(fname), overwrite)
+    write._participants_json = lambda fname, overwrite=False: \
+        originals['_participants_json'](redirect(fname), overwrite)
+    write.make_dataset_description = lambda path, **kwargs: \
+        originals['make_dataset_description'](path=str(shard_dir), **kwargs)
+    try:
+        yield
+    finally:
+        for name, original in originals.items():
+            setattr(write, name, original)
+
+
+class _PlacingShutil:
+    # shutil, except copyfile goes through place_file
+
+    def __init__(self, placement, placements):
+        self.placement = placement
+        self.placements = placements
+
+    def copyfile(self, src, dst, *args, **kwargs):
+        method = place_file(src, dst, self.placement)
+        # src is the link in the temp dir (see _make_temp_vhdr)
+        self.placements.append((Path(os.path.realpath(src)), Path(dst), method))
+        return dst
+
+    def __getattr__(self, name):
+        return getattr(shutil, name)
+
+
+def _get_mne_bids_vhdr(write_path, subject, session, task, run):
+    # Returns the path of the .vhdr mne-bids writes for this run
+
+    bids_path = mne_bids.BIDSPath(subject=subject,
+                                  task=task,
+                                  run=run,
+                                  suffix='eeg',
+                                  extension='.vhdr',
+                                  datatype='eeg',
+                                  root=write_path)
+    if session:
+        bids_path.update(session=session)
 
     return bids_path.fpath
-    
-    progress_bar.update(1)
 
 
 def _get_run_number(task_file):
@@ -292,34 +522,33 @@ def _get_task_files(eeg_files, task_name):
 
 
 
-def _make_temp_vhdr(read_path):
+def _make_temp_vhdr(read_path, temp_dir):
     '''
     Takes in full read path (ie, path to file and extension) of the .eeg
-    file
-    Returns a corrected vhdr file with the original name
-    Renames the original with extension '.bak'
-    '''
-    # Rename original
-    shutil.copy(read_path.with_suffix('.vhdr'), read_path.with_suffix('.bak'))
-    with open(read_path.with_suffix('.bak'), 'r') as old_file:
-        with open(read_path.with_suffix('.vhdr'), 'w') as new_file:
-            for line in old_file:
-                if 'DataFile' in line:
-                    line = 'DataFile={}'.format(str(read_path.stem) + '.eeg\n')
-                if 'MarkerFile' in line:
-                    line = 'MarkerFile={}'.format(str(read_path.stem) + '.vmrk\n')
-                new_file.write(line)
-    new_file.close()
-
-def _restore_vhdr(read_path):
-    '''
-    Takes in full read path (ie, path to file and extension) of the .eeg
-    file
-    Takes the .bak (temp) vhdr and restores it to the original 
+    file and a temp dir
+    Writes a corrected vhdr (DataFile / MarkerFile pointing at the files
+    with the same stem) into temp_dir, next to symlinks to the source .eeg
+    and .vmrk, so mne and mne-bids see a consistent triplet
+    Returns the path of the .eeg link in temp_dir
     '''
 
-    shutil.copy(read_path.with_suffix('.bak'), read_path.with_suffix('.vhdr'))
-    os.remove(read_path.with_suffix('.bak'))
+    temp_path = Path(temp_dir) / Path(read_path.name)
+    for extension in ['.eeg', '.vmrk']:
+        os.symlink(os.path.abspath(read_path.with_suffix(extension)),
+                   temp_path.with_suffix(extension))
+
+    # Work on bytes so headers in any codepage come through unchanged
+    with open(read_path.with_suffix('.vhdr'), 'rb') as file:
+        lines = file.read().splitlines(keepends=True)
+    with open(temp_path.with_suffix('.vhdr'), 'wb') as file:
+        for line in lines:
+            if b'DataFile' in line:
+                line = 'DataFile={}.eeg\n'.format(read_path.stem).encode()
+            if b'MarkerFile' in line:
+                line = 'MarkerFile={}.vmrk\n'.format(read_path.stem).encode()
+            file.write(line)
+
+    return temp_path
 
 
 
@@ -338,7 +567,8 @@ def _load_raw_brainvision(read_path):
 
     return raw
 
-def _make_bids_data(read_path, write_stem, raw, make_edf, overwrite, progress_bar):
+def _make_bids_data(read_path, write_stem, raw, make_edf, overwrite,
+                    placement='copy', placements=None, edf_type='.edf', threads=1):
     '''
     Writes BIDs compatible data in the destination directory
 
@@ -353,21 +583,25 @@ def _make_bids_data(read_path, write_stem, raw, make_edf, overwrite, progress_ba
     make_edf: boolean
               whether or not to write an edf file or move the brainvision
               triplet
+    placement: how to place the .eeg / .vmrk (see helpers/placement.py)
+    placements: list; (source, dest, method) is appended for each placed file
+    edf_type: '.edf' or '.bdf', the format written when make_edf is True
+    threads: threads used for the EDF conversion
     '''
 
+    if placements is None:
+        placements = []
+
+    # mne-bids makes its own dirs; here it's up to us
+    os.makedirs(Path(write_stem).parent, exist_ok=True)
+
     if make_edf:
-        # Get channel names
-        channel_names = raw.info['ch_names']
-        sf = raw.info['sfreq']
-        signal_headers = highlevel.make_signal_headers(channel_names, 
-                                                       sample_frequency=sf)
-        write_file = str(write_stem) + '_eeg.edf'
+        write_file = str(write_stem) + '_eeg' + edf_type
         if not overwrite and not os.path.exists(write_file):
-            highlevel.write_edf(write_file,
-                                raw.get_data(), 
-                                signal_headers)
-            print('\nSaved: {}'.format(str(write_stem) + '_eeg.edf'))
-        progress_bar.update(1)
+            # Streams the data block by block (see writers/edf_tools.py)
+            with span('write ' + edf_type[1:]):
+                write_edf(raw, write_file, threads)
+            print('\nSaved: {}'.format(write_file))
 
     else:
         extensions = ['.eeg', '.vhdr', '.vmrk']
@@ -377,10 +611,17 @@ def _make_bids_data(read_path, write_stem, raw, make_edf, overwrite, progress_ba
             write_file = str(write_stem) + '_eeg' + extension
             # i dont think this logic works
             # if overwrite is true we should write...
-            if not overwrite and not os.path.exists(write_file):
-                shutil.copy(source_file, write_file)
-        # Update progress once per triad
-        progress_bar.update(1)
+            if overwrite or os.path.exists(write_file):
+                continue
+            with span('place ' + extension):
+                if extension == '.vhdr':
+                    # The corrected header from _make_temp_vhdr
+                    shutil.copy(source_file, write_file)
+                else:
+                    method = place_file(source_file, write_file, placement)
+                    # read_path may be a link (see _make_temp_vhdr)
+                    placements.append((Path(os.path.realpath(source_file)), Path(write_file),
+                                       method))
 
 def _write_file(data, write_stem, suffix, extension):
     '''
@@ -2,9 +2,9 @@
 
 
 from pathlib import Path
-import mne
 import pandas as pd
-from writers.eeg_tools import get_true_event_label
+from writers.eeg_tools import get_true_event_label, get_event_summary
+from helpers.event_cache import get_events, run_key, get_cache_dir
 import numpy as np
 from glob import glob
 import re
@@ -45,11 +45,14 @@ def get_eegfmri_behav(vhdr_path, behav_path, args):
     # Item onset in behavioral time
     first_item_behav = behav['onset_original'].to_numpy()[0]
 
-    # Import eeg
-    raw = mne.io.read_raw_brainvision(vhdr_path)
+    # EEG events (kept when the EEG run was written, see
+    # helpers/event_cache.py)
+    key = run_key(args['subject'], args['session'], 'ExperienceSampling', args['run'])
+    events, event_id, sfreq = get_events(key, vhdr_path,
+                                         get_cache_dir(args['dest_path']))
+    summary = get_event_summary(events)
 
     # --- FIND SCAN START IN EEG TIME --- #
-    events, event_id = mne.events_from_annotations(raw)
     tr_label = [x for x in event_id.keys() if 'T  1' in x]
 
     if not len(tr_label):
@@ -57,11 +60,12 @@ def get_eegfmri_behav(vhdr_path, behav_path, args):
         scan_start_eeg = np.nan
     else:
         tr_number = event_id[tr_label[0]]
-        scan_start_eeg = events[events[:, 2] == tr_number, :][0][0] / raw.info['sfreq']
+        scan_start_eeg = summary[tr_number][1][0] / sfreq
 
 
     # --- FIND ITEM START IN EEG TIME --- #
-    item_label = get_true_event_label(events, event_id, task='ExperienceSampling')
+    item_label = get_true_event_label(events, event_id, task='ExperienceSampling',
+                                      summary=summary)
 
     # If cant find a unique item label
     if item_label is None or item_label == '-9999':
@@ -69,7 +73,7 @@ def get_eegfmri_behav(vhdr_path, behav_path, args):
         raise ValueError(message)
 
     item_number = event_id[item_label]
-    first_stims = events[events[:,2] == item_number][:, 0][:3] / raw.info['sfreq']
+    first_stims = np.array(summary[item_number][1]) / sfreq
     first_durations = np.diff(first_stims)
     if not len(first_durations):
         raise ValueError(message)
@@ -1,5 +1,4 @@
 import sys
-import shutil
 import nibabel as nib
 import re
 import os
@@ -7,12 +6,24 @@ import pickle
 from pathlib import Path
 import copy
 from tqdm import tqdm
-from glob import glob
 import os
 import numpy as np
 from helpers.metadata import make_write_log
-
-def write_fmri(fmri_root, write_start, meta_info, overwrite, progress_bar):
+from helpers.inventory import Inventory
+from helpers.fingerprints import needs_write, record
+from helpers.placement import place_file
+import time
+from helpers.pgzip import DEFAULT_LEVEL, new_stats
+from helpers.pipeline import run_pipeline
+from helpers.trace import span
+
+# gzip at nibabel's level with plain zlib
+DEFAULT_COMPRESSION = {'enabled': True, 'level': DEFAULT_LEVEL, 'backend': 'zlib'}
+
+def write_fmri(fmri_root, write_start, meta_info, overwrite, progress_bar,
+               inventory=None, incremental=False, use_hash=False, threads=1,
+               compression=None, placement='copy', placements=None, shard_dir=None,
+               pipeline=None, scans=None):
     '''
     Nested within a subject-session loop
     Moves the appropriate fmri data from source to bids dest
@@ -31,12 +42,132 @@ def write_fmri(fmri_root, write_start, meta_info, overwrite, progress_bar):
                       {'subject': 'sub-001', 'session': '.'}
     overwrite: (boolean) whether to overwrite existing data (with same
                          name)
+    inventory: (helpers.inventory.Inventory) origin inventory to look
+                        scans up in (scanned from fmri_root if not given)
+    incremental: (boolean) only rewrite outputs whose source changed
+                           (see helpers/fingerprints.py)
+    use_hash: (boolean) in incremental mode, compare source contents when
+                        the mtime changed
+    threads: (int) number of threads to gzip each .nii.gz with
+    compression: (dict) {'enabled': write .nii.gz (else plain .nii),
+                         'level': gzip level, 'backend': see helpers/pgzip.py}
+                        (default: DEFAULT_COMPRESSION)
+    placement: (str) how sidecars (and uncompressed images) are put in the
+                     output, see helpers/placement.py
+    placements: (list) (source, dest, method) is appended for every file
+                       placed
+    shard_dir: (pathlib.Path) with tobids --shard, where this shard keeps
+                              its dataset-level files (see helpers/shards.py)
+    pipeline: (dict) {'read_depth', 'write_depth'}: how far reading runs
+                     ahead of compressing and writing behind it
+                     (see helpers/pipeline.py)
+    scans: (list) only write these (from get_fmri_scans, or parts of them)
+                  instead of every scan under fmri_root
+
+    Returns stats on the images written (see helpers.pgzip.new_stats)
     '''
 
+    if inventory is None:
+        inventory = Inventory(fmri_root)
+    if compression is None:
+        compression = DEFAULT_COMPRESSION
+    if placements is None:
+        placements = []
+    stats = new_stats()
+    suffix = '.nii.gz' if compression['enabled'] else '.nii'
+
     # Logging
     outs = []
     ins = []
 
+    # Images to write are collected and then go through the read /
+    # compress / write pipeline together (see helpers/pipeline.py)
+    images = []
+
+    if scans is None:
+        scans = get_fmri_scans(fmri_root, write_start, meta_info, inventory)
+
+    for fmri_scan in scans:
+        niis = fmri_scan['niis']
+        sidecars = fmri_scan['sidecars']
+        dests = fmri_scan['dests']
+
+        # Write nifti
+        for nii, dest in zip(niis, dests):
+            dest_path = dest.with_suffix(suffix)
+            # Make dir
+            os.makedirs(dest_path.parent, exist_ok=True)
+            # Handle overwriting
+            write = needs_write(dest_path, [nii], overwrite, incremental, use_hash)
+
+            # Don't leave the same image behind in the other format
+            _remove_other_format(dest, suffix)
+
+            ins.append(nii)
+            outs.append(dest_path)
+
+            if not write:
+                progress_bar.update(os.path.getsize(nii), 'fmri')
+                continue
+
+            n_bytes = _nifti_bytes(nii)
+            if not compression['enabled'] and os.path.getsize(nii) == n_bytes:
+                # Nothing to strip or compress: place the file whole
+                started = time.perf_counter()
+                with span('place ' + dest_path.name, bytes=n_bytes):
+                    method = place_file(nii, dest_path, placement)
+                placements.append((nii, dest_path, method))
+                seconds = time.perf_counter() - started
+                stats['seconds'] += seconds
+                _add_image(stats, nii, dest_path, incremental, use_hash)
+                progress_bar.update(os.path.getsize(nii), 'fmri', seconds)
+            else:
+                images.append((nii, dest_path, n_bytes))
+
+        # Write json
+        for sidecar, dest in zip(sidecars, dests):
+            dest_path = dest.with_suffix('.json')
+            # Sidecars are always refreshed unless incremental says they're
+            # current
+            if needs_write(dest_path, [sidecar], True, incremental, use_hash):
+                with span('place ' + dest_path.name):
+                    method = place_file(sidecar, dest_path, placement)
+                placements.append((sidecar, dest_path, method))
+                if incremental:
+                    record(dest_path, [sidecar], use_hash)
+
+    def finished(index):
+        # On the pipeline's write thread, as each image is complete; the
+        # images go through one after the other, so each took the time
+        # since the last one was done
+        nii, dest_path, _ = images[index]
+        _add_image(stats, nii, dest_path, incremental, use_hash)
+        now = time.perf_counter()
+        progress_bar.update(os.path.getsize(nii), 'fmri', now - last_done[0])
+        last_done[0] = now
+
+    last_done = [time.perf_counter()]
+    if images:
+        with span('nifti pipeline', bytes=sum(x[2] for x in images)):
+            run_pipeline(images, compression, threads, finished, stats, pipeline)
+
+    make_write_log(ins, outs, 'fmri', shard_dir)
+
+    return stats
+
+
+def get_fmri_scans(fmri_root, write_start, meta_info, inventory):
+    '''
+    Takes as input the fmri root, the subject / session dir in the BIDS
+    dest, the meta_info (see write_fmri) and the origin inventory
+    Returns a dict per scan type (T1w, B0map, BOLD) with the scan_type and
+    the lists niis, sidecars and dests (output paths without a suffix), in
+    the order write_fmri writes them
+    '''
+
+    meta_info = dict(meta_info)
+    scans_out = []
+
     # Get session number
     # Session is empty string if only one session
     if meta_info['session'] != '.':
@@ -59,10 +190,9 @@ def write_fmri(fmri_root, write_start, meta_info, overwrite, progress_bar):
         key, threshold, bids_name = _get_scan_types(scan_type)
 
         # Find the appropriate dir
-        scans = os.listdir(fmri_root)
+        # (The inventory already leaves out hidden dirs)
+        scans = inventory.subdirs(fmri_root)
         target_dirs = [x for x in scans if key in x]
-        # Drop hidden dirs
-        target_dirs = [x for x in target_dirs if not x.startswith('.')]
 
         # Ensure there's the appropriate amount of found folders
         _error_check(target_dirs, threshold, fmri_root, scan_type)
@@ -72,7 +202,7 @@ def write_fmri(fmri_root, write_start, meta_info, overwrite, progress_bar):
         sidecars = []
         for directory in target_dirs:
             scan_root = fmri_root / Path(directory + '/NIFTI')
-            files = [file for file in scan_root.iterdir() if not file.name.startswith('.') and file.is_file()]
+            files = [x.path for x in inventory.files(scan_root, recursive=False)]
             niis += [x for x in files if x.suffix == '.nii']
             sidecars += [x for x in files if x.suffix == '.json']
 
@@ -91,34 +221,46 @@ def write_fmri(fmri_root, write_start, meta_info, overwrite, progress_bar):
         # Build write info
         dests = _get_dests(write_start, meta_info, scan_type, niis, sidecars)
 
-        # Write nifti
-        for nii, dest in zip(niis, dests):
-            dest_path = dest.with_suffix('.nii.gz') 
-            # Make dir
-            if not os.path.exists(dest_path.parent):
-                os.makedirs(dest_path.parent)
-            # Handle overwriting
-            write = False
-            if os.path.exists(dest_path):
-                if overwrite:
-                    write = True
-            else:
-                write = True
+        scans_out.append({'scan_type': scan_type,
+                          'niis': niis,
+                          'sidecars': sidecars,
+                          'dests': dests})
 
-            if write:
-                source_img = nib.load(nii)
-                nib.save(source_img, dest_path)
+    return scans_out
 
-            ins.append(nii)
-            outs.append(dest_path)
-            progress_bar.update(1)
 
-        # Write json
-        for sidecar, dest in zip(sidecars, dests):
-            dest_path = dest.with_suffix('.json')
-            shutil.copy(sidecar, dest_path)
+def _nifti_bytes(nii):
+    '''
+    Takes as input a source .nii
+    Returns the number of bytes the header (with any extensions) and the
+    voxels take up; anything after them is left out of the output
+
+    Only the header is read (nibabel's array proxy knows where the data
+    sits), so the image is then streamed straight from the source and goes
+    out with its header exactly as it came in (nib.save would have filled
+    in some unset fields, eg a NaN scl_slope becomes 1)
+    '''
 
-    make_write_log(ins, outs, 'fmri')
+    proxy = nib.load(nii).dataobj
+    n_voxels = int(np.prod(proxy.shape, dtype=np.int64))
+    return int(proxy.offset) + n_voxels * proxy.dtype.itemsize
+
+
+def _add_image(stats, nii, dest_path, incremental, use_hash):
+    # Count a written image and (incremental) remember what it was written
+    # from
+    stats['images'] += 1
+    stats['bytes_in'] += os.path.getsize(nii)
+    stats['bytes_out'] += os.path.getsize(dest_path)
+    if incremental:
+        record(dest_path, [nii], use_hash)
+
+
+def _remove_other_format(dest, suffix):
+    # dest is the output path without a suffix
+    other = dest.with_suffix('.nii' if suffix == '.nii.gz' else '.nii.gz')
+    if os.path.exists(other):
+        os.remove(other)
 
 
 def _get_dests(write_start, meta_info, scan_type, niis, sidecars):
@@ -237,16 +379,20 @@ def _error_check(l, threshold, fmri_root, scan):
         if len(l) > threshold:
             raise ValueError('{} scan directory is ambiguous {} {}'.format(scan, fmri_root, l))
 
-def get_fmri_root(seek_path):
+def get_fmri_root(seek_path, inventory=None):
     # Returns the fmri root directory 
     # Seek path is origin_path / subject / session
+    # inventory is the origin Inventory (scanned here if not given)
     # Raises an error if it doesn't find exactly one dir
 
+    if inventory is None:
+        inventory = Inventory(seek_path)
+
     keywords = ['BOLD', 'AAHScout', 'Localizer', 'B0map']
 
     founds = []
 
-    for dirpath, dirnames, filenames in os.walk(seek_path):
+    for dirpath, dirnames in inventory.walk_dirs(seek_path):
         hits = 0
         for keyword in keywords:
             if any(keyword in x for x in dirnames):
@@ -261,10 +407,10 @@ def get_fmri_root(seek_path):
                          'fMRI root needs the following dir keywords: '
                          f'{keywords}')
 
-    for item in os.listdir(founds[0]):
+    for item in inventory.subdirs(founds[0]):
         look_dir = os.path.join(founds[0], item)
-        if os.path.isdir(look_dir) and 'BOLD' in item:
-            niis = glob(look_dir + '/**/*.nii', recursive=True)
+        if 'BOLD' in item:
+            niis = inventory.files(look_dir, extension='.nii')
             if not niis:
                 raise ValueError('Unable to infer fMRI root directory. No .nii file in {}'.format(look_dir))
 
@@ -0,0 +1,329 @@
+import os
+from pathlib import Path
+from functools import partial
+from helpers.basic_parsing import parse_data_type
+from writers.eeg_tools import (
+        write_eeg,
+        get_eeg_runs,
+        bandaid_es,
+        delete_eeg_events
+)
+from writers.fmri_tools import (write_fmri, get_fmri_root, get_fmri_scans)
+from writers.behav_tools import (write_behav, get_behav_runs, clear_behav_events)
+from helpers.pgzip import new_stats, add_stats
+from helpers.throughput import new_timings, add_timing, add_timings
+from helpers.event_cache import run_key, drop_events
+from helpers.metadata import make_write_log
+from helpers.scheduler import make_task, run_graph
+from helpers.trace import span, traced, tracing
+
+
+# write_session's once-per-session tasks: clearing old EEG events before
+# the EEG runs, and clear_behav_events before the behavioral runs
+EEG_EVENTS_TASK = 'eeg events'
+BEHAV_EVENTS_TASK = 'behav events'
+
+
+def get_session_units(subjects, origin_path, dest_path, inventory):
+    '''
+    Takes as input
+        subjects (list of dict) from parse_subjects
+        origin_path (pathlib.Path) root of the raw data
+        dest_path (pathlib.Path) the rawdata dir in the BIDS dest
+        inventory (helpers.inventory.Inventory) of the origin path
+    Returns a list of dicts, one per (subject, session), holding everything
+    write_session needs to convert that unit on its own
+    Units come out in subject / session order (the serial order)
+    '''
+
+    units = []
+
+    for subject in subjects:
+
+        # Handle sessions
+        if subject['sessions']:
+            sessions = list(subject['sessions'].keys())
+        else:
+            sessions = ['-999']
+
+        for session in sessions:
+            if sessions[0] == '-999':
+                session_path = Path('')
+                session_arg = Path('')
+            else:
+                session_path = subject['sessions'][session]
+                session_arg = Path('ses-' + session)
+
+            seek_path = origin_path / subject['path'] / session_path
+            # Build write path
+            subject_arg = Path('sub-' + subject['number'])
+
+            unit = {'subject': subject['number'],
+                    'session': session, # -999 if no sessions
+                    'seek_path': seek_path,
+                    'write_path': dest_path / subject_arg / session_arg,
+                    'dest_path': dest_path,
+                    'subject_arg': subject_arg,
+                    'session_arg': session_arg,
+                    # Only this unit's part of the inventory
+                    'inventory': inventory.subset(seek_path),
+                    'size': inventory.size(seek_path)}
+            units.append(unit)
+
+    return units
+
+
+def get_unit_modalities(unit):
+    '''
+    Takes as input one unit from get_session_units
+    Returns the kinds of data it holds ('eeg', 'fmri', 'behav'), in the
+    order write_session writes them
+    '''
+
+    found = parse_data_type(unit['seek_path'], unit['inventory'])
+    return [x for x, present in zip(['eeg', 'fmri', 'behav'], found) if present]
+
+
+def write_session(unit, settings, progress_bar, modalities=None):
+    '''
+    Converts all the data for one subject / session unit
+
+    PARAMETERS
+    ----------
+    unit (dict): One element from get_session_units
+    settings (dict): Run-wide settings with keys
+                     make_edf, edf_type, use_mne_bids, overwrite, incremental, use_hash,
+                     threads, run_jobs, compression, pipeline, placement, shard_dir (None unless
+                     tobids --shard / --queue, see helpers/shards.py), trace (the
+                     dir worker processes put their part of the tobids --trace in,
+                     or None; see helpers/trace.py)
+    progress_bar (ByteProgress): Anything with an update(n_bytes, kind,
+                                 seconds) method (see helpers/progress.py)
+    modalities (list): Only write these kinds of data ('eeg', 'fmri',
+                       'behav'; default all). Behavioral data goes after
+                       the unit's EEG (EEG-synced events are read from it)
+
+    Returns a dict of stats for the run report
+    {'nifti': NIfTI compression stats (see helpers.pgzip.new_stats),
+     'placements': (source, dest, method) for every placed file
+                   (see helpers/placement.py),
+     'timings': source bytes and seconds of the work done per kind of data
+                (see helpers/throughput.py)}
+    '''
+
+    # Traced as subject -> session (see helpers/trace.py)
+    session = 'ses-' + unit['session'] if unit['session'] != '-999' else 'no sessions'
+    with span('sub-' + unit['subject'], 'subject'), \
+            span(session, 'session', bytes=unit['size']):
+        try:
+            return _write_session(unit, settings, progress_bar, modalities)
+        finally:
+            # Done with the unit's EEG events (see helpers/event_cache.py)
+            drop_events(unit['subject'], unit['session'])
+
+
+def _write_session(unit, settings, progress_bar, modalities):
+    # write_session, inside its spans
+    seek_path = unit['seek_path']
+    write_path = unit['write_path']
+    inventory = unit['inventory']
+
+    # Determine whether there is eeg and / or fmri data
+    eeg, fmri, behav = parse_data_type(seek_path, inventory)
+
+    if behav and not fmri:
+        raise ValueError('tobids is only configured to process behavioral data when fMRI data are present.')
+
+    if modalities is None:
+        modalities = ['eeg', 'fmri', 'behav']
+
+    # One task per run and kind of data, run settings['run_jobs'] at a time
+    # in dependency order (see helpers/scheduler.py)
+    tasks = []
+    # Names of the session's EEG tasks, for the behavioral runs to wait on
+    # (already done if they belong to another queue item)
+    eeg_tasks = []
+
+    if eeg:
+        # Get all *.eeg files for that subject/session
+        eeg_files = inventory.files(seek_path, extension='.eeg')
+        eeg_files = [x.path for x in eeg_files]
+        eeg_runs = get_eeg_runs(eeg_files, write_path / Path('eeg'), settings['make_edf'],
+                                settings['use_mne_bids'], settings['edf_type'])
+        # Clear out the events of an earlier conversion first
+        # (incremental runs keep the behavioral events of unchanged runs;
+        # write_eeg drops the mne-bids ones of each run it writes)
+        events_after = [] if settings['incremental'] else [EEG_EVENTS_TASK]
+        run_names = [_eeg_task_name(run_key(x['subject'], x['session'],
+                                            bandaid_es(x['task_name']), x['run']))
+                     for x in eeg_runs]
+        eeg_tasks = events_after + run_names
+
+        if 'eeg' in modalities:
+            print('Writing EEG data')
+            if events_after:
+                tasks.append(_make_run_task(unit, 'eeg', EEG_EVENTS_TASK,
+                                            partial(delete_eeg_events, unit['subject'],
+                                                    unit['session'], write_path)))
+            for eeg_run, name in zip(eeg_runs, run_names):
+                tasks.append(_make_run_task(unit, 'eeg', name,
+                                            partial(_write_eeg_runs, unit, settings,
+                                                    progress_bar, [eeg_run]),
+                                            sources=eeg_run['sources'], after=events_after))
+
+    if fmri and 'fmri' in modalities:
+        print('Writing fMRI data')
+        # Get root fmri dir
+        # (the one with all the fmri dirs from the scan nested inside)
+        fmri_root = get_fmri_root(seek_path, inventory)
+        meta_info = {'subject': str(unit['subject_arg']),
+                     'session': str(unit['session_arg'])}
+        scans = get_fmri_scans(fmri_root, write_path, meta_info, inventory)
+        if settings['run_jobs'] > 1:
+            # A task per image
+            for scan in scans:
+                for i in range(len(scan['niis'])):
+                    image = {'scan_type': scan['scan_type'],
+                             'niis': scan['niis'][i:i + 1],
+                             'sidecars': scan['sidecars'][i:i + 1],
+                             'dests': scan['dests'][i:i + 1]}
+                    tasks.append(_make_run_task(unit, 'fmri', 'fmri ' + image['dests'][0].name,
+                                                partial(_write_fmri_scans, unit, settings,
+                                                        progress_bar, fmri_root, meta_info,
+                                                        [image]),
+                                                sources=image['niis']))
+        else:
+            # One at a time, the NIfTI pipeline overlaps the images of the
+            # session by itself (see helpers/pipeline.py)
+            tasks.append(_make_run_task(unit, 'fmri', 'fmri',
+                                        partial(_write_fmri_scans, unit, settings, progress_bar,
+                                                fmri_root, meta_info, scans),
+                                        sources=[x for scan in scans for x in scan['niis']]))
+
+    if behav and 'behav' in modalities:
+        print('Writing behavioral data')
+        # Once for the session, after its EEG (as a whole-session
+        # write_behav does it)
+        tasks.append(_make_run_task(unit, 'behav', BEHAV_EVENTS_TASK,
+                                    partial(clear_behav_events, unit['subject'],
+                                            unit['session'], unit['dest_path']),
+                                    after=eeg_tasks))
+        for behav_run in get_behav_runs(unit['subject'], unit['session'], seek_path,
+                                        unit['dest_path'], eeg, inventory):
+            task = behav_run['out_bids'].task
+            after = [BEHAV_EVENTS_TASK]
+            if 'eeg' in behav_run['datatypes']:
+                # EEG-synced: the clock comes from the same run's EEG (if
+                # the session has it)
+                key = run_key(unit['subject'], unit['session'], task, behav_run['run'])
+                after += [x for x in [EEG_EVENTS_TASK, _eeg_task_name(key)] if x in eeg_tasks]
+            name = 'behav {} run {}'.format(task, behav_run['run'])
+            tasks.append(_make_run_task(unit, 'behav', name,
+                                        partial(_write_behav_runs, unit, settings, progress_bar,
+                                                eeg, fmri, [behav_run]),
+                                        sources=[behav_run['path']], after=after))
+
+    stats = _new_task_stats()
+    # A queue item without the EEG comes after the one with it
+    done = eeg_tasks if 'eeg' not in modalities else []
+    for result in run_graph(tasks, settings['run_jobs'], done):
+        if result is None:
+            continue
+        add_stats(stats['nifti'], result['nifti'])
+        stats['placements'] += result['placements']
+        add_timings(stats['timings'], result['timings'])
+        stats['behav_log'] += result['behav_log']
+
+    # One journal entry for the session's behavioral runs (the pairs aren't
+    # part of the stats returned)
+    behav_log = stats.pop('behav_log')
+    if behav_log:
+        ins, outs = zip(*behav_log)
+        make_write_log(list(ins), list(outs), 'behav', settings['shard_dir'])
+
+    return stats
+
+
+def _make_run_task(unit, modality, name, work, sources=None, after=None):
+    # A task of the session's graph; when tracing, its work is timed as
+    # modality -> run, with the unit (--run-jobs threads don't have its
+    # spans) and the run's source bytes
+    if tracing():
+        n_bytes = sum(os.path.getsize(x) for x in sources or [])
+        work = traced(traced(work, name, 'run', bytes=n_bytes), modality, 'modality',
+                      unit='sub-{} ses-{}'.format(unit['subject'], unit['session']))
+    return make_task(name, work, after)
+
+
+def _eeg_task_name(key):
+    # key from helpers.event_cache.run_key
+    return 'eeg {} run {}'.format(key[2], key[3])
+
+
+def _new_task_stats():
+    # behav_log: the (input, output) pairs of behavioral runs, journaled
+    # once per session
+    return {'nifti': new_stats(), 'placements': [], 'timings': new_timings(),
+            'behav_log': []}
+
+
+def _write_eeg_runs(unit, settings, progress_bar, eeg_runs):
+    # Task: write some of the session's EEG runs (from get_eeg_runs)
+    stats = _new_task_stats()
+    write_eeg([x['read_path'] for x in eeg_runs],
+              unit['write_path'],
+              settings['make_edf'],
+              settings['overwrite'],
+              settings['use_mne_bids'],
+              progress_bar,
+              incremental=settings['incremental'],
+              use_hash=settings['use_hash'],
+              placement=settings['placement'],
+              placements=stats['placements'],
+              edf_type=settings['edf_type'],
+              threads=settings['threads'],
+              timing=stats['timings']['eeg'],
+              shard_dir=settings['shard_dir'],
+              runs=eeg_runs)
+    return stats
+
+
+def _write_fmri_scans(unit, settings, progress_bar, fmri_root, meta_info, scans):
+    # Task: write some of the session's NIfTI images (from get_fmri_scans)
+    stats = _new_task_stats()
+    stats['nifti'] = write_fmri(fmri_root, unit['write_path'], meta_info,
+                                settings['overwrite'], progress_bar,
+                                inventory=unit['inventory'],
+                                incremental=settings['incremental'],
+                                use_hash=settings['use_hash'],
+                                threads=settings['threads'],
+                                compression=settings['compression'],
+                                placement=settings['placement'],
+                                placements=stats['placements'],
+                                shard_dir=settings['shard_dir'],
+                                pipeline=settings['pipeline'],
+                                scans=scans)
+    add_timing(stats['timings']['fmri'], stats['nifti']['bytes_in'],
+               stats['nifti']['seconds'], stats['nifti']['images'])
+    return stats
+
+
+def _write_behav_runs(unit, settings, progress_bar, eeg, fmri, runs):
+    # Task: write some of the session's behavioral runs (from get_behav_runs)
+    stats = _new_task_stats()
+    write_behav(unit['subject'],
+        unit['session'], # Goes in as -999 if no sessions
+        unit['seek_path'],
+        unit['dest_path'], # writedir/rawdata
+        settings['overwrite'],
+        eeg,
+        fmri,
+        inventory=unit['inventory'],
+        incremental=settings['incremental'],
+        use_hash=settings['use_hash'],
+        timing=stats['timings']['behav'],
+        shard_dir=settings['shard_dir'],
+        runs=runs,
+        progress_bar=progress_bar,
+        log=stats['behav_log'])
+    return stats